@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ******************************************************************************
+#
+# Purpose:  Compare tiling engines of gdal2mbtiles.py (--engine) on sample
+#           datasets: wall time, number of tiles and size of the .mbtiles.
+#
+# Usage:    benchmark.py [options] input [input ...] [-- gdal2mbtiles options]
+#
+#           benchmark.py --repeat 3 dem.tif ortho.vrt -- -z 10-14 -f JPEG
+#
+# ******************************************************************************
+
+import os
+import sys
+import sqlite3
+from optparse import OptionParser
+
+import gdal2mbtiles
+
+
+class SilentProgress(object):
+    """Progress receiver in place of the GUI progress bar"""
+
+    def progress_emiter(self, maxz, minz, processed_tiles, total, overview=False):
+        pass
+
+
+def run(engine, input, output, args):
+    """Tiles input to output by the engine, returns (seconds, tiles, bytes)"""
+
+    if os.path.exists(output):
+        os.unlink(output)
+    argv = ['gdal2mbtiles.py'] + args + ['--engine', engine, input, output]
+    seconds = gdal2mbtiles.main(SilentProgress(), argv)
+    con = sqlite3.connect(output)
+    tiles = con.execute("""SELECT COUNT(*) FROM tiles""").fetchone()[0]
+    con.close()
+    return seconds, tiles, os.path.getsize(output)
+
+
+def main(argv):
+    args = []
+    if '--' in argv:
+        args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    p = OptionParser("Usage: %prog [options] input [input ...] [-- gdal2mbtiles options]")
+    p.add_option('--engines', dest='engines', default=",".join(gdal2mbtiles.engine_list),
+                 help="Engines to compare - default '%s'" % ",".join(gdal2mbtiles.engine_list))
+    p.add_option('--repeat', dest='repeat', type='int', default=1,
+                 help="Runs per engine and input, the fastest one is reported - default 1")
+    p.add_option('--workdir', dest='workdir', default='.',
+                 help="Directory for the generated .mbtiles - default the current one")
+    p.add_option('--csv', dest='csv',
+                 help="Append the results to CSV file")
+    options, inputs = p.parse_args(argv[1:])
+    if not inputs:
+        p.error("No input file specified")
+
+    results = []
+    for input in inputs:
+        name = os.path.splitext(os.path.basename(input))[0]
+        for engine in options.engines.split(','):
+            output = os.path.join(options.workdir, '%s.%s.mbtiles' % (name, engine))
+            runs = [run(engine, input, output, args) for i in range(options.repeat)]
+            seconds, tiles, size = min(runs)
+            results.append((input, engine, seconds, tiles, size))
+            print("%s %s: %.2f s, %d tiles, %.1f MB, %.0f tiles/s" % (
+                input, engine, seconds, tiles, size / 1048576.0, tiles / max(seconds, 1e-6)))
+
+    if options.csv:
+        header = not os.path.exists(options.csv)
+        f = open(options.csv, 'a')
+        if header:
+            f.write("input,engine,seconds,tiles,bytes,options\n")
+        for input, engine, seconds, tiles, size in results:
+            f.write('"%s",%s,%.3f,%d,%d,"%s"\n' % (input, engine, seconds, tiles, size, " ".join(args)))
+        f.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -39,7 +39,9 @@ import signal, sys
 import time
 import io
 import os
+import glob
 import json
+import copy
 from PyQt4.QtCore import pyqtSlot
 from PyQt4 import QtCore
 
@@ -64,6 +66,7 @@ os.environ['PROJ_DEBUG'] = 'ON'
 try:
     from osgeo import gdal
     from osgeo import osr
+    from osgeo import ogr
 except:
     import gdal
 
@@ -76,13 +79,20 @@ import math
 try:
     from PIL import Image
     import numpy
-    import osgeo.gdal_array as gdalarray
 except:
     # 'antialias' resampling is not available
     pass
 
 import multiprocessing
+import multiprocessing.pool
+import threading
+import collections
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 import traceback
+import shlex
 import tempfile
 from optparse import OptionParser, OptionGroup
 
@@ -91,6 +101,41 @@ __version__ = "$Id$"
 resampling_list = ('average', 'near', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'antialias')
 profile_list = ('mercator', 'geodetic', 'raster')  # ,'zoomify')
 webviewer_list = ('all', 'google', 'openlayers', 'leaflet', 'index', 'metadata', 'none')
+overview_resampling_list = ('near', 'mode', 'min', 'max', 'weighted')
+png_strategy_list = ('default', 'filtered', 'huffman', 'rle', 'fixed')  # zlib strategies Z_DEFAULT_STRATEGY...
+engine_list = ('native', 'gdal')
+# Dynamic scheduler: tiles are ordered in blocks of SCHEDULER_BLOCK x SCHEDULER_BLOCK tiles,
+# the first chunk of a process has SCHEDULER_CHUNK tiles, the next ones take SCHEDULER_CHUNK_SECONDS
+SCHEDULER_BLOCK = 8
+SCHEDULER_CHUNK = 4
+SCHEDULER_CHUNK_SECONDS = 0.5
+# Encoded tiles waiting for the writer thread of a process (--threads)
+WRITER_QUEUE = 256
+# --memory-budget: estimated memory of a tile generating thread (MB), share of the budget for the
+# GDAL block cache, minimal cache of a process (MB), seconds between adjustments of the active processes
+# and gain of throughput required to keep a process added
+WORKER_MEMORY = 96
+MEMORY_CACHE_SHARE = 0.25
+MEMORY_CACHE_MIN = 16
+ADAPT_INTERVAL = 10
+ADAPT_GAIN = 0.05
+affinity_list = ('none', 'core', 'numa')
+# Classes of tiles of --bbox and --cutline
+CLIP_OUTSIDE, CLIP_INSIDE, CLIP_BOUNDARY = 0, 1, 2
+# Maximal tiles along a side of the coverage bitmap of --coverage, pixels of the mask read per tile
+COVERAGE_TILES = 2048
+COVERAGE_SAMPLES = 2
+# Datasets of the sources of a mosaic kept open by a process
+MOSAIC_OPEN = 64
+# Tiles per work unit of --batch, inputs of jobs kept open by a worker and jobs in progress per process
+BATCH_UNIT = 64
+BATCH_OPEN = 4
+BATCH_ACTIVE = 2
+# Tiles per work unit of --recompress
+RECOMPRESS_BATCH = 256
+# Tile format: (driver, extension), AUTO tiles are JPEG or PNG, the extension is the one of tiles with transparency
+tile_formats = {'PNG': ('PNG', 'png'), 'PNG8': ('PNG', 'png'), 'JPEG': ('JPEG', 'jpg'),
+                'WEBP': ('WEBP', 'webp'), 'AUTO': ('AUTO', 'png')}
 tcount = 0
 # =============================================================================
 # =============================================================================
@@ -492,6 +537,673 @@ class Zoomify(object):
                             "%s-%s-%s.%s" % (z, x, y, self.tileformat))
 
 
+# ---------------------
+
+class ScratchPyramid(object):
+    """
+    Raw pixel scratch store for the overview phase
+    ----------------------------------------------
+
+    Keeps uncompressed tile pixels of a zoom level in a memory-mapped file
+    addressed by tile coordinates, so the overview tiles can be assembled from
+    the raw children instead of decoding (and for JPEG degrading again) the
+    blobs stored in the MBTiles. Only the level being generated and the level
+    below it are needed at any time, the older ones are discarded.
+
+    Every zoom level is stored in two files in the scratch directory:
+      <name>.<z>.raw   - tile pixels, shape (rows, columns, tilesize, tilesize, bands)
+      <name>.<z>.flags - one byte per tile, set when the tile pixels are written
+
+    The files are created sparse and resized by every worker to the same size,
+    so concurrent workers can open them without coordination and write their
+    own (disjoint) tiles.
+    """
+
+    def __init__(self, directory, name, tilesize):
+        self.directory = directory
+        self.name = name
+        self.tilesize = tilesize
+        self.levels = {}
+
+    def filename(self, tz, ext='raw'):
+        "Returns filename of the scratch file for given zoom level"
+
+        return os.path.join(self.directory, "%s.%d.%s" % (self.name, tz, ext))
+
+    def _map(self, filename, shape):
+        "Memory-maps (and creates if necessary) file of the given shape"
+
+        size = 1
+        for s in shape:
+            size *= s
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        return numpy.memmap(filename, dtype=numpy.uint8, mode='r+', shape=shape)
+
+    def open(self, tz, tminmax, tilebands):
+        "Opens the zoom level covering tile range tminmax = (tminx, tminy, tmaxx, tmaxy)"
+
+        if tz not in self.levels:
+            tminx, tminy, tmaxx, tmaxy = tminmax
+            rows, columns = tmaxy - tminy + 1, tmaxx - tminx + 1
+            data = self._map(self.filename(tz, 'raw'),
+                             (rows, columns, self.tilesize, self.tilesize, tilebands))
+            flags = self._map(self.filename(tz, 'flags'), (rows, columns))
+            self.levels[tz] = (tminmax, data, flags)
+        return self.levels[tz]
+
+    def _index(self, tminmax, tx, ty):
+        tminx, tminy, tmaxx, tmaxy = tminmax
+        if tminx <= tx <= tmaxx and tminy <= ty <= tmaxy:
+            return ty - tminy, tx - tminx
+        return None
+
+    def write(self, tz, tx, ty, tile):
+        "Stores tile pixels given as array of shape (tilesize, tilesize, bands)"
+
+        tminmax, data, flags = self.levels[tz]
+        index = self._index(tminmax, tx, ty)
+        if index is None:
+            return
+        bands = min(tile.shape[2], data.shape[4])
+        data[index][:, :, :bands] = tile[:, :, :bands]
+        flags[index] = 1
+
+    def read(self, tz, tx, ty):
+        "Returns view on the stored tile pixels or None if the tile was not written"
+
+        tminmax, data, flags = self.levels[tz]
+        index = self._index(tminmax, tx, ty)
+        if index is None or not flags[index]:
+            return None
+        return data[index]
+
+    def close(self):
+        "Flushes and unmaps all opened levels"
+
+        for tminmax, data, flags in self.levels.values():
+            data.flush()
+            flags.flush()
+        self.levels = {}
+
+    def discard(self, tz):
+        "Removes scratch files of the given zoom level"
+
+        for ext in ('raw', 'flags'):
+            if os.path.exists(self.filename(tz, ext)):
+                os.unlink(self.filename(tz, ext))
+
+
+# ---------------------
+
+class TileEncoder(object):
+    """
+    Encoder of the tile images
+    --------------------------
+
+    Encodes tile pixels (numpy array of shape (tilesize, tilesize, bands)) to the
+    image format of the tiles with the encoder parameters given by options.
+    PIL releases the GIL while encoding, so the encoder is safe to be called from
+    several threads.
+    """
+
+    def __init__(self, tiledriver, options, palettefile=None):
+        self.tiledriver = tiledriver
+
+        # PNG8: tiles quantized to 8-bit palette with alpha, optionally to the palette shared by all tiles
+        self.quantize = tiledriver == 'PNG' and options.output_format == 'PNG8'
+        self.max_error = options.png8_max_error
+        self.palette = None
+        if self.quantize and palettefile and os.path.exists(palettefile):
+            self.palette = Image.open(palettefile)
+            self.palette.load()
+
+        # Encoder parameters of every format (AUTO uses both PNG and JPEG)
+        self.params = {'PNG': {}, 'JPEG': {}, 'WEBP': {}}
+        if options.png_compress_level is not None:
+            self.params['PNG']['compress_level'] = options.png_compress_level
+        if options.png_strategy:
+            self.params['PNG']['compress_type'] = png_strategy_list.index(options.png_strategy)
+        if options.quality is not None:
+            self.params['JPEG']['quality'] = options.quality
+            self.params['WEBP']['quality'] = options.quality
+        if options.jpeg_optimize:
+            self.params['JPEG']['optimize'] = True
+        if options.jpeg_progressive:
+            self.params['JPEG']['progressive'] = True
+        if options.webp_lossless:
+            self.params['WEBP']['lossless'] = True
+        if options.webp_method is not None:
+            self.params['WEBP']['method'] = options.webp_method
+
+    def encode(self, tile_array):
+        "Returns encoded tile image, None if the tile is not to be stored"
+
+        tiledriver = self.tiledriver
+        if tiledriver == 'AUTO':
+            # JPEG for opaque tiles, PNG for tiles with transparency, nothing for empty tiles
+            if tile_array.shape[2] not in (2, 4):
+                tiledriver = 'JPEG'
+            else:
+                alpha = tile_array[:, :, -1]
+                if alpha.max() == 0:
+                    return None
+                tiledriver = 'JPEG' if alpha.min() == 255 else 'PNG'
+
+        if self.quantize:
+            img = self.quantize_tile(tile_array)
+            if img is not None:
+                binary = io.BytesIO()
+                img.save(binary, format=tiledriver, **self.params[tiledriver])
+                return binary.getvalue()
+            # Too many colours for the palette, the tile is stored in truecolour
+
+        if tiledriver == 'JPEG' and tile_array.shape[2] in (2, 4):
+            # JPEG has no alpha channel
+            tile_array = tile_array[:, :, :-1] if tile_array.shape[2] == 4 else tile_array[:, :, 0]
+        img = Image.fromarray(tile_array)
+        if tiledriver == 'WEBP' and img.mode == 'LA':
+            # WebP has only RGB and RGBA
+            img = img.convert('RGBA')
+        binary = io.BytesIO()
+        img.save(binary, format=tiledriver, **self.params[tiledriver])
+        return binary.getvalue()
+
+    def quantize_tile(self, tile_array):
+        """Returns the tile as paletted image (alpha in the tRNS chunk), exact if the tile has at most
+        256 colours, otherwise quantized. None if the quantization error exceeds max_error."""
+
+        if tile_array.shape[2] < 3:
+            tile_array = numpy.array(Image.fromarray(tile_array).convert('RGBA' if tile_array.shape[2] == 2 else 'RGB'))
+        h, w, bands = tile_array.shape
+        has_alpha = bands == 4
+
+        # Exact palette of the colours in the tile, all transparent pixels are one colour
+        keys = numpy.zeros((h, w), numpy.uint32)
+        for i in range(bands):
+            keys = (keys << 8) | tile_array[:, :, i]
+        if has_alpha:
+            keys[tile_array[:, :, 3] == 0] = 0
+        else:
+            keys = (keys << 8) | 255
+        colours, indices = numpy.unique(keys, return_inverse=True)
+        if len(colours) <= 256:
+            palette = numpy.empty((len(colours), 4), numpy.uint8)
+            for i in range(4):
+                palette[:, i] = (colours >> (8 * (3 - i))) & 255
+            return self.paletted(indices.reshape(h, w), palette)
+
+        opaque = tile_array[:, :, 3] > 0 if has_alpha else numpy.ones((h, w), bool)
+
+        if self.palette is not None and (not has_alpha or not (opaque & (tile_array[:, :, 3] < 255)).any()):
+            # Shared palette, the last entry is reserved for transparent pixels
+            rgb = Image.fromarray(numpy.ascontiguousarray(tile_array[:, :, :3]))
+            try:
+                img = rgb.quantize(palette=self.palette, dither=0)
+            except TypeError:
+                img = rgb.quantize(palette=self.palette)
+            indices = numpy.array(img)
+            indices[indices == 255] = 0  # copy of the first entry
+            palette = numpy.empty((256, 4), numpy.uint8)
+            palette[:, :3] = numpy.array(self.palette.getpalette()[:768], numpy.uint8).reshape(256, 3)
+            palette[:, 3] = 255
+            palette[255, 3] = 0
+            if self.quantization_error(tile_array, palette[indices], opaque) <= self.max_error:
+                indices[~opaque] = 255
+                return self.paletted(indices, palette)
+
+        # Per tile palette by the fast octree quantizer (supports alpha)
+        img = Image.fromarray(tile_array).quantize(256, method=2)  # Image.FASTOCTREE
+        back = numpy.array(img.convert('RGBA' if has_alpha else 'RGB'))
+        if self.quantization_error(tile_array, back, opaque) <= self.max_error:
+            return img
+        return None
+
+    def quantization_error(self, tile_array, quantized, opaque):
+        "Mean absolute difference of band values of opaque pixels"
+
+        if not opaque.any():
+            return 0
+        diff = numpy.abs(tile_array.astype(numpy.int16) - quantized[:, :, :tile_array.shape[2]])
+        return diff[opaque].mean()
+
+    def paletted(self, indices, palette):
+        "Returns 'P' image from 2D array of indices to palette given as array of RGBA entries"
+
+        h, w = indices.shape
+        img = Image.frombytes('P', (w, h), indices.astype(numpy.uint8).tobytes())
+        rgb = numpy.zeros((256, 3), numpy.uint8)
+        rgb[:len(palette)] = palette[:, :3]
+        img.putpalette(rgb.ravel().tolist())
+        if (palette[:, 3] < 255).any():
+            img.info['transparency'] = bytes(bytearray(palette[:, 3].tolist()))
+        return img
+
+
+# ---------------------
+class TileWriter(object):
+    """
+    Single writer of tiles of a process
+    -----------------------------------
+
+    With --threads the threads of a process generate tiles with their own datasets
+    and put the encoded tiles here. A background thread inserts them in batches
+    through one SQLite connection per output. An error of the inserts is raised
+    by the next put() or by close(), the queue is drained so that they do not block.
+    """
+
+    def __init__(self, gdal2mbtiles):
+        self.gdal2mbtiles = gdal2mbtiles
+        self.queue = Queue(maxsize=WRITER_QUEUE)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, output, tz, tx, ty, tile_data):
+        "Queues encoded tile for insert into the output, blocks if too many tiles are waiting"
+
+        self.check()
+        self.queue.put((output, tz, tx, ty, tile_data))
+
+    def check(self):
+        "Raises the error of the inserts if any"
+
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        cons = {}
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            while len(batch) < WRITER_QUEUE and not self.queue.empty():
+                batch.append(self.queue.get())
+            for item in batch:
+                if item is None:
+                    done = True
+                    continue
+                if self.error is not None:
+                    continue
+                output, tz, tx, ty, tile_data = item
+                try:
+                    if output not in cons:
+                        cons[output] = self.gdal2mbtiles.mbtiles_connect(output)
+                    self.gdal2mbtiles.insert_tile(cons[output].cursor(), tz, tx, ty, tile_data)
+                except Exception as e:
+                    self.error = e
+            if self.error is None:
+                try:
+                    for con in cons.values():
+                        con.commit()
+                except Exception as e:
+                    self.error = e
+        for con in cons.values():
+            con.close()
+
+    def close(self):
+        "Waits until all queued tiles are inserted, raises the error of the inserts if any"
+
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+
+# ---------------------
+class ConcurrencyController(object):
+    """
+    Adjustment of the number of active processes
+    --------------------------------------------
+
+    With --memory-budget the processes generating tiles are started all and the number of those
+    allowed to take tiles from the dynamic scheduler is kept in a shared value, at first half of them.
+    A paused process releases its GDAL block cache. Every ADAPT_INTERVAL seconds the RSS of the
+    processes and the throughput are measured: a process is paused when the RSS exceeds the budget,
+    or when the last added process has not increased the throughput (then the level is not raised
+    again in this zoom level), otherwise a paused process is resumed while there is memory left for it.
+    """
+
+    def __init__(self, budget, processes):
+        self.budget = budget
+        self.processes = processes
+        self.active = multiprocessing.Value('i', max(1, processes // 2))
+        self.reset()
+
+    def reset(self):
+        "Starts measuring anew, for a new zoom level"
+
+        self.ceiling = self.processes
+        self.step = 0
+        self.rate = None
+        self.time = time.time()
+        self.tiles = 0
+
+    def update(self, procs, tiles):
+        "Measures RSS of procs and throughput given by the number of tiles processed, adjusts the active processes"
+
+        now = time.time()
+        if now - self.time < ADAPT_INTERVAL:
+            return
+        rate = (tiles - self.tiles) / (now - self.time)
+        rss = [process_rss(proc.pid) for proc in procs if proc.is_alive()]
+        rss = sum(rss) if rss and None not in rss else None
+        active = self.active.value
+        if rss is not None and rss > self.budget:
+            step = -1
+        elif self.step > 0 and self.rate is not None and rate < self.rate * (1 + ADAPT_GAIN):
+            # The input is not faster read by more processes
+            step = -1
+            self.ceiling = active - 1
+        elif active < self.ceiling and (rss is None or rss + rss / active < self.budget * (1 - ADAPT_GAIN)):
+            step = 1
+        else:
+            step = 0
+        self.active.value = max(1, active + step)
+        self.step = self.active.value - active
+        self.rate, self.time, self.tiles = rate, now, tiles
+
+
+def release_memory():
+    """Empties the GDAL block cache of a paused process and returns the freed heap to the system"""
+
+    gdal.SetCacheMax(0)
+    try:
+        import ctypes
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (ImportError, OSError, AttributeError):
+        pass
+
+
+def process_rss(pid):
+    """Resident memory of the process in MB, None if not known (/proc is not available)"""
+
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def parse_cpulist(text):
+    """Set of CPUs of a kernel cpulist like '0-3,8-11'"""
+
+    cpus = set()
+    for part in text.strip().split(','):
+        if part:
+            lo, _, hi = part.partition('-')
+            cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def numa_nodes():
+    """CPUs of the NUMA nodes, a single node with all CPUs if the system does not tell"""
+
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda path: int(path.split('/')[-2][4:])):
+        with open(path) as f:
+            cpus = parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [set(range(multiprocessing.cpu_count()))]
+
+
+def set_affinity(mode, cpu):
+    """Pins the current process cpu to a core or a NUMA node of the CPUs it is allowed to run on"""
+
+    allowed = os.sched_getaffinity(0)
+    if mode == 'core':
+        cpus = sorted(allowed)
+        os.sched_setaffinity(0, [cpus[cpu % len(cpus)]])
+    elif mode == 'numa':
+        nodes = [node & allowed for node in numa_nodes()]
+        nodes = [node for node in nodes if node]
+        if nodes:
+            os.sched_setaffinity(0, nodes[cpu % len(nodes)])
+
+
+# ---------------------
+class SourceIndex(object):
+    """
+    Spatial index of the sources of a mosaic
+    ----------------------------------------
+
+    Footprints (minx, miny, maxx, maxy, resolution) in the output SRS are hashed into a grid of
+    cells of the median footprint size. A query visits only the cells it overlaps, so its cost
+    depends on the local overlap of the sources and not on their total number.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        sizes = sorted(max(b[2] - b[0], b[3] - b[1]) for b in boxes)
+        self.cell = sizes[len(sizes) // 2] or 1.0
+        self.grid = {}
+        for i, b in enumerate(boxes):
+            for key in self.cells(b[0], b[1], b[2], b[3]):
+                self.grid.setdefault(key, []).append(i)
+
+    def cells(self, minx, miny, maxx, maxy):
+        c = self.cell
+        for cx in range(int(math.floor(minx / c)), int(math.floor(maxx / c)) + 1):
+            for cy in range(int(math.floor(miny / c)), int(math.floor(maxy / c)) + 1):
+                yield cx, cy
+
+    def query(self, minx, miny, maxx, maxy):
+        "Indices of the sources intersecting the box, in the order of the sources"
+
+        cells = (math.floor(maxx / self.cell) - math.floor(minx / self.cell) + 1) * \
+                (math.floor(maxy / self.cell) - math.floor(miny / self.cell) + 1)
+        if cells > len(self.boxes):
+            candidates = range(len(self.boxes))
+        else:
+            candidates = set()
+            for key in self.cells(minx, miny, maxx, maxy):
+                candidates.update(self.grid.get(key, ()))
+        return sorted(i for i in candidates if self.boxes[i][0] < maxx and self.boxes[i][2] > minx and
+                      self.boxes[i][1] < maxy and self.boxes[i][3] > miny)
+
+
+# ---------------------
+class ClipRegion(object):
+    """
+    Clipping region of --bbox and --cutline
+    ---------------------------------------
+
+    Tiles are classified as outside, inside or on the boundary of the region geometry given in the
+    output SRS. A tile takes the class of its parent when the parent is wholly inside or outside,
+    so the geometry is tested only along the boundary, from the low zoom levels up. Tiles on the
+    boundary are masked by the geometry rasterized into their alpha band.
+    """
+
+    def __init__(self, geometry, srs, tilebounds):
+        self.geometry = geometry
+        self.tilebounds = tilebounds
+        self.classes = {}
+        self.mem_drv = gdal.GetDriverByName('MEM')
+        self.source = ogr.GetDriverByName('Memory').CreateDataSource('')
+        self.layer = self.source.CreateLayer('clip', srs, ogr.wkbPolygon)
+        feature = ogr.Feature(self.layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        self.layer.CreateFeature(feature)
+
+    def classify(self, tx, ty, tz):
+        "Class of the tile: CLIP_OUTSIDE, CLIP_INSIDE or CLIP_BOUNDARY"
+
+        key = (tz, tx, ty)
+        if key not in self.classes:
+            parent = self.classify(tx >> 1, ty >> 1, tz - 1) if tz > 0 else CLIP_BOUNDARY
+            if parent != CLIP_BOUNDARY:
+                return parent
+            minx, miny, maxx, maxy = self.tilebounds(tx, ty, tz)
+            ring = ogr.Geometry(ogr.wkbLinearRing)
+            for x, y in ((minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)):
+                ring.AddPoint_2D(x, y)
+            box = ogr.Geometry(ogr.wkbPolygon)
+            box.AddGeometry(ring)
+            if not self.geometry.Intersects(box):
+                self.classes[key] = CLIP_OUTSIDE
+            elif self.geometry.Contains(box):
+                self.classes[key] = CLIP_INSIDE
+            else:
+                self.classes[key] = CLIP_BOUNDARY
+        return self.classes[key]
+
+    def mask(self, tile_array, tx, ty, tz):
+        "Clears the alpha (last band) of tile pixels outside of the geometry"
+
+        minx, miny, maxx, maxy = self.tilebounds(tx, ty, tz)
+        size = tile_array.shape[0]
+        ds = self.mem_drv.Create('', size, size, 1)
+        ds.SetGeoTransform((minx, (maxx - minx) / size, 0.0, maxy, 0.0, -(maxy - miny) / size))
+        gdal.RasterizeLayer(ds, [1], self.layer, burn_values=[255])
+        tile_array = numpy.array(tile_array)
+        tile_array[:, :, -1] = numpy.minimum(tile_array[:, :, -1], ds.GetRasterBand(1).ReadAsArray())
+        return tile_array
+
+
+# ---------------------
+class ValueScaler(object):
+    """
+    Value scaling of 16-bit and float sources
+    -----------------------------------------
+
+    Maps source values to 8-bit tile values per tile buffer: linear stretch of each band
+    from its (min, max) range to 0-255 with optional gamma. With a colour ramp the single
+    band is mapped through a lookup table of 256 RGBA entries interpolated from the ramp
+    entries, as by gdaldem color-relief.
+
+    Without ranges the values are indices of a paletted band, expanded through the
+    lookup table given as lut (the colour table, transparent for NODATA).
+    """
+
+    def __init__(self, ranges, gamma=1.0, ramp=None, lut=None):
+        self.ranges = None if ranges is None else numpy.array(ranges, numpy.float64).reshape(-1, 2)
+        self.gamma = gamma
+        self.lut = lut
+        if ramp:
+            # Source values of the 256 scaled values, ramp entries given in percents are relative to the range
+            lo, hi = self.ranges[0]
+            values = lo + (numpy.arange(256) / 255.0) ** gamma * (hi - lo)
+            ramp = sorted((lo + value * (hi - lo) / 100.0 if percent else value, rgba)
+                          for value, percent, rgba in ramp)
+            colours = numpy.array([rgba for value, rgba in ramp], numpy.float64)
+            self.lut = numpy.empty((256, 4), numpy.uint8)
+            for i in range(4):
+                self.lut[:, i] = numpy.interp(values, [value for value, rgba in ramp], colours[:, i]) + 0.5
+
+    def scale(self, data):
+        """Maps array of shape (bands, ...) of source values to uint8 array of the same shape,
+        of shape (4, ...) with RGBA of the colour ramp or colour table"""
+
+        if self.ranges is None:
+            indices = numpy.clip(numpy.nan_to_num(data[0]) + 0.5, 0, 255).astype(numpy.uint8)
+            return numpy.rollaxis(self.lut[indices], -1, 0)
+
+        shape = (-1,) + (1,) * (data.ndim - 1)
+        lo = self.ranges[:, 0].reshape(shape)
+        hi = self.ranges[:, 1].reshape(shape)
+        scaled = numpy.nan_to_num((data - lo) / (hi - lo)).astype(numpy.float32)
+        numpy.clip(scaled, 0, 1, out=scaled)
+        if self.gamma != 1.0:
+            scaled **= 1.0 / self.gamma
+        scaled = (scaled * 255 + 0.5).astype(numpy.uint8)
+        if self.lut is not None:
+            return numpy.rollaxis(self.lut[scaled[0]], -1, 0)
+        return scaled
+
+
+# ---------------------
+# Overview kernels
+#
+# Vectorized alternatives to the GDAL resampling of overview tiles. Every kernel
+# gets the query window of four underlying tiles rearranged by overview_blocks()
+# to shape (tilesize, tilesize, 4, bands) and returns the tile (tilesize, tilesize, bands).
+# If has_alpha is set the last band is alpha and transparent pixels are ignored.
+
+def overview_blocks(query):
+    "Rearranges (2*size, 2*size, bands) array so the 2x2 source pixels of every target pixel are on axis 2"
+
+    h, w, bands = query.shape
+    return query.reshape(h // 2, 2, w // 2, 2, bands).swapaxes(1, 2).reshape(h // 2, w // 2, 4, bands)
+
+
+def overview_near(blocks, has_alpha):
+    "Nearest neighbour - upper left pixel of the block"
+
+    return blocks[:, :, 0, :].copy()
+
+
+def overview_mode(blocks, has_alpha):
+    "Most frequent colour of the block, for categorical rasters (ties resolved in favour of the upper left)"
+
+    keys = numpy.zeros(blocks.shape[:3], numpy.uint32)
+    for i in range(blocks.shape[3]):
+        keys = (keys << 8) | blocks[:, :, :, i]
+    # counts[..., i] = number of (opaque) pixels having the colour of pixel i
+    counts = (keys[:, :, :, None] == keys[:, :, None, :])
+    if has_alpha:
+        valid = blocks[:, :, :, -1] > 0
+        counts &= valid[:, :, None, :]
+        counts = counts.sum(axis=3)
+        counts[~valid] = -1
+    else:
+        counts = counts.sum(axis=3)
+    index = counts.argmax(axis=2)
+    return numpy.take_along_axis(blocks, index[:, :, None, None], axis=2)[:, :, 0, :]
+
+
+def _overview_extreme(blocks, has_alpha, reduce, fill):
+    if not has_alpha:
+        return reduce(blocks, axis=2)
+    data = blocks[:, :, :, :-1].copy()
+    data[blocks[:, :, :, -1] == 0] = fill
+    tile = numpy.empty(blocks.shape[:2] + blocks.shape[3:], numpy.uint8)
+    tile[:, :, :-1] = reduce(data, axis=2)
+    tile[:, :, -1] = blocks[:, :, :, -1].max(axis=2)
+    return tile
+
+
+def overview_min(blocks, has_alpha):
+    "Minimum of every band over the opaque pixels of the block"
+
+    return _overview_extreme(blocks, has_alpha, numpy.min, 255)
+
+
+def overview_max(blocks, has_alpha):
+    "Maximum of every band over the opaque pixels of the block"
+
+    return _overview_extreme(blocks, has_alpha, numpy.max, 0)
+
+
+def overview_weighted(blocks, has_alpha):
+    "Average weighted by alpha, so transparent pixels do not darken the edges"
+
+    if not has_alpha:
+        return ((blocks.sum(axis=2, dtype=numpy.uint32) + 2) // 4).astype(numpy.uint8)
+    alpha = blocks[:, :, :, -1].astype(numpy.uint32)
+    weight = alpha.sum(axis=2)
+    tile = numpy.empty(blocks.shape[:2] + blocks.shape[3:], numpy.uint8)
+    data = (blocks[:, :, :, :-1] * alpha[:, :, :, None]).sum(axis=2, dtype=numpy.uint32)
+    tile[:, :, :-1] = (data + weight[:, :, None] // 2) // numpy.maximum(weight, 1)[:, :, None]
+    tile[:, :, -1] = (weight + 2) // 4
+    return tile
+
+
+overview_kernels = {
+    'near': overview_near,
+    'mode': overview_mode,
+    'min': overview_min,
+    'max': overview_max,
+    'weighted': overview_weighted,
+}
+
 # =============================================================================
 # =============================================================================
 # =============================================================================
@@ -535,19 +1247,12 @@ class GDAL2Mbtiles(object):
         self.input = None
         self.output = None
 
-        # Tile format
-
-        self.tilesize = 256
-
         # Should we read bigger window of the input raster and scale it down?
         # Note: Modified leter by open_input()
         # Not for 'near' resampling
         # Not for Wavelet based drivers (JPEG2000, ECW, MrSID)
         # Not for 'raster' profile
         self.scaledquery = True
-        # How big should be query window be for scaling down
-        # Later on reset according the chosen resampling algorightm
-        self.querysize = 4 * self.tilesize
 
         # Should we use Read on the input file for generating overview tiles?
         # Note: Modified later by open_input()
@@ -558,21 +1263,73 @@ class GDAL2Mbtiles(object):
 
         self.optparse_init()
         self.options, self.args = self.parser.parse_args(args=arguments)
+        if self.options.batch:
+            # The jobs of the batch are parsed by batch(), options given here apply to all of them
+            if self.args:
+                self.error("Only options are expected with --batch, the files are given in the job list")
+            return
         if not self.args:
             self.error("No input file specified")
 
+        # Distributed rendering: a job takes the files and options from the manifest (options given
+        # on the command line are applied over them), the merge takes the output from it
+        self.manifest = None
+        self.manifestfile = None
+        self.job = None
+        if self.options.job is not None or self.options.merge:
+            if len(self.args) != 1:
+                self.error("Only the manifest is expected with --job or --merge")
+            self.manifestfile = self.args[0]
+            try:
+                with open(self.manifestfile) as f:
+                    self.manifest = json.load(f)
+            except (IOError, ValueError) as e:
+                self.error("The manifest '%s' can not be read: %s" % (self.manifestfile, e))
+            if self.options.job is not None:
+                extra = [a for a in arguments if a != self.manifestfile]
+                self.options, self.args = self.parser.parse_args(args=self.manifest['argv'] + extra)
+
         # POSTPROCESSING OF PARSED ARGUMENTS:
 
-        if self.options.output_format == 'JPEG':
-            self.tiledriver = 'JPEG'
-            self.tileext = 'jpg'
+        # Tile format
 
-        elif self.options.output_format == 'PNG':
-            self.tiledriver = 'PNG'
-            self.tileext = 'png'
+        self.tilesize = self.options.tilesize or 256
+        if not 64 <= self.tilesize <= 4096 or self.tilesize & (self.tilesize - 1):
+            self.error("Tile size must be a power of two in range 64-4096")
 
-        else:
-            self.error("Output formats allowed are PNG and JPEG")
+        if self.options.threads < 1:
+            self.error("Number of threads must be positive")
+
+        # Memory budget: processes from what is left after the GDAL cache share, the cache divided among them
+        self.cachemax = None
+        if self.options.memory_budget is not None:
+            budget = self.options.memory_budget
+            if budget < WORKER_MEMORY + MEMORY_CACHE_MIN:
+                self.error("Memory budget must be at least %d MB" % (WORKER_MEMORY + MEMORY_CACHE_MIN))
+            processes = int(budget * (1 - MEMORY_CACHE_SHARE) // (WORKER_MEMORY * self.options.threads))
+            self.options.processes = max(1, min(self.options.processes, processes))
+            self.cachemax = max(MEMORY_CACHE_MIN, int(budget * MEMORY_CACHE_SHARE / self.options.processes))
+
+        if self.options.affinity != 'none' and not hasattr(os, 'sched_setaffinity'):
+            self.error("Pinning of processes is not supported on this system")
+
+        # How big should be query window be for scaling down
+        # Later on reset according the chosen resampling algorightm
+        self.querysize = 4 * self.tilesize
+
+        # Without -f the format of the tiles of --overviews-only is that of the existing tiles
+        self.format_given = self.options.output_format is not None
+        if not self.format_given:
+            self.options.output_format = 'PNG'
+        self.tiledriver, self.tileext = self.check_output_format(self.options.output_format)
+
+        if self.options.webp_method is not None and not 0 <= self.options.webp_method <= 6:
+            self.error("WebP method must be in range 0-6")
+
+        if self.options.png_compress_level is not None and not 0 <= self.options.png_compress_level <= 9:
+            self.error("PNG compression level must be in range 0-9")
+        if self.options.quality is not None and not 1 <= self.options.quality <= 100:
+            self.error("Quality must be in range 1-100")
 
         if self.options.output_cache not in ('tms', 'xyz'):
             self.error("Accepted formats for output cache are 'xyz' or 'tms'")
@@ -591,15 +1348,58 @@ class GDAL2Mbtiles(object):
         # if os.path.isdir(self.args[-1]) or (len(self.args) > 1 and not os.path.exists(self.args[-1])):
         self.output = self.args[-1]
         self.args = self.args[:-1]
-        # More files on the input not directly supported yet
-
-        if (len(self.args) > 1):
-            self.error("Processing of several input files is not supported.",
-                       """Please first use a tool like gdal_vrtmerge.py or gdal_merge.py on the files:
-           gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(self.args))
-        # TODO: Call functions from gdal_vrtmerge.py directly
 
-        self.input = self.args[0]
+        # Several input files are tiled as a mosaic, @FILE stands for the files listed in FILE
+        self.inputargs = list(self.args)
+        inputs = []
+        for arg in self.args:
+            if arg.startswith('@'):
+                try:
+                    with open(arg[1:]) as f:
+                        inputs.extend(line.strip() for line in f if line.strip())
+                except IOError as e:
+                    self.error("The list of input files '%s' can not be read: %s" % (arg[1:], e))
+            else:
+                inputs.append(arg)
+        self.args = inputs[:1]
+        self.sources = inputs if len(inputs) > 1 else None
+        if self.sources:
+            if self.options.profile == 'raster':
+                self.error("Several input files can be tiled only in the 'mercator' and 'geodetic' profiles")
+            if self.options.engine == 'gdal' or self.options.recompress:
+                self.error("Several input files are not supported with --engine=gdal or --recompress",
+                           """Please first use a tool like gdal_vrtmerge.py or gdal_merge.py on the files:
+           gdal_vrtmerge.py -o merged.vrt %s""" % " ".join(inputs))
+
+        if self.options.overviews_only:
+            # The only argument is the existing .mbtiles, no input raster is needed
+            if self.args:
+                self.error("Only the existing .mbtiles file is expected with --overviews-only")
+            self.input = None
+        elif self.options.merge:
+            # The partial outputs of the jobs are merged into the output of the manifest
+            self.output = self.manifest['output']
+            self.input = None
+        else:
+            if not self.args:
+                self.error("No output file specified")
+            self.input = self.args[0]
+
+        if self.options.engine == 'gdal':
+            if self.options.overviews_only or self.options.recompress or self.options.extra_outputs:
+                self.error("--engine=gdal can not be combined with --overviews-only, --recompress or --extra-output")
+            if self.options.profile != 'mercator':
+                self.error("The MBTiles driver of GDAL supports only the 'mercator' profile")
+            if self.options.output_format == 'AUTO' or self.options.color_ramp:
+                self.error("Output format AUTO and colour ramps are not supported with --engine=gdal")
+
+        if self.options.recompress:
+            if self.options.overviews_only or self.options.extra_outputs:
+                self.error("--recompress can not be combined with --overviews-only or --extra-output")
+            if self.options.png8_shared_palette:
+                self.error("Shared PNG8 palette is computed from the input raster, it can not be used with --recompress")
+            if os.path.abspath(self.input) == os.path.abspath(self.output):
+                self.error("The recompressed .mbtiles must be written to another file")
 
         # Default values for not given options
 
@@ -608,7 +1408,7 @@ class GDAL2Mbtiles(object):
             self.output = os.path.splitext(os.path.basename(self.input))[0]
 
         if not self.options.title:
-            self.options.title = os.path.basename(self.input)
+            self.options.title = os.path.basename(self.input or self.output)
 
         if self.options.url and not self.options.url.endswith('/'):
             self.options.url += '/'
@@ -658,16 +1458,149 @@ class GDAL2Mbtiles(object):
         if self.options.zoom:
             minmax = self.options.zoom.split('-', 1)
             minmax.extend([''])
-            min, max = minmax[:2]
-            self.tminz = int(min)
-            if max:
-                self.tmaxz = int(max)
+            zmin, zmax = minmax[:2]
+            self.tminz = int(zmin)
+            if zmax:
+                self.tmaxz = int(zmax)
             else:
-                self.tmaxz = int(min)
+                self.tmaxz = int(zmin)
+
+        if (self.options.bbox or self.options.cutline) and self.options.profile == 'raster':
+            self.error("--bbox and --cutline are supported only in the 'mercator' and 'geodetic' profiles")
+
+        if self.options.coverage and self.options.profile == 'raster':
+            self.error("--coverage is supported only in the 'mercator' and 'geodetic' profiles")
+
+        if self.options.update:
+            if self.options.profile == 'raster':
+                self.error("--update is supported only in the 'mercator' and 'geodetic' profiles")
+            if self.options.resume or self.options.overviews_only or self.options.recompress or \
+                    self.options.engine == 'gdal' or self.options.scratch or self.options.zoom_sources or \
+                    self.options.make_jobs is not None or self.options.job is not None:
+                self.error("--update can not be combined with --resume, --overviews-only, --recompress, "
+                           "--engine=gdal, --scratch, --zoom-source or jobs")
+
+        # Zoom levels rendered from other inputs, as (minz, maxz, input) from the highest
+        self.zoom_sources = []
+        for spec in self.options.zoom_sources or []:
+            zooms, _, path = spec.partition(':')
+            try:
+                minz, _, maxz = zooms.partition('-')
+                minz, maxz = int(minz), int(maxz or minz)
+            except ValueError:
+                minz = maxz = None
+            if minz is None or minz > maxz or not path:
+                self.error("Zoom source must be given as MINZ-MAXZ:INPUT: %s" % spec)
+            self.zoom_sources.append((minz, maxz, path))
+        self.zoom_sources.sort(reverse=True)
+        if self.zoom_sources:
+            if self.tminz is None:
+                self.error("Zoom levels (-z) must be given with --zoom-source")
+            for (minz, maxz, path), (lower_minz, lower_maxz, lower_path) in zip(self.zoom_sources,
+                                                                                self.zoom_sources[1:]):
+                if lower_maxz >= minz:
+                    self.error("Zoom sources %s and %s overlap" % (path, lower_path))
+            if self.options.overviews_only or self.options.recompress or self.options.engine == 'gdal' or \
+                    self.options.make_jobs is not None or self.options.job is not None:
+                self.error("--zoom-source can not be combined with --overviews-only, --recompress, --engine=gdal "
+                           "or jobs")
+
+        # Additional outputs of the same tiles in other formats, as (path, options with the format and quality)
+        self.extra_outputs = []
+        for spec in self.options.extra_outputs or []:
+            fields = spec.split(',', 2)
+            if len(fields) < 2 or not fields[-1]:
+                self.error("Extra output must be given as FORMAT[,QUALITY],FILE: %s" % spec)
+            options = copy.copy(self.options)
+            options.output_format = fields[0].upper()
+            self.check_output_format(options.output_format)
+            if len(fields) == 3 and fields[1]:
+                try:
+                    options.quality = int(fields[1])
+                except ValueError:
+                    self.error("Quality of extra output must be a number: %s" % spec)
+                if not 1 <= options.quality <= 100:
+                    self.error("Quality must be in range 1-100")
+            if os.path.abspath(fields[-1]) == os.path.abspath(self.output):
+                self.error("Extra output must differ from the main output: %s" % spec)
+            self.extra_outputs.append((fields[-1], options))
+        if self.extra_outputs and self.options.overviews_only:
+            self.error("Extra outputs can not be used with --overviews-only")
+        if self.extra_outputs and not self.options.scratch:
+            # Overview tiles of the extra outputs would be built from the decoded lossy (and for JPEG opaque)
+            # tiles of the main output
+            def lossy(options):
+                return options.output_format in ('JPEG', 'PNG8', 'AUTO') or \
+                    options.output_format == 'WEBP' and not options.webp_lossless
+            if lossy(self.options) and not all(lossy(options) for path, options in self.extra_outputs) or \
+                    self.options.output_format == 'JPEG' and \
+                    any(options.output_format != 'JPEG' for path, options in self.extra_outputs):
+                self.error("Extra outputs need --scratch when the main output is lossy (JPEG, PNG8, AUTO or WEBP "
+                           "without --webp-lossless) and they are lossless or, for JPEG, keep transparency")
+
+        # A job renders the zoom levels from the job level up within its tiles into a partial output,
+        # written under a temporary name until finished
+        if self.options.make_jobs is not None or self.options.job is not None or self.options.merge:
+            if self.options.overviews_only or self.options.recompress or self.options.engine == 'gdal':
+                self.error("Jobs can not be combined with --overviews-only, --recompress or --engine=gdal")
+            if self.extra_outputs:
+                self.error("Jobs can not be combined with --extra-output")
+            if self.options.make_jobs is not None and self.options.make_jobs < 1:
+                self.error("Number of jobs must be positive")
+        if self.options.job is not None:
+            jobs = self.manifest['jobs']
+            if not 0 <= self.options.job < len(jobs):
+                self.error("The manifest has jobs 0-%d" % (len(jobs) - 1))
+            self.job = jobs[self.options.job]
+            self.tminz = self.manifest['jobz']
+            self.output = self.job['output'] + '.tmp'
+            if self.options.job:
+                # Web viewers are written by the first job only
+                self.options.webviewer = 'none'
+
+        # Encoding of tiles, optionally in background threads
+        self.palettefile = None
+        if self.options.png8_shared_palette and 'PNG8' in [self.options.output_format] + \
+                [options.output_format for path, options in self.extra_outputs]:
+            self.palettefile = self.output + '.palette.png'
+        self.encoder = None
+        self.extra_sinks = []
+        self.encode_pool = None
+        self.writer = None
+        self.active = None
+        self.tile_list = None
+        # Tile ranges of the input before the restriction by --bbox, --cutline, jobs or --update,
+        # the children of overview tiles are looked up in them
+        self.extents = None
+        self.clip = None
+        self.coverage = None
+        self.coveragefile = self.output + '.coverage.npz'
+        self.encoding = collections.deque()
+
+        # Value scaling of non-Byte sources, the ranges computed by the metadata process are kept in scalefile
+        self.scaler = None
+        self.scalefile = self.output + '.scale.json'
+
+        # Footprints of the sources of a mosaic, indexed by the metadata process into mosaicfile
+        self.source_index = None
+        self.source_datasets = collections.OrderedDict()
+        self.mosaicfile = self.output + '.mosaic.json'
+        if self.options.gamma <= 0:
+            self.error("Gamma must be positive")
+
+        # Numpy kernel for overview tiles, GDAL resampling of --resampling is used if not set
+        self.overview_kernel = None
+        if self.options.overview_resampling:
+            self.overview_kernel = overview_kernels[self.options.overview_resampling]
 
         # KML generation
         self.kml = self.options.kml
 
+        # Raw pixel scratch store for the overview phase
+        self.scratch = None
+        if self.options.scratch:
+            self.scratch = ScratchPyramid(self.options.scratch, os.path.basename(self.output), self.tilesize)
+
         # Output the results
 
         if self.options.verbose:
@@ -677,6 +1610,24 @@ class GDAL2Mbtiles(object):
             print("Cache: %s MB" % (gdal.GetCacheMax() / 1024 / 1024))
             print('')
 
+    # -------------------------------------------------------------------------
+    def check_output_format(self, output_format):
+        """Returns (driver, extension) of tiles of the given output format, exits if it is not available"""
+
+        if output_format not in tile_formats:
+            self.error("Output formats allowed are PNG, PNG8, JPEG, WEBP and AUTO")
+
+        if output_format == 'WEBP':
+            try:
+                Image.init()
+                if 'WEBP' not in Image.SAVE:
+                    raise ImportError
+            except:
+                self.error("WEBP output format is not available.",
+                           "Install PIL/Pillow built with libwebp.")
+
+        return tile_formats[output_format]
+
     # -------------------------------------------------------------------------
     def optparse_init(self):
         """Prepare the option parser for input (argv)"""
@@ -688,6 +1639,13 @@ class GDAL2Mbtiles(object):
                          profile_list))
         p.add_option("-r", "--resampling", dest="resampling", type='choice', choices=resampling_list,
                      help="Resampling method (%s) - default 'average'" % ",".join(resampling_list))
+        p.add_option("--overview-resampling", dest="overview_resampling", type='choice',
+                     choices=overview_resampling_list,
+                     help="Resampling method for overview tiles (%s) - default the one of --resampling. "
+                          "Use 'mode' for land-cover and other categorical rasters" % ",".join(overview_resampling_list))
+        p.add_option('--gdal-warp', dest="gdal_warp", action="store_true",
+                     help="Reproject by the generic GDAL warper also EPSG:4326 input of the 'mercator' profile, "
+                          "which is otherwise reprojected by a faster separable transformation")
         p.add_option('-s', '--s_srs', dest="s_srs", metavar="SRS",
                      help="The spatial reference system used for the source input data")
         p.add_option('-z', '--zoom', dest="zoom",
@@ -698,6 +1656,59 @@ class GDAL2Mbtiles(object):
                      help="NODATA transparency value to assign to the input data")
         p.add_option('--processes', dest='processes', type='int', default=multiprocessing.cpu_count(),
                      help='Number of concurrent processes (defaults to the number of cores in the system)')
+        p.add_option('--overviews-only', dest='overviews_only', action='store_true',
+                     help="Build missing lower zoom levels of an existing .mbtiles given as the only argument "
+                          "from its highest zoom level (or the maximum of -z MIN-MAX, which must be present), without "
+                          "the input raster, in the format given by -f (e.g. AUTO) or else that of its tiles")
+        p.add_option('--threads', dest='threads', type='int',
+                     help="Number of threads of each process generating tiles with their own datasets, sharing "
+                          "the GDAL block cache and one writer of the process - default 1")
+        p.add_option('--memory-budget', dest='memory_budget', type='int', metavar='MB',
+                     help="Memory for tile generation in MB, split to the GDAL block cache and the number of "
+                          "processes, which is lowered when their RSS exceeds the budget or more of them do not "
+                          "increase the throughput (with the dynamic scheduler)")
+        p.add_option('--affinity', dest='affinity', type='choice', choices=affinity_list,
+                     help="Pinning of the processes (%s) - default 'none', 'core' each to one core, 'numa' "
+                          "to the cores of NUMA nodes in turn" % ",".join(affinity_list))
+        p.add_option('--scheduler', dest='scheduler', type='choice', choices=('static', 'dynamic'),
+                     help="Distribution of tiles to the processes: 'static' every processes-th tile, 'dynamic' "
+                          "chunks of neighbouring tiles taken by the processes as they finish - default 'dynamic'")
+        p.add_option('--engine', dest='engine', type='choice', choices=engine_list,
+                     help="Tiling engine (%s) - default 'native', 'gdal' renders by the MBTiles driver of GDAL "
+                          "and its overview building, for comparison" % ",".join(engine_list))
+        p.add_option('--recompress', dest='recompress', action='store_true',
+                     help="Re-encode the tiles of an existing .mbtiles given as input to the format of -f and the "
+                          "tile size of --tilesize (tiles are mosaicked or split, zoom levels shift accordingly), "
+                          "without the input raster")
+        p.add_option('--make-jobs', dest='make_jobs', type='int', metavar='N',
+                     help="Split the tiles to about N jobs of quadtree aligned tile ranges, write their manifest "
+                          "to OUTPUT.jobs.json and exit")
+        p.add_option('--job', dest='job', type='int', metavar='ID',
+                     help="Render the job ID of the manifest given as the only argument into a partial .mbtiles "
+                          "next to the manifest")
+        p.add_option('--merge', dest='merge', action='store_true',
+                     help="Merge the partial .mbtiles of the jobs of the manifest given as the only argument into "
+                          "its output and generate the zoom levels below the jobs")
+        p.add_option('--batch', dest='batch', metavar='JOBLIST',
+                     help="Tile the jobs of JOBLIST, a line '[options] input output' each, through one pool of "
+                          "processes; the options given on the command line apply to all jobs, the status of the "
+                          "jobs is written to JOBLIST.status.json")
+        p.add_option('--zoom-source', dest='zoom_sources', action='append', metavar='ZOOMS:INPUT',
+                     help="Render the zoom levels ZOOMS (e.g. 9-13) from INPUT instead of the input file, levels "
+                          "below up to the next zoom source are overviews of it (can be repeated)")
+        p.add_option('--bbox', dest='bbox', metavar='WEST,SOUTH,EAST,NORTH',
+                     help="Render only the tiles in the bounding box given in degrees, tiles on its boundary "
+                          "are masked")
+        p.add_option('--cutline', dest='cutline', metavar='FILE',
+                     help="Render only the tiles in the polygons of the first layer of the vector FILE, tiles on "
+                          "their boundary are masked")
+        p.add_option('--coverage', dest='coverage', action='store_true',
+                     help="Skip tiles without data by a coverage bitmap of the input mask read at low resolution, "
+                          "cached in OUTPUT.coverage.npz for reruns")
+        p.add_option('--update', dest='update', metavar='REGION',
+                     help="Re-render in the existing output only the tiles of the changed region, given as "
+                          "west,south,east,north in degrees or by the footprint of a raster file, and their "
+                          "ancestors in the lower zoom levels")
         p.add_option("-v", "--verbose",
                      action="store_true", dest="verbose",
                      help="Print status messages to stdout")
@@ -731,9 +1742,65 @@ class GDAL2Mbtiles(object):
         g.add_option("-x", "--auxfiles", dest='aux_files', action='store_true',
                      help="Generate aux.xml files.")
         g.add_option("-f", "--format", dest="output_format",
-                     help="Image format for output tiles. Just PNG and JPEG allowed. PNG is selected by default")
+                     help="Image format for output tiles. PNG, PNG8 (8-bit paletted PNG), JPEG, WEBP and AUTO "
+                          "(JPEG for opaque tiles, PNG for tiles with transparency, empty tiles skipped) allowed. "
+                          "PNG is selected by default")
+        g.add_option("--tilesize", dest="tilesize", type='int', metavar="PIXELS",
+                     help="Width and height of tiles, a power of two - default 256. With 512 the tiles of a zoom level "
+                          "cover the same area as 256 pixel tiles, with double resolution (@2x, high-DPI)")
         g.add_option("-o", "--output", dest="output_cache",
                      help="Format for output cache. Values allowed are tms and xyz, being xyz the default value")
+        g.add_option("--scratch", dest="scratch", metavar="DIR",
+                     help="Keep raw pixels of the last two zoom levels in memory-mapped files in DIR and build "
+                          "overview tiles from them instead of decoding stored tiles. Needs temporary disk space "
+                          "of up to tilesize*tilesize*4 bytes per tile of two levels")
+        g.add_option("--extra-output", dest="extra_outputs", action="append", metavar="FORMAT[,QUALITY],FILE",
+                     help="Write the tiles also to another .mbtiles FILE in FORMAT, optionally with its own QUALITY. "
+                          "Tiles are read and resampled once and encoded for each output, overview tiles are built "
+                          "from the main output (or --scratch), which must be given for lossless formats when the "
+                          "main output is lossy (JPEG, PNG8, AUTO or WEBP without --webp-lossless) and for other "
+                          "formats than JPEG when it is JPEG. Can be repeated")
+        p.add_option_group(g)
+
+        # Encoder options
+        g = OptionGroup(p, "Encoder options", "Options for encoding of the tile images")
+        g.add_option("--encoder-threads", dest="encoder_threads", type='int',
+                     help="Number of threads per process encoding tiles while the next ones are read - default 1, "
+                          "0 encodes in the reading thread")
+        g.add_option("--png-compress-level", dest="png_compress_level", type='int', metavar="LEVEL",
+                     help="zlib compression level of PNG tiles (0-9)")
+        g.add_option("--png-strategy", dest="png_strategy", type='choice', choices=png_strategy_list,
+                     help="zlib compression strategy of PNG tiles (%s)" % ",".join(png_strategy_list))
+        g.add_option("--quality", dest="quality", type='int',
+                     help="Quality of JPEG and lossy WEBP tiles (1-100)")
+        g.add_option("--jpeg-optimize", dest="jpeg_optimize", action="store_true",
+                     help="Optimize Huffman tables of JPEG tiles")
+        g.add_option("--jpeg-progressive", dest="jpeg_progressive", action="store_true",
+                     help="Write progressive JPEG tiles")
+        g.add_option("--png8-shared-palette", dest="png8_shared_palette", action="store_true",
+                     help="Quantize PNG8 tiles to one palette computed from the whole raster")
+        g.add_option("--png8-max-error", dest="png8_max_error", type='float', metavar="ERROR",
+                     help="Mean absolute error of band values up to which a tile is quantized to PNG8, "
+                          "tiles with bigger error are stored as truecolour PNG - default 3")
+        g.add_option("--webp-lossless", dest="webp_lossless", action="store_true",
+                     help="Write lossless WEBP tiles")
+        g.add_option("--webp-method", dest="webp_method", type='int', metavar="METHOD",
+                     help="Speed/size trade-off of WEBP encoder (0-6), 0 is the fastest - default 4")
+        p.add_option_group(g)
+
+        # Value scaling options
+        g = OptionGroup(p, "Value scaling options", "Options for mapping of 16-bit and float source values "
+                                                    "to the 8-bit tiles, used for all sources other than Byte")
+        g.add_option("--scale-range", dest="scale_range", metavar="MIN,MAX[,MIN,MAX...]",
+                     help="Source values mapped to 0 and 255, for all bands or per band - default the minimum "
+                          "and maximum of the source")
+        g.add_option("--percentile", dest="percentile", metavar="LOW,HIGH",
+                     help="Stretch between percentiles of the source values of each band, e.g. 2,98")
+        g.add_option("--gamma", dest="gamma", type='float',
+                     help="Gamma applied to the stretched values, greater than 1 brightens - default 1")
+        g.add_option("--color-ramp", dest="color_ramp", metavar="FILE",
+                     help="Colour the single band by the ramp in FILE, lines of 'value R G B [A]' as for gdaldem "
+                          "color-relief, values may be given in percents of the range")
         p.add_option_group(g)
 
         # TODO: MapFile + TileIndexes per zoom level for efficient MapServer WMS
@@ -745,7 +1812,10 @@ class GDAL2Mbtiles(object):
         p.set_defaults(verbose=False, profile="mercator", kml=False, url='',
                        webviewer='all', copyright='', resampling='average', resume=False,
                        googlekey='INSERT_YOUR_KEY_HERE', yahookey='INSERT_YOUR_YAHOO_APP_ID_HERE', aux_files=False,
-                       output_format="PNG", output_cache="xyz")
+                       output_format=None, output_cache="xyz", overviews_only=False, recompress=False, merge=False, engine='native',
+                       scheduler='dynamic', threads=1, affinity='none',
+                       gdal_warp=False, encoder_threads=1, jpeg_optimize=False, jpeg_progressive=False,
+                       webp_lossless=False, png8_shared_palette=False, png8_max_error=3.0, gamma=1.0)
 
         self.parser = p
 
@@ -758,13 +1828,10 @@ class GDAL2Mbtiles(object):
         if not self.options.verbose:
             gdal.PushErrorHandler('CPLQuietErrorHandler')
 
-        # Initialize necessary GDAL drivers
+        # Initialize necessary GDAL drivers (tiles are encoded by PIL)
 
-        self.out_drv = gdal.GetDriverByName(self.tiledriver)
         self.mem_drv = gdal.GetDriverByName('MEM')
 
-        if not self.out_drv:
-            raise Exception("The '%s' driver was not found, is it available in this GDAL build?", self.tiledriver)
         if not self.mem_drv:
             raise Exception("The 'MEM' driver was not found, is it available in this GDAL build?")
 
@@ -787,13 +1854,7 @@ class GDAL2Mbtiles(object):
         if self.in_ds.RasterCount == 0:
             self.error("Input file '%s' has no raster band" % self.input)
 
-        if self.in_ds.GetRasterBand(1).GetRasterColorTable():
-            # TODO: Process directly paletted dataset by generating VRT in memory
-            self.error("Please convert this file to RGB/RGBA and run GDAL2Mbtiles on the result.",
-                       """From paletted file you can create RGBA file (temp.vrt) by:
-           gdal_translate -of vrt -expand rgba %s temp.vrt
-           then run:
-           GDAL2Mbtiles temp.vrt""" % self.input)
+        # Paletted dataset: the index band is read and expanded to RGBA by the value scaler (init_scaler)
 
         # Get NODATA value
         self.in_nodata = []
@@ -853,6 +1914,18 @@ class GDAL2Mbtiles(object):
 
         self.out_ds = None
 
+        # Geographic (EPSG:4326) input of the 'mercator' profile is reprojected by the separable
+        # fastwarp_tile() directly from the input instead of the warped VRT
+        self.fastwarp = False
+        if self.options.profile == 'mercator' and self.in_srs and not self.options.gdal_warp and not self.sources \
+                and self.in_ds.GetGCPCount() == 0 and self.in_ds.GetGeoTransform()[2:5:2] == (0, 0):
+            srs4326 = osr.SpatialReference()
+            srs4326.ImportFromEPSG(4326)
+            self.fastwarp = srs4326.ExportToProj4() == self.in_srs.ExportToProj4()
+            self.fastwarp_rows_cache = {}
+            if self.fastwarp and self.options.verbose:
+                print("Separable EPSG:4326 -> EPSG:3857 reprojection, no warping by AutoCreateWarpedVRT")
+
         if self.options.profile in ('mercator', 'geodetic'):
 
             if (self.in_ds.GetGeoTransform() == (0.0, 1.0, 0.0, 0.0, 0.0, 1.0)) and (self.in_ds.GetGCPCount() == 0):
@@ -862,7 +1935,8 @@ class GDAL2Mbtiles(object):
 
             if self.in_srs:
 
-                if (self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4()) or (self.in_ds.GetGCPCount() != 0):
+                if not self.fastwarp and ((self.in_srs.ExportToProj4() != self.out_srs.ExportToProj4()) or
+                                          (self.in_ds.GetGCPCount() != 0)):
 
                     # Generation of VRT dataset in tile projection, default 'nearest neighbour' warping
                     self.out_ds = gdal.AutoCreateWarpedVRT(self.in_ds, self.in_srs_wkt, self.out_srs.ExportToWkt())
@@ -889,9 +1963,9 @@ class GDAL2Mbtiles(object):
                         # replace BandMapping tag for NODATA bands....
                         for i in range(len(self.in_nodata)):
                             s = s.replace("""<BandMapping src="%i" dst="%i"/>""" % ((i + 1), (i + 1)), """<BandMapping src="%i" dst="%i">
-          <SrcNoDataReal>%i</SrcNoDataReal>
+          <SrcNoDataReal>%.18g</SrcNoDataReal>
           <SrcNoDataImag>0</SrcNoDataImag>
-          <DstNoDataReal>%i</DstNoDataReal>
+          <DstNoDataReal>%.18g</DstNoDataReal>
           <DstNoDataImag>0</DstNoDataImag>
         </BandMapping>""" % (
                                 (i + 1), (i + 1), self.in_nodata[i],
@@ -906,8 +1980,7 @@ class GDAL2Mbtiles(object):
                         os.unlink(tempfilename)
 
                         # set NODATA_VALUE metadata
-                        self.out_ds.SetMetadataItem('NODATA_VALUES', '%i %i %i' % (
-                            self.in_nodata[0], self.in_nodata[1], self.in_nodata[2]))
+                        self.out_ds.SetMetadataItem('NODATA_VALUES', ' '.join('%.18g' % v for v in self.in_nodata))
 
                         if self.options.verbose:
                             print("Modified warping result saved into 'tiles1.vrt'")
@@ -969,6 +2042,8 @@ class GDAL2Mbtiles(object):
             self.dataBandsCount = self.out_ds.RasterCount - 1
         else:
             self.dataBandsCount = self.out_ds.RasterCount
+        self.srcBandsCount = self.dataBandsCount
+        self.init_scaler()
 
         # KML test
         self.isepsg4326 = False
@@ -1012,6 +2087,30 @@ class GDAL2Mbtiles(object):
         self.ominy = self.out_gt[3] - self.out_ds.RasterYSize * self.out_gt[1]
         # Note: maybe round(x, 14) to avoid the gdal_translate behaviour, when 0 becomes -1e-15
 
+        if self.fastwarp:
+            # The input is not warped: bounds are transformed to mercator meters corner by corner,
+            # the pixel size is the one along the longitude (equal everywhere in mercator)
+            self.in_gt = self.out_gt
+            mercator = GlobalMercator(self.tilesize)
+            self.ominx, self.ominy = mercator.LatLonToMeters(max(-85.05112878, self.ominy), self.ominx)
+            self.omaxx, self.omaxy = mercator.LatLonToMeters(min(85.05112878, self.omaxy), self.omaxx)
+            res = self.in_gt[1] * mercator.originShift / 180.0
+            self.out_gt = (self.ominx, res, 0.0, self.omaxy, 0.0, -res)
+
+        # Size of the raster in pixels along the longer side, for the minimal zoom level
+        self.rastersize = max(self.out_ds.RasterXSize, self.out_ds.RasterYSize)
+
+        if self.sources:
+            # Mosaic: union of the source footprints in the finest resolution of the sources,
+            # the first source gives the bands and the value scaling
+            self.open_mosaic()
+            footprints = self.source_index.boxes
+            self.ominx, self.ominy = min(b[0] for b in footprints), min(b[1] for b in footprints)
+            self.omaxx, self.omaxy = max(b[2] for b in footprints), max(b[3] for b in footprints)
+            res = min(b[4] for b in footprints)
+            self.out_gt = (self.ominx, res, 0.0, self.omaxy, 0.0, -res)
+            self.rastersize = max(self.omaxx - self.ominx, self.omaxy - self.ominy) / res
+
         if self.options.verbose:
             print("Bounds (output srs):", round(self.ominx, 13), self.ominy, self.omaxx, self.omaxy)
 
@@ -1021,7 +2120,7 @@ class GDAL2Mbtiles(object):
 
         if self.options.profile == 'mercator':
 
-            self.mercator = GlobalMercator()  # from globalmaptiles.py
+            self.mercator = GlobalMercator(self.tilesize)  # from globalmaptiles.py
 
             # Function which generates SWNE in LatLong for given tile
             self.tileswne = self.mercator.TileLatLonBounds
@@ -1041,7 +2140,7 @@ class GDAL2Mbtiles(object):
             # Get the minimal zoom level (map covers area equivalent to one tile)
             if self.tminz == None:
                 self.tminz = self.mercator.ZoomForPixelSize(
-                    self.out_gt[1] * max(self.out_ds.RasterXSize, self.out_ds.RasterYSize) / float(self.tilesize))
+                    self.out_gt[1] * self.rastersize / float(self.tilesize))
 
             # Get the maximal zoom level (closest possible zoom level up on the resolution of raster)
             if self.tmaxz == None:
@@ -1055,7 +2154,7 @@ class GDAL2Mbtiles(object):
 
         if self.options.profile == 'geodetic':
 
-            self.geodetic = GlobalGeodetic()  # from globalmaptiles.py
+            self.geodetic = GlobalGeodetic(self.tilesize)  # from globalmaptiles.py
 
             # Function which generates SWNE in LatLong for given tile
             self.tileswne = self.geodetic.TileLatLonBounds
@@ -1075,7 +2174,7 @@ class GDAL2Mbtiles(object):
             # Get the maximal zoom level (closest possible zoom level up on the resolution of raster)
             if self.tminz == None:
                 self.tminz = self.geodetic.ZoomForPixelSize(
-                    self.out_gt[1] * max(self.out_ds.RasterXSize, self.out_ds.RasterYSize) / float(self.tilesize))
+                    self.out_gt[1] * self.rastersize / float(self.tilesize))
 
             # Get the maximal zoom level (closest possible zoom level up on the resolution of raster)
             if self.tmaxz == None:
@@ -1134,6 +2233,712 @@ class GDAL2Mbtiles(object):
                 self.tileswne = rastertileswne
             else:
                 self.tileswne = lambda x, y, z: (0, 0, 0, 0)
+
+        self.extents = list(self.tminmax)
+        self.clip = None
+        if self.options.bbox or self.options.cutline:
+            self.open_clip()
+        if self.job is not None:
+            self.apply_job()
+        if self.options.update:
+            self.apply_update()
+        if self.options.coverage:
+            self.open_coverage()
+
+    # -------------------------------------------------------------------------
+    def open_clip(self):
+        """Clipping region of --bbox (in degrees) and --cutline (polygons of the first layer of a vector file,
+        in EPSG:4326 if the layer has no SRS) in the output SRS, the tile ranges are restricted to its extent"""
+
+        def transform(geometry, srs):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            out_srs = self.out_srs.Clone()
+            if hasattr(out_srs, 'SetAxisMappingStrategy'):
+                out_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            geometry.Transform(osr.CoordinateTransformation(srs, out_srs))
+            return geometry
+
+        srs4326 = osr.SpatialReference()
+        srs4326.ImportFromEPSG(4326)
+        geometry = None
+        if self.options.bbox:
+            try:
+                west, south, east, north = map(float, self.options.bbox.split(','))
+            except ValueError:
+                self.error("Bounding box must be given as west,south,east,north: %s" % self.options.bbox)
+            if self.options.profile == 'mercator':
+                south, north = max(-85.05112878, south), min(85.05112878, north)
+            geometry = ogr.CreateGeometryFromWkt('POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))' % (
+                west, south, east, south, east, north, west, north, west, south))
+            geometry = transform(geometry, srs4326)
+        if self.options.cutline:
+            source = ogr.Open(self.options.cutline)
+            if source is None:
+                self.error("The cutline '%s' can not be opened." % self.options.cutline)
+            layer = source.GetLayer(0)
+            cutline = ogr.Geometry(ogr.wkbMultiPolygon)
+            for feature in layer:
+                polygon = feature.GetGeometryRef()
+                if polygon is not None:
+                    cutline = cutline.Union(polygon)
+            cutline = transform(cutline, layer.GetSpatialRef() or srs4326)
+            geometry = cutline if geometry is None else geometry.Intersection(cutline)
+        if geometry is None or geometry.IsEmpty():
+            self.error("The clipping region is empty")
+
+        tilebounds = self.mercator.TileBounds if self.options.profile == 'mercator' else self.geodetic.TileBounds
+        self.clip = ClipRegion(geometry, self.out_srs, tilebounds)
+
+        minx, maxx, miny, maxy = geometry.GetEnvelope()
+        for tz in range(self.tminz, self.tmaxz + 1):
+            if self.options.profile == 'mercator':
+                cminx, cminy = self.mercator.MetersToTile(minx, miny, tz)
+                cmaxx, cmaxy = self.mercator.MetersToTile(maxx, maxy, tz)
+            else:
+                cminx, cminy = self.geodetic.LatLonToTile(minx, miny, tz)
+                cmaxx, cmaxy = self.geodetic.LatLonToTile(maxx, maxy, tz)
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            self.tminmax[tz] = (max(tminx, cminx), max(tminy, cminy), min(tmaxx, cmaxx), min(tmaxy, cmaxy))
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+        if tminx > tmaxx or tminy > tmaxy:
+            self.error("The clipping region does not intersect the input")
+
+    # -------------------------------------------------------------------------
+    def open_coverage(self):
+        """Coverage bitmaps of the zoom levels up to the coverage level: the highest one with at most
+        COVERAGE_TILES tiles along a side. Read from coveragefile if it was computed for the same input
+        and tile ranges, otherwise computed and saved there. Higher zoom levels are looked up by ancestors."""
+
+        inputs = self.sources or [self.input]
+        key = json.dumps([[(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in inputs],
+                          self.options.profile, self.tilesize, self.tminz, self.tmaxz,
+                          self.tminmax[self.tminz:self.tmaxz + 1]])
+        if os.path.exists(self.coveragefile):
+            try:
+                with numpy.load(self.coveragefile) as cached:
+                    if str(cached['key']) == key:
+                        self.coverage = dict((int(name[1:]), cached[name]) for name in cached.files if name != 'key')
+                        self.coverage_zoom = max(self.coverage)
+                        return
+            except (IOError, ValueError, KeyError):
+                pass
+
+        coverage = self.compute_coverage()
+        if coverage is None:
+            # Data everywhere, nothing to skip
+            return
+        self.coverage = coverage
+        self.coverage_zoom = max(coverage)
+        with open(self.coveragefile, 'wb') as f:
+            numpy.savez(f, key=numpy.array(key), **dict(('z%d' % z, a) for z, a in coverage.items()))
+
+    def compute_coverage(self):
+        """Computes the coverage bitmaps from the input mask read decimated (from overviews if present),
+        or from the footprints of the sources of a mosaic. A tile of the coverage level is covered if
+        any pixel of the mask in it or in its neighbours has data. Lower levels are OR-pooled 2x2.
+        Returns {zoom: bool array indexed [ty - tminy, tx - tminx]}, None if the input has no mask."""
+
+        cz = self.tminz
+        for tz in range(self.tminz, self.tmaxz + 1):
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            if max(tmaxx - tminx, tmaxy - tminy) + 1 <= COVERAGE_TILES:
+                cz = tz
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[cz]
+        tilebounds = self.mercator.TileBounds if self.options.profile == 'mercator' else self.geodetic.TileBounds
+        originx, originy, span = tilebounds(0, 0, cz)[0], tilebounds(0, 0, cz)[1], \
+            tilebounds(0, 0, cz)[2] - tilebounds(0, 0, cz)[0]
+        covered = numpy.zeros((tmaxy - tminy + 1, tmaxx - tminx + 1), numpy.bool_)
+
+        if self.sources:
+            for minx, miny, maxx, maxy, res in self.source_index.boxes:
+                x0, x1 = int((minx - originx) // span) - tminx, int((maxx - originx) // span) - tminx
+                y0, y1 = int((miny - originy) // span) - tminy, int((maxy - originy) // span) - tminy
+                covered[max(0, y0):max(0, y1 + 1), max(0, x0):max(0, x1 + 1)] = True
+        else:
+            if self.alphaband.GetMaskFlags() & gdal.GMF_ALL_VALID:
+                return None
+            ds = self.out_ds
+            gt = ds.GetGeoTransform()
+            bx = max(1, min(ds.RasterXSize, int(math.ceil(COVERAGE_SAMPLES * ds.RasterXSize * self.out_gt[1] / span))))
+            by = max(1, min(ds.RasterYSize, int(math.ceil(COVERAGE_SAMPLES * ds.RasterYSize * self.out_gt[1] / span))))
+            mask = numpy.frombuffer(self.alphaband.ReadRaster(0, 0, ds.RasterXSize, ds.RasterYSize, bx, by),
+                                    numpy.uint8).reshape(by, bx)
+            rows, cols = numpy.nonzero(mask)
+            x = gt[0] + (cols + 0.5) * (ds.RasterXSize / float(bx)) * gt[1]
+            y = gt[3] + (rows + 0.5) * (ds.RasterYSize / float(by)) * gt[5]
+            if self.fastwarp:
+                # Pixels of the geographic input to mercator meters
+                shift = self.mercator.originShift
+                x = x * shift / 180.0
+                y = numpy.log(numpy.tan((90 + numpy.clip(y, -85.05112878, 85.05112878)) * math.pi / 360.0)) * \
+                    shift / math.pi
+            tx = numpy.floor((x - originx) / span).astype(numpy.int64) - tminx
+            ty = numpy.floor((y - originy) / span).astype(numpy.int64) - tminy
+            inside = (tx >= 0) & (tx < covered.shape[1]) & (ty >= 0) & (ty < covered.shape[0])
+            covered[ty[inside], tx[inside]] = True
+
+        # Data between the samples: neighbours of the covered tiles are covered
+        dilated = covered.copy()
+        dilated[1:, :] |= covered[:-1, :]
+        dilated[:-1, :] |= covered[1:, :]
+        dilated[:, 1:] |= dilated[:, :-1].copy()
+        dilated[:, :-1] |= dilated[:, 1:].copy()
+        coverage = {cz: dilated}
+        for tz in range(cz - 1, self.tminz - 1, -1):
+            cminx, cminy = self.tminmax[tz + 1][:2]
+            pminx, pminy, pmaxx, pmaxy = self.tminmax[tz]
+            parent = numpy.zeros((pmaxy - pminy + 1, pmaxx - pminx + 1), numpy.bool_)
+            rows, cols = numpy.nonzero(coverage[tz + 1])
+            parent[((rows + cminy) >> 1) - pminy, ((cols + cminx) >> 1) - pminx] = True
+            coverage[tz] = parent
+        return coverage
+
+    def covered(self, tx, ty, tz):
+        "Whether the tile has data by the coverage bitmaps of --coverage, True without them"
+
+        if self.coverage is None:
+            return True
+        cz = self.coverage_zoom
+        if tz > cz:
+            tx, ty, tz = tx >> (tz - cz), ty >> (tz - cz), cz
+        tminx, tminy = self.tminmax[tz][:2]
+        bitmap = self.coverage[tz]
+        if not (0 <= ty - tminy < bitmap.shape[0] and 0 <= tx - tminx < bitmap.shape[1]):
+            return False
+        return bool(bitmap[ty - tminy, tx - tminx])
+
+    # -------------------------------------------------------------------------
+    def apply_update(self):
+        """Restricts the tile ranges to the tiles of the changed region of --update in the highest zoom level
+        and their ancestors. The region is given in degrees as west,south,east,north or by the footprint
+        of a raster file."""
+
+        try:
+            west, south, east, north = map(float, self.options.update.split(','))
+            if self.options.profile == 'mercator':
+                minx, miny = self.mercator.LatLonToMeters(max(-85.05112878, south), west)
+                maxx, maxy = self.mercator.LatLonToMeters(min(85.05112878, north), east)
+            else:
+                minx, miny, maxx, maxy = west, south, east, north
+        except ValueError:
+            if not os.path.exists(self.options.update):
+                self.error("Changed region must be given as west,south,east,north or by a raster file: %s" %
+                           self.options.update)
+            ds, alphaband = self.warp_source(self.options.update)
+            gt = ds.GetGeoTransform()
+            minx, maxy = gt[0], gt[3]
+            maxx, miny = gt[0] + ds.RasterXSize * gt[1], gt[3] + ds.RasterYSize * gt[5]
+
+        if self.options.profile == 'mercator':
+            ux0, uy0 = self.mercator.MetersToTile(minx, miny, self.tmaxz)
+            ux1, uy1 = self.mercator.MetersToTile(maxx, maxy, self.tmaxz)
+        else:
+            ux0, uy0 = self.geodetic.LatLonToTile(minx, miny, self.tmaxz)
+            ux1, uy1 = self.geodetic.LatLonToTile(maxx, maxy, self.tmaxz)
+        for tz in range(self.tmaxz, self.tminz - 1, -1):
+            d = self.tmaxz - tz
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            self.tminmax[tz] = (max(tminx, ux0 >> d), max(tminy, uy0 >> d),
+                                min(tmaxx, ux1 >> d), min(tmaxy, uy1 >> d))
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[self.tmaxz]
+        if tminx > tmaxx or tminy > tmaxy:
+            self.error("The changed region does not intersect the input")
+        if self.options.verbose:
+            print("Updated tiles:", self.tminmax[self.tmaxz])
+
+    # -------------------------------------------------------------------------
+    def zoom_stages(self):
+        """Returns (input arguments, minz, maxz) of the inputs rendering the zoom levels, from the highest:
+        the input file renders the levels above the zoom sources, every input renders its highest level
+        as base tiles and the levels down to the next zoom source as overviews"""
+
+        tops = [(min(maxz, self.tmaxz), [path]) for minz, maxz, path in self.zoom_sources
+                if minz <= self.tmaxz and maxz >= self.tminz]
+        if not tops or tops[0][0] < self.tmaxz:
+            tops.insert(0, (self.tmaxz, self.inputargs))
+        stages = []
+        for n, (maxz, args) in enumerate(tops):
+            minz = tops[n + 1][0] + 1 if n + 1 < len(tops) else self.tminz
+            stages.append((args, minz, maxz))
+        return stages
+
+    # -------------------------------------------------------------------------
+    def split_jobs(self, count):
+        """Splits the tiles to about count jobs, returns the job zoom level and the tile ranges of the jobs in it.
+        The job level is the lowest one with at least count tiles, so that every job renders whole subtrees
+        of the pyramid from it up and the overview tiles of a job depend only on its own tiles."""
+
+        jobz = self.tmaxz
+        for tz in range(self.tminz, self.tmaxz + 1):
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            if (tmaxx - tminx + 1) * (tmaxy - tminy + 1) >= count:
+                jobz = tz
+                break
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[jobz]
+        w, h = tmaxx - tminx + 1, tmaxy - tminy + 1
+        cols = max(1, min(w, int(round(math.sqrt(count * w / float(h))))))
+        rows = max(1, min(h, int(math.ceil(count / float(cols)))))
+        ranges = []
+        for r in range(rows):
+            y0, y1 = tminy + h * r // rows, tminy + h * (r + 1) // rows - 1
+            for c in range(cols):
+                x0, x1 = tminx + w * c // cols, tminx + w * (c + 1) // cols - 1
+                ranges.append((x0, y0, x1, y1))
+        return jobz, ranges
+
+    def apply_job(self):
+        """Restricts the tile ranges to the subtrees of the tiles of the job in the job zoom level"""
+
+        jobz = self.manifest['jobz']
+        x0, y0, x1, y1 = self.job['tiles']
+        for tz in range(jobz, self.tmaxz + 1):
+            d = tz - jobz
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+            self.tminmax[tz] = (max(tminx, x0 << d), max(tminy, y0 << d),
+                                min(tmaxx, ((x1 + 1) << d) - 1), min(tmaxy, ((y1 + 1) << d) - 1))
+        self.tminz = max(self.tminz, jobz)
+
+    # -------------------------------------------------------------------------
+    def init_scaler(self):
+        """Value scaler mapping the source values to 8-bit tile values, used for sources other than Byte
+        and with any of the value scaling options"""
+
+        o = self.options
+        colortable = self.in_ds.GetRasterBand(1).GetRasterColorTable()
+        if colortable:
+            if o.scale_range or o.percentile or o.gamma != 1.0 or o.color_ramp:
+                self.error("Value scaling options can not be used with a paletted input")
+            if self.srcBandsCount != 1:
+                self.error("Only paletted input with a single band is supported")
+            self.scaler = ValueScaler(None, lut=self.read_color_table(colortable))
+            self.dataBandsCount = 3
+            return
+
+        if self.out_ds.GetRasterBand(1).DataType == gdal.GDT_Byte and not (
+                o.scale_range or o.percentile or o.gamma != 1.0 or o.color_ramp):
+            return
+
+        ramp = None
+        if o.color_ramp:
+            if self.srcBandsCount != 1:
+                self.error("Colour ramp can be used only with a single band input")
+            ramp = self.read_color_ramp(o.color_ramp)
+            self.dataBandsCount = 3
+
+        if o.scale_range:
+            try:
+                ranges = list(map(float, o.scale_range.split(',')))
+            except ValueError:
+                self.error("Scale range must be given as MIN,MAX: %s" % o.scale_range)
+            if len(ranges) == 2:
+                ranges = ranges * self.srcBandsCount
+            if len(ranges) != 2 * self.srcBandsCount:
+                self.error("Scale range must be given once or for each of %d bands" % self.srcBandsCount)
+        elif ramp and not o.percentile and [value for value, percent, rgba in ramp if not percent]:
+            # Absolute values of the ramp define the range
+            values = [value for value, percent, rgba in ramp if not percent]
+            ranges = [min(values), max(values)]
+        elif os.path.exists(self.scalefile):
+            with open(self.scalefile) as f:
+                ranges = json.load(f)
+        else:
+            ranges = self.compute_scale_ranges()
+
+        self.scaler = ValueScaler(ranges, o.gamma, ramp)
+        if self.options.verbose:
+            print("Scale ranges:", self.scaler.ranges.tolist(), "gamma:", o.gamma)
+
+    def read_color_table(self, colortable):
+        """Lookup table of 256 RGBA entries from the colour table of the input, NODATA entry transparent"""
+
+        lut = numpy.zeros((256, 4), numpy.uint8)
+        gray = colortable.GetPaletteInterpretation() == gdal.GPI_Gray
+        for i in range(min(256, colortable.GetCount())):
+            entry = colortable.GetColorEntry(i)
+            lut[i] = (entry[0], entry[0], entry[0], 255) if gray else entry[:4]
+        for nodata in self.in_nodata[:1]:
+            if 0 <= nodata <= 255 and nodata == int(nodata):
+                lut[int(nodata), 3] = 0
+        return lut
+
+    def read_color_ramp(self, filename):
+        """Reads colour ramp in the format of gdaldem color-relief as list of (value, percent, (r, g, b, a))"""
+
+        ramp = []
+        try:
+            for line in open(filename):
+                fields = line.replace(',', ' ').replace(':', ' ').split()
+                if not fields or fields[0].startswith('#') or fields[0].lower() in ('nv', 'nodata'):
+                    continue
+                if len(fields) < 4:
+                    raise ValueError("colour expected as R G B [A]: %s" % line.strip())
+                percent = fields[0].endswith('%')
+                rgba = list(map(int, fields[1:5])) + [255]
+                ramp.append((float(fields[0].rstrip('%')), percent, rgba[:4]))
+        except (IOError, ValueError) as e:
+            self.error("Can not read colour ramp '%s': %s" % (filename, e))
+        if not ramp:
+            self.error("Colour ramp '%s' has no entries" % filename)
+        return ramp
+
+    def compute_scale_ranges(self):
+        """Approximate (min, max) or percentiles of --percentile of each band, from a decimated read
+        of the input (served from its overviews if there are any)"""
+
+        low, high = 0.0, 100.0
+        if self.options.percentile:
+            try:
+                low, high = map(float, self.options.percentile.split(','))
+            except ValueError:
+                self.error("Percentiles must be given as LOW,HIGH: %s" % self.options.percentile)
+
+        ds = self.in_ds
+        scale = max(1.0, max(ds.RasterXSize, ds.RasterYSize) / 1024.0)
+        w, h = max(1, int(ds.RasterXSize / scale)), max(1, int(ds.RasterYSize / scale))
+        ranges = []
+        for i in range(self.srcBandsCount):
+            band = ds.GetRasterBand(i + 1)
+            data = band.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize, w, h).astype(numpy.float64)
+            valid = (band.GetMaskBand().ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize, w, h) > 0) & \
+                numpy.isfinite(data)
+            if self.options.srcnodata:
+                valid &= data != self.in_nodata[i]
+            data = data[valid]
+            if not len(data):
+                ranges.extend([0.0, 255.0])
+                continue
+            lo, hi = numpy.percentile(data, [low, high])
+            ranges.extend([float(lo), float(hi) if hi > lo else float(lo) + 1.0])
+        return ranges
+
+    def save_scaling(self):
+        """Saves ranges of the value scaler for the tile generating processes"""
+
+        with open(self.scalefile, 'w') as f:
+            json.dump(self.scaler.ranges.ravel().tolist(), f)
+
+    def read_data(self, ds, rx, ry, rxsize, rysize, wxsize, wysize, alphaband=None):
+        """ReadRaster of the data bands and of the alpha band (of the input if not given), with values mapped
+        to 8-bit by the value scaler. Returns band sequential buffers (data, alpha)."""
+
+        alpha = (alphaband or self.alphaband).ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
+        if not self.scaler:
+            return ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
+                                 band_list=list(range(1, self.dataBandsCount + 1))), alpha
+
+        data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
+                             band_list=list(range(1, self.srcBandsCount + 1)), buf_type=gdal.GDT_Float32)
+        data = self.scaler.scale(numpy.frombuffer(data, numpy.float32).reshape(-1, wysize, wxsize))
+        if self.scaler.lut is not None:
+            # Transparency of the colour ramp or colour table
+            alpha = numpy.minimum(numpy.frombuffer(alpha, numpy.uint8).reshape(wysize, wxsize), data[3]).tobytes()
+            data = data[:3]
+        return data.tobytes(), alpha
+
+    # -------------------------------------------------------------------------
+    def open_mosaic(self):
+        """Spatial index of the sources of a mosaic: footprints and resolutions in the output SRS
+        are read from mosaicfile, or computed from the sources and saved there by the first call"""
+
+        if os.path.exists(self.mosaicfile):
+            with open(self.mosaicfile) as f:
+                footprints = json.load(f)
+        else:
+            footprints = []
+            for path in self.sources:
+                ds, alphaband = self.warp_source(path)
+                if ds.RasterCount < self.srcBandsCount:
+                    self.error("The input file '%s' has less bands than '%s'" % (path, self.input))
+                gt = ds.GetGeoTransform()
+                footprints.append((gt[0], gt[3] + ds.RasterYSize * gt[5], gt[0] + ds.RasterXSize * gt[1], gt[3],
+                                   gt[1]))
+            with open(self.mosaicfile, 'w') as f:
+                json.dump(footprints, f)
+        self.source_index = SourceIndex(footprints)
+
+    def warp_source(self, path):
+        """Opens a source of a mosaic in the output SRS (by a warped VRT with alpha if necessary),
+        returns the dataset and its alpha band"""
+
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if not ds:
+            self.error("It is not possible to open the input file '%s'." % path)
+        srs_wkt = self.in_srs_wkt if self.options.s_srs else ds.GetProjection()
+        if not srs_wkt:
+            self.error("Input file '%s' has unknown SRS." % path,
+                       "Use --s_srs ESPG:xyz (or similar) to provide source reference system.")
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(srs_wkt)
+        if srs.ExportToProj4() != self.out_srs.ExportToProj4() or ds.GetGCPCount() != 0:
+            has_alpha = ds.GetRasterBand(1).GetMaskBand().GetMaskFlags() & gdal.GMF_ALPHA or ds.RasterCount in (2, 4)
+            ds = gdal.Warp('', ds, format='VRT', srcSRS=srs_wkt, dstSRS=self.out_srs.ExportToWkt(),
+                           srcNodata=' '.join('%.18g' % v for v in self.in_nodata) if self.options.srcnodata else None,
+                           dstAlpha=not has_alpha)
+        return ds, ds.GetRasterBand(1).GetMaskBand()
+
+    def read_mosaic(self, b, querysize):
+        """Reads the query of the tile bounds b composited from the sources intersecting it, later sources
+        over the earlier ones by their alpha. Returns (data, alpha) as read_data(), None if there is no source."""
+
+        ids = self.source_index.query(b[0], b[1], b[2], b[3])
+        if not ids:
+            return None
+        data = numpy.zeros((self.dataBandsCount, querysize, querysize), numpy.float32)
+        alpha = numpy.zeros((querysize, querysize), numpy.float32)
+        for i in ids:
+            if i in self.source_datasets:
+                ds, alphaband = self.source_datasets.pop(i)
+            else:
+                ds, alphaband = self.warp_source(self.sources[i])
+            # The datasets of the recently used sources stay open
+            self.source_datasets[i] = ds, alphaband
+            while len(self.source_datasets) > MOSAIC_OPEN:
+                self.source_datasets.popitem(last=False)
+
+            rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
+            rx, ry, rxsize, rysize = rb
+            wx, wy, wxsize, wysize = wb
+            if min(rxsize, rysize, wxsize, wysize) <= 0:
+                continue
+            src, src_alpha = self.read_data(ds, rx, ry, rxsize, rysize, wxsize, wysize, alphaband)
+            src = numpy.frombuffer(src, numpy.uint8).reshape(-1, wysize, wxsize)
+            a = numpy.frombuffer(src_alpha, numpy.uint8).reshape(wysize, wxsize) / 255.0
+            window = (slice(wy, wy + wysize), slice(wx, wx + wxsize))
+            below = alpha[window] * (1 - a)
+            over = a + below
+            data[(slice(None),) + window] = (src * a + data[(slice(None),) + window] * below) / numpy.maximum(over, 1e-6)
+            alpha[window] = over
+        return numpy.rint(data).astype(numpy.uint8).tobytes(), numpy.rint(alpha * 255).astype(numpy.uint8).tobytes()
+
+    # -------------------------------------------------------------------------
+    def open_mbtiles(self):
+        """Initialization from an existing .mbtiles (--overviews-only) instead of the input raster.
+        The highest zoom level present is the base, its extent is taken from the tiles table.
+        The format of the tiles is taken from a base tile unless given by -f."""
+
+        gdal.AllRegister()
+        self.mem_drv = gdal.GetDriverByName('MEM')
+        if not self.mem_drv:
+            raise Exception("The 'MEM' driver was not found, is it available in this GDAL build?")
+
+        if not os.path.exists(self.output):
+            self.error("The file '%s' does not exist." % self.output)
+
+        con = sqlite3.connect(self.output, timeout=30)
+        cur = con.cursor()
+        extents = {}
+        for z, tminx, tminy, tmaxx, tmaxy in cur.execute("""SELECT zoom_level,
+                MIN(tile_column), MIN(tile_row), MAX(tile_column), MAX(tile_row)
+                FROM tiles GROUP BY zoom_level"""):
+            extents[z] = (tminx, tminy, tmaxx, tmaxy)
+        if not extents:
+            self.error("There are no tiles in '%s'." % self.output)
+
+        if self.tmaxz is None or '-' not in self.options.zoom:
+            # -z with one level gives the lowest one
+            self.tmaxz = max(extents)
+        elif self.tmaxz not in extents:
+            self.error("There are no tiles of the zoom level %d in '%s', its levels are %s." % (
+                self.tmaxz, self.output, ",".join(str(z) for z in sorted(extents))))
+        if self.tminz is None or self.tminz > self.tmaxz:
+            self.tminz = 0
+
+        # Parameters of the tiles are taken from a tile of the base zoom level
+        cur.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? LIMIT 1", (self.tmaxz,))
+        pil_tile = Image.open(io.BytesIO(cur.fetchone()[0]))
+        con.close()
+
+        self.tilesize = pil_tile.size[0]
+        if self.scratch:
+            self.scratch.tilesize = self.tilesize
+        self.dataBandsCount = 1 if pil_tile.mode in ('L', 'LA') else 3
+        if self.format_given:
+            # Kept as given, e.g. AUTO with tiles of both JPEG and PNG
+            pass
+        elif pil_tile.format == 'JPEG':
+            self.tiledriver = 'JPEG'
+            self.tileext = 'jpg'
+        elif pil_tile.format == 'WEBP':
+            self.tiledriver = 'WEBP'
+            self.tileext = 'webp'
+        else:
+            self.tiledriver = 'PNG'
+            self.tileext = 'png'
+
+        # Tile ranges of lower levels are covered by the parents of the tiles in the level below
+        self.tminmax = list(range(0, 32))
+        self.tminmax[self.tmaxz] = extents[self.tmaxz]
+        for tz in range(self.tmaxz - 1, -1, -1):
+            tminx, tminy, tmaxx, tmaxy = self.tminmax[tz + 1]
+            tminx, tminy, tmaxx, tmaxy = tminx >> 1, tminy >> 1, tmaxx >> 1, tmaxy >> 1
+            if tz in extents:
+                tminx, tminy = min(tminx, extents[tz][0]), min(tminy, extents[tz][1])
+                tmaxx, tmaxy = max(tmaxx, extents[tz][2]), max(tmaxy, extents[tz][3])
+            self.tminmax[tz] = (tminx, tminy, tmaxx, tmaxy)
+
+        # Only the missing tiles are generated
+        self.options.resume = True
+
+        if self.options.verbose:
+            print("Base zoom level:", self.tmaxz, self.tminmax[self.tmaxz])
+            print("MinZoomLevel:", self.tminz)
+
+    # -------------------------------------------------------------------------
+    def open_recompress(self):
+        """Initialization from the existing .mbtiles given as input to --recompress.
+        Tiles of another size than the source ones are mosaicked or split, self.retile is the zoom shift."""
+
+        if not os.path.exists(self.input):
+            self.error("The file '%s' does not exist." % self.input)
+
+        self.src_con = sqlite3.connect(self.input, timeout=30)
+        cur = self.src_con.cursor()
+        # tiles is a table or a view, e.g. over the map and images tables of deduplicated tiles
+        cur.execute("""SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = 'tiles'""")
+        if cur.fetchone() is None:
+            self.error("There is no tiles table or view in '%s'." % self.input)
+        cur.execute("""SELECT tile_data FROM tiles LIMIT 1""")
+        row = cur.fetchone()
+        if row is None:
+            self.error("There are no tiles in '%s'." % self.input)
+
+        pil_tile = Image.open(io.BytesIO(row[0]))
+        self.srctilesize = pil_tile.size[0]
+        self.tilesize = self.options.tilesize or self.srctilesize
+        self.retile = int(round(math.log(self.tilesize / float(self.srctilesize), 2)))
+        self.tilemode = 'LA' if pil_tile.mode in ('L', 'LA') else 'RGBA'
+        self.encoder = TileEncoder(self.tiledriver, self.options)
+
+    def recompress_units(self):
+        """Work units of --recompress: ranges of rows and columns of about RECOMPRESS_BATCH tiles of
+        a zoom level (tiles may be a view without rowid), or blocks of tiles of a row of the target tiles
+        when the source tiles are mosaicked"""
+
+        cur = self.src_con.cursor()
+        if self.retile <= 0:
+            units = []
+            rows = []  # Rows of the unit being collected as (zoom, row, tiles, min column, max column)
+
+            def flush():
+                if rows:
+                    units.append(('range', rows[0][0], rows[0][1], rows[-1][1],
+                                  min(row[3] for row in rows), max(row[4] for row in rows)))
+                    del rows[:]
+
+            for z, y, count, minx, maxx in cur.execute("""SELECT zoom_level, tile_row, COUNT(*),
+                    MIN(tile_column), MAX(tile_column) FROM tiles
+                    GROUP BY zoom_level, tile_row ORDER BY zoom_level, tile_row"""):
+                if rows and (rows[0][0] != z or sum(row[2] for row in rows) + count > RECOMPRESS_BATCH):
+                    flush()
+                if count > RECOMPRESS_BATCH:
+                    # Wide row split by columns
+                    units.extend(('range', z, y, y, x, min(maxx, x + RECOMPRESS_BATCH - 1))
+                                 for x in range(minx, maxx + 1, RECOMPRESS_BATCH))
+                else:
+                    rows.append((z, y, count, minx, maxx))
+            flush()
+            return units
+
+        k = self.retile
+        step = max(1, RECOMPRESS_BATCH // 4 ** k)
+        units = []
+        for z, ty, minx, maxx in cur.execute("""SELECT zoom_level, tile_row >> ?, MIN(tile_column) >> ?,
+                MAX(tile_column) >> ? FROM tiles WHERE zoom_level >= ?
+                GROUP BY zoom_level, tile_row >> ?""", (k, k, k, k, k)):
+            for tx in range(minx, maxx + 1, step):
+                units.append(('block', z, ty, tx, min(maxx, tx + step - 1)))
+        return units
+
+    def recompress_unit(self, unit):
+        """Decodes and re-encodes (mosaicked or split) the tiles of a work unit of --recompress.
+        Returns (tiles read, bytes read, list of (zoom, column, row, tile data))"""
+
+        cur = self.src_con.cursor()
+        k = self.retile
+        count, size, tiles = 0, 0, []
+
+        if unit[0] == 'range':
+            n = 2 ** -k
+            ts = self.tilesize
+            z, tminy, tmaxy, tminx, tmaxx = unit[1:]
+            for z, x, y, data in cur.execute("""SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles
+                    WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?""",
+                                             (z, tminx, tmaxx, tminy, tmaxy)):
+                count, size = count + 1, size + len(data)
+                tile_array = self.decode_tile(data)
+                # Tile split to n x n tiles of the zoom level -k levels deeper, rows from the bottom
+                for j in range(n):
+                    for i in range(n):
+                        tiles.append((z - k, x * n + i, y * n + j, self.encoder.encode(
+                            tile_array[(n - 1 - j) * ts:(n - j) * ts, i * ts:(i + 1) * ts])))
+            return count, size, tiles
+
+        # Tiles of n x n source tiles mosaicked to the zoom level k levels higher
+        z, ty, tminx, tmaxx = unit[1:]
+        n = 2 ** k
+        ts = self.srctilesize
+        blocks = {}
+        for x, y, data in cur.execute("""SELECT tile_column, tile_row, tile_data FROM tiles
+                WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?""",
+                                      (z, tminx * n, (tmaxx + 1) * n - 1, ty * n, (ty + 1) * n - 1)):
+            count, size = count + 1, size + len(data)
+            tx = x >> k
+            if tx not in blocks:
+                blocks[tx] = numpy.zeros((self.tilesize, self.tilesize, len(self.tilemode)), numpy.uint8)
+            posx = (x - tx * n) * ts
+            posy = ((ty + 1) * n - 1 - y) * ts
+            blocks[tx][posy:posy + ts, posx:posx + ts] = self.decode_tile(data)
+        for tx in sorted(blocks):
+            tiles.append((z - k, tx, ty, self.encoder.encode(blocks.pop(tx))))
+        return count, size, tiles
+
+    def decode_tile(self, data):
+        """Decodes tile data to numpy array of shape (tilesize, tilesize, bands) with alpha band"""
+
+        pil_tile = Image.open(io.BytesIO(data))
+        if pil_tile.mode != self.tilemode:
+            pil_tile = pil_tile.convert(self.tilemode)
+        return numpy.array(pil_tile)
+
+    def copy_metadata(self, cur):
+        """Copies metadata of the source .mbtiles of --recompress, with the new tile format and scale"""
+
+        for name, value in self.src_con.execute("""SELECT name, value FROM metadata"""):
+            if name == 'format':
+                value = self.tileext
+            elif name == 'scale':
+                value = "%g" % (self.tilesize / 256.0)
+            cur.execute("INSERT INTO metadata (name,value) values (?,?)", (name, value))
+
+    # -------------------------------------------------------------------------
+    def generate_palette(self):
+        """Quantizes a decimated read of the whole raster to the palette shared by PNG8 tiles (--png8-shared-palette).
+        The palette is saved to self.palettefile, its last entry is reserved for transparent pixels."""
+
+        ds = self.out_ds
+        scale = max(1.0, max(ds.RasterXSize, ds.RasterYSize) / 1024.0)
+        w, h = max(1, int(ds.RasterXSize / scale)), max(1, int(ds.RasterYSize / scale))
+        bands = self.dataBandsCount
+        data, alpha = self.read_data(ds, 0, 0, ds.RasterXSize, ds.RasterYSize, w, h)
+        data = numpy.frombuffer(data, numpy.uint8).reshape(bands, h * w).T
+        alpha = numpy.frombuffer(alpha, numpy.uint8)
+        data = data[alpha.reshape(h * w) > 0]
+        if not len(data):
+            data = numpy.zeros((1, bands), numpy.uint8)
+        if bands == 1:
+            data = data.repeat(3, axis=1)
+
+        # Opaque pixels in one row, quantized to 255 colours
+        img = Image.fromarray(numpy.ascontiguousarray(data[:, :3]).reshape(1, len(data), 3)).quantize(255)
+        palette = numpy.zeros((256, 3), numpy.uint8)
+        colours = numpy.array(img.getpalette()[:765], numpy.uint8).reshape(-1, 3)
+        palette[:len(colours)] = colours
+        palette[255] = palette[0]
+        img = Image.frombytes('P', (16, 16), bytes(bytearray(range(256))))
+        img.putpalette(palette.ravel().tolist())
+        img.save(self.palettefile, 'PNG')
+
     # -------------------------------------------------------------------------
     def generate_metadata(self, cur):
         """Generation of main metadata files and HTML viewers (metadata related to particular tiles are generated during the tile processing)."""
@@ -1240,7 +3045,74 @@ class GDAL2Mbtiles(object):
                     f.close()
 
     # -------------------------------------------------------------------------
-    def generate_base_tiles(self, cpu, queue, con):
+    def iter_tiles(self, tz, cpu, cursor=None):
+        """Yields (ti, tx, ty) of the tiles of zoom level tz generated by the process cpu.
+        Without cursor every (processes * threads)-th tile of rows from the top is taken. Otherwise tiles are ordered
+        in blocks of SCHEDULER_BLOCK x SCHEDULER_BLOCK tiles and claimed in chunks from the cursor
+        (multiprocessing.Value) shared by all processes, so that a process finishing its tiles early
+        takes the next ones. The chunk is sized by the measured time per tile, and to a fraction of
+        the remaining tiles, so that the processes finish together. Processes beyond the active ones
+        (self.active, --memory-budget) wait before taking tiles. The tiles of self.tile_list are
+        taken if given."""
+
+        if self.tile_list is not None:
+            # Work unit of --batch
+            for ti, (tx, ty) in enumerate(self.tile_list, 1):
+                yield ti, tx, ty
+            return
+
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+        workers = self.options.processes * self.options.threads
+        if cursor is None:
+            ti = 0
+            for ty in range(tmaxy, tminy - 1, -1):  # range(tminy, tmaxy+1):
+                for tx in range(tminx, tmaxx + 1):
+                    ti += 1
+                    if (ti - 1) % workers == cpu:
+                        yield ti, tx, ty
+            return
+
+        w, h = tmaxx - tminx + 1, tmaxy - tminy + 1
+        cost = None
+        while True:
+            # Paused by the ConcurrencyController of --memory-budget until resumed or all tiles taken
+            if self.active is not None and cpu // self.options.threads >= self.active.value \
+                    and cursor.value < w * h:
+                release_memory()
+                while cpu // self.options.threads >= self.active.value and cursor.value < w * h:
+                    time.sleep(0.1)
+                gdal.SetCacheMax(self.cachemax * 1024 * 1024)
+            with cursor.get_lock():
+                start = cursor.value
+                remaining = w * h - start
+                if remaining <= 0:
+                    return
+                chunk = SCHEDULER_CHUNK if cost is None else int(SCHEDULER_CHUNK_SECONDS / max(cost, 1e-6))
+                chunk = max(1, min(chunk, remaining // (2 * workers)))
+                cursor.value = start + chunk
+
+            started = time.time()
+            for tile in self.block_tiles(tz, start, start + chunk):
+                yield tile
+            spent = (time.time() - started) / chunk
+            cost = spent if cost is None else (cost + spent) / 2
+
+    def block_tiles(self, tz, start, stop):
+        """Yields (ti, tx, ty) of the tiles start to stop of zoom level tz ordered in blocks
+        of SCHEDULER_BLOCK x SCHEDULER_BLOCK tiles from the top"""
+
+        tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
+        w, h = tmaxx - tminx + 1, tmaxy - tminy + 1
+        b = SCHEDULER_BLOCK
+        for n in range(start, stop):
+            # Block row from the top, block in the row, tile in the block
+            r, i = divmod(n, b * w)
+            c, i = divmod(i, min(b, h - r * b) * b)
+            y, x = divmod(i, min(b, w - c * b))
+            yield n + 1, tminx + c * b + x, tmaxy - r * b - y
+
+    # -------------------------------------------------------------------------
+    def generate_base_tiles(self, cpu, queue, con, cursor=None):
         """Generation of the base tiles (the lowest in the pyramid) directly from the input raster"""
         cur = con.cursor()
         if self.options.verbose:
@@ -1274,151 +3146,175 @@ class GDAL2Mbtiles(object):
 
         queue.put(tcount)
 
-        ti = 0
         j = 0
         msg = ''
         tz = self.tmaxz
         count = (tmaxy - tminy + 1) * (tmaxx + 1 - tminx)
 
-        for ty in range(tmaxy, tminy - 1, -1):  # range(tminy, tmaxy+1):
-            for tx in range(tminx, tmaxx + 1):
-                if self.stopped:
-                    break
-                ti += 1
-                if (ti - 1) % self.options.processes != cpu:
-                    continue
+        if self.scratch:
+            self.scratch.open(tz, self.tminmax[tz], tilebands)
 
-                if self.options.output_cache == 'xyz':
-                    ty_final = (2 ** tz - 1) - ty
-                else:
-                    ty_final = ty
-                # my addons
-                tilefilename = os.path.join(self.output, str(tz), str(tx), "%s.%s" % (ty_final, self.tileext))
-                if os.path.exists(os.path.abspath(tilefilename)):
-                    # already exist
+        for ti, tx, ty in self.iter_tiles(tz, cpu, cursor):
+            if self.stopped:
+                break
+            if self.options.output_cache == 'xyz':
+                ty_final = (2 ** tz - 1) - ty
+            else:
+                ty_final = ty
+            # my addons
+            tilefilename = os.path.join(self.output, str(tz), str(tx), "%s.%s" % (ty_final, self.tileext))
+            if os.path.exists(os.path.abspath(tilefilename)):
+                # already exist
+                continue
+            if self.options.verbose:
+                print(ti, '/', tcount, tilefilename)  # , "( TileMapService: z / x / y )"
+
+            if self.options.resume:
+                cur.execute("""SELECT 1 FROM tiles WHERE zoom_level = ?
+                               AND tile_column = ? AND tile_row = ?""", (tz, tx, ty))
+                exists = cur.fetchone()
+                if exists is not None:
+                    if self.options.verbose:
+                        print("Tile generation skiped because of --resume")
+                    else:
+                        queue.put(tcount)
                     continue
-                if self.options.verbose:
-                    print(ti, '/', tcount, tilefilename)  # , "( TileMapService: z / x / y )"
 
-                if self.options.resume:
-                    cur.execute("""SELECT 1 FROM tiles WHERE zoom_level = ?
-                                   AND tile_column = ? AND tile_row = ?""", (tz, tx, ty))
-                    exists = cur.fetchone()
-                    if exists is not None:
-                        if self.options.verbose:
-                            print("Tile generation skiped because of --resume")
-                        else:
-                            queue.put(tcount)
-                        continue
+            # Tiles outside of --bbox/--cutline or without data by --coverage are not read at all,
+            # tiles on the boundary of the clipping region are masked
+            clip = self.clip.classify(tx, ty, tz) if self.clip else CLIP_INSIDE
+            if clip == CLIP_OUTSIDE or not self.covered(tx, ty, tz):
+                if not self.options.verbose:
+                    queue.put(tcount)
+                continue
+
+            if self.fastwarp:
+                # Separable reprojection of the geographic input, no generic warping
+                tile_array = self.fastwarp_tile(tx, ty, tz)
+                if clip == CLIP_BOUNDARY:
+                    tile_array = self.clip.mask(tile_array, tx, ty, tz)
+                self.write_tile(cur, tz, tx, ty, tile_array)
+                if not self.options.verbose:
+                    con.commit()
+                    queue.put(tcount)
+                continue
 
-                if self.options.profile == 'mercator':
-                    # Tile bounds in EPSG:900913
-                    b = self.mercator.TileBounds(tx, ty, tz)
-                elif self.options.profile == 'geodetic':
-                    b = self.geodetic.TileBounds(tx, ty, tz)
+            if self.options.profile == 'mercator':
+                # Tile bounds in EPSG:900913
+                b = self.mercator.TileBounds(tx, ty, tz)
+            elif self.options.profile == 'geodetic':
+                b = self.geodetic.TileBounds(tx, ty, tz)
 
-                # print "\tgdalwarp -ts 256 256 -te %s %s %s %s %s %s_%s_%s.tif" % ( b[0], b[1], b[2], b[3], "tiles.vrt", tz, tx, ty)
+            # print "\tgdalwarp -ts 256 256 -te %s %s %s %s %s %s_%s_%s.tif" % ( b[0], b[1], b[2], b[3], "tiles.vrt", tz, tx, ty)
 
-                # Don't scale up by nearest neighbour, better change the querysize
-                # to the native resolution (and return smaller query tile) for scaling
+            # Don't scale up by nearest neighbour, better change the querysize
+            # to the native resolution (and return smaller query tile) for scaling
 
-                if self.options.profile in ('mercator', 'geodetic'):
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
-                    nativesize = wb[0] + wb[2]  # Pixel size in the raster covering query geo extent
-                    if self.options.verbose:
-                        print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
-
-                    # Tile bounds in raster coordinates for ReadRaster query
-                    rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
-
-                    rx, ry, rxsize, rysize = rb
-                    wx, wy, wxsize, wysize = wb
-
-                else:  # 'raster' profile:
-
-                    tsize = int(self.tsize[tz])  # tilesize in raster coordinates for actual zoom
-                    xsize = self.out_ds.RasterXSize  # size of the raster in pixels
-                    ysize = self.out_ds.RasterYSize
-                    if tz >= self.nativezoom:
-                        querysize = self.tilesize  # int(2**(self.nativezoom-tz) * self.tilesize)
-
-                    rx = (tx) * tsize
-                    rxsize = 0
-                    if tx == tmaxx:
-                        rxsize = xsize % tsize
-                    if rxsize == 0:
-                        rxsize = tsize
-
-                    rysize = 0
-                    if ty == tmaxy:
-                        rysize = ysize % tsize
-                    if rysize == 0:
-                        rysize = tsize
-                    ry = ysize - (ty * tsize) - rysize
-
-                    wx, wy = 0, 0
-                    wxsize, wysize = int(rxsize / float(tsize) * self.tilesize), int(
-                        rysize / float(tsize) * self.tilesize)
-                    if wysize != self.tilesize:
-                        wy = self.tilesize - wysize
+            if self.sources:
+                # Mosaic: the query of the whole tile is composited from the sources
+                rx, ry, rxsize, rysize = 0, 0, 0, 0
+                wx, wy, wxsize, wysize = 0, 0, querysize, querysize
 
+            elif self.options.profile in ('mercator', 'geodetic'):
+                rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1])
+                nativesize = wb[0] + wb[2]  # Pixel size in the raster covering query geo extent
                 if self.options.verbose:
-                    print("\tReadRaster Extent: ", (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize))
+                    print("\tNative Extent (querysize", nativesize, "): ", rb, wb)
+
+                # Tile bounds in raster coordinates for ReadRaster query
+                rb, wb = self.geo_query(ds, b[0], b[3], b[2], b[1], querysize=querysize)
+
+                rx, ry, rxsize, rysize = rb
+                wx, wy, wxsize, wysize = wb
+
+            else:  # 'raster' profile:
+
+                tsize = int(self.tsize[tz])  # tilesize in raster coordinates for actual zoom
+                xsize = self.out_ds.RasterXSize  # size of the raster in pixels
+                ysize = self.out_ds.RasterYSize
+                if tz >= self.nativezoom:
+                    querysize = self.tilesize  # int(2**(self.nativezoom-tz) * self.tilesize)
+
+                rx = (tx) * tsize
+                rxsize = 0
+                if tx == tmaxx:
+                    rxsize = xsize % tsize
+                if rxsize == 0:
+                    rxsize = tsize
+
+                rysize = 0
+                if ty == tmaxy:
+                    rysize = ysize % tsize
+                if rysize == 0:
+                    rysize = tsize
+                ry = ysize - (ty * tsize) - rysize
+
+                wx, wy = 0, 0
+                wxsize, wysize = int(rxsize / float(tsize) * self.tilesize), int(
+                    rysize / float(tsize) * self.tilesize)
+                if wysize != self.tilesize:
+                    wy = self.tilesize - wysize
+
+            if self.options.verbose:
+                print("\tReadRaster Extent: ", (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize))
 
-                # Query is in 'nearest neighbour' but can be bigger in then the tilesize
-                # We scale down the query to the tilesize by supplied algorithm.
+            # Query is in 'nearest neighbour' but can be bigger in then the tilesize
+            # We scale down the query to the tilesize by supplied algorithm.
 
-                # Tile dataset in memory
-                dstile = self.mem_drv.Create('', self.tilesize, self.tilesize, tilebands)
-                # print 'dest', dstile
-                data = ds.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize,
-                                     band_list=list(range(1, self.dataBandsCount + 1)))
-                alpha = self.alphaband.ReadRaster(rx, ry, rxsize, rysize, wxsize, wysize)
-
-                if self.tilesize == querysize:
-                    # Use the ReadRaster result directly in tiles ('nearest neighbour' query)
-                    dstile.WriteRaster(wx, wy, wxsize, wysize, data, band_list=list(range(1, self.dataBandsCount + 1)))
-                    dstile.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
-
-                # Note: For source drivers based on WaveLet compression (JPEG2000, ECW, MrSID)
-                # the ReadRaster function returns high-quality raster (not ugly nearest neighbour)
-                # TODO: Use directly 'near' for WaveLet files
-                else:
-                    # Big ReadRaster query in memory scaled to the tilesize - all but 'near' algo
-                    dsquery = self.mem_drv.Create('', querysize, querysize, tilebands)
-                    # TODO: fill the null value in case a tile without alpha is produced (now only png tiles are supported)
-                    # for i in range(1, tilebands+1):
-                    #   dsquery.GetRasterBand(1).Fill(tilenodata)
-                    dsquery.WriteRaster(wx, wy, wxsize, wysize, data, band_list=list(range(1, self.dataBandsCount + 1)))
-                    dsquery.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
-
-                    self.scale_query_to_tile(dsquery, dstile, tilefilename)
-                    del dsquery
-
-                del data
-
-                if self.options.resampling != 'antialias':
-                    dstile_array = dstile.ReadAsArray()
-                    binary = io.BytesIO()
-                    img = Image.fromarray(numpy.rollaxis(dstile_array, 0, 3))  # rotate from (256,256,3) to (3,256,256)
-                    img.save(binary, format=self.tiledriver)
-
-                    cur.execute("""insert into tiles (zoom_level,
-                                            tile_column, tile_row, tile_data) values
-                                            (?, ?, ?, ?);""",
-                                (tz, tx, ty, sqlite3.Binary(binary.getvalue())))
-
-                    del img
-                    binary.flush()
-                    binary.close()
-                    del dstile_array
-                    del dstile
-                if not self.options.verbose:
-                    con.commit()
-                    queue.put(tcount)
+            if self.sources:
+                mosaic = self.read_mosaic(b, querysize)
+                if mosaic is None:
+                    # No source in the tile
+                    if not self.options.verbose:
+                        queue.put(tcount)
+                    continue
+                data, alpha = mosaic
+            else:
+                data, alpha = self.read_data(ds, rx, ry, rxsize, rysize, wxsize, wysize)
+
+            # Tile dataset in memory
+            dstile = self.mem_drv.Create('', self.tilesize, self.tilesize, tilebands)
+
+            if self.tilesize == querysize:
+                # Use the ReadRaster result directly in tiles ('nearest neighbour' query)
+                dstile.WriteRaster(wx, wy, wxsize, wysize, data, band_list=list(range(1, self.dataBandsCount + 1)))
+                dstile.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
+
+            # Note: For source drivers based on WaveLet compression (JPEG2000, ECW, MrSID)
+            # the ReadRaster function returns high-quality raster (not ugly nearest neighbour)
+            # TODO: Use directly 'near' for WaveLet files
+            else:
+                # Big ReadRaster query in memory scaled to the tilesize - all but 'near' algo
+                dsquery = self.mem_drv.Create('', querysize, querysize, tilebands)
+                # TODO: fill the null value in case a tile without alpha is produced (now only png tiles are supported)
+                # for i in range(1, tilebands+1):
+                #   dsquery.GetRasterBand(1).Fill(tilenodata)
+                dsquery.WriteRaster(wx, wy, wxsize, wysize, data, band_list=list(range(1, self.dataBandsCount + 1)))
+                dsquery.WriteRaster(wx, wy, wxsize, wysize, alpha, band_list=[tilebands])
+
+                self.scale_query_to_tile(dsquery, dstile, tilefilename)
+                del dsquery
+
+            del data
+
+            dstile_array = dstile.ReadAsArray()
+            tile_array = numpy.rollaxis(dstile_array, 0, 3)  # rotate from (3,256,256) to (256,256,3)
+            if clip == CLIP_BOUNDARY:
+                tile_array = self.clip.mask(tile_array, tx, ty, tz)
+            self.write_tile(cur, tz, tx, ty, tile_array)
+            del dstile_array
+            del dstile
+            if not self.options.verbose:
+                con.commit()
+                queue.put(tcount)
+
+        self.finish_tiles(cur)
+        con.commit()
+        if self.scratch:
+            self.scratch.close()
 
     # -------------------------------------------------------------------------
-    def generate_overview_tiles(self, cpu, tz, queue, con):
+    def generate_overview_tiles(self, cpu, tz, queue, con, cursor=None):
         """Generation of the overview tiles (higher in the pyramid) based on existing tiles"""
         cur = con.cursor()
         tilebands = self.dataBandsCount + 1
@@ -1430,112 +3326,205 @@ class GDAL2Mbtiles(object):
             tminx, tminy, tmaxx, tmaxy = self.tminmax[z]
             tcount += (1 + abs(tmaxx - tminx)) * (1 + abs(tmaxy - tminy))
 
-        ti = 0
-
         # querysize = tilesize * 2
 
         msg = ''
         tminx, tminy, tmaxx, tmaxy = self.tminmax[tz]
         count = (tmaxy - tminy + 1) * (tmaxx + 1 - tminx)
-        for ty in range(tmaxy, tminy - 1, -1):  # range(tminy, tmaxy+1):
-            for tx in range(tminx, tmaxx + 1):
-
-                if self.stopped:
-                    break
 
-                ti += 1
-                if (ti - 1) % self.options.processes != cpu:
-                    continue
+        if self.scratch:
+            self.scratch.open(tz + 1, self.tminmax[tz + 1], tilebands)
+            self.scratch.open(tz, self.tminmax[tz], tilebands)
 
-                if self.options.output_cache == 'xyz':
-                    ty_final = (2 ** tz - 1) - ty
-                else:
-                    ty_final = ty
+        for ti, tx, ty in self.iter_tiles(tz, cpu, cursor):
+            if self.stopped:
+                break
+            if self.options.output_cache == 'xyz':
+                ty_final = (2 ** tz - 1) - ty
+            else:
+                ty_final = ty
 
-                tilefilename = os.path.join(self.output, str(tz), str(tx), "%s.%s" % (ty_final, self.tileext))
+            tilefilename = os.path.join(self.output, str(tz), str(tx), "%s.%s" % (ty_final, self.tileext))
 
-                if self.options.verbose:
-                    print(ti, '/', tcount, tilefilename)  # , "( TileMapService: z / x / y )"
+            if self.options.verbose:
+                print(ti, '/', tcount, tilefilename)  # , "( TileMapService: z / x / y )"
 
-                if self.options.resume and os.path.exists(tilefilename):
+            if self.options.resume:
+                cur.execute("""SELECT 1 FROM tiles WHERE zoom_level = ?
+                               AND tile_column = ? AND tile_row = ?""", (tz, tx, ty))
+                if cur.fetchone() is not None:
                     if self.options.verbose:
                         print("Tile generation skipped because of --resume")
                     else:
                         queue.put(tcount)
                     continue
 
-                # TODO: improve that
-                if self.out_drv.ShortName == 'JPEG' and tilebands == 4:
-                    tilebands = 3
+            if self.clip and self.clip.classify(tx, ty, tz) == CLIP_OUTSIDE or not self.covered(tx, ty, tz):
+                if not self.options.verbose:
+                    queue.put(tcount)
+                continue
 
-                dsquery = self.mem_drv.Create('', 2 * self.tilesize, 2 * self.tilesize, tilebands)
-                # TODO: fill the null value
-                # for i in range(1, tilebands+1):
-                #   dsquery.GetRasterBand(1).Fill(tilenodata)
-                dstile = self.mem_drv.Create('', self.tilesize, self.tilesize, tilebands)
+            # TODO: improve that
+            if tilebands == 4 and self.tiledriver == 'JPEG' and \
+                    all(options.output_format == 'JPEG' for path, options in self.extra_outputs):
+                tilebands = 3
+
+            # Query window assembled from up to four underlying tiles
+            query = numpy.zeros((2 * self.tilesize, 2 * self.tilesize, tilebands), numpy.uint8)
+
+            # TODO: Implement more clever walking on the tiles with cache functionality
+            # probably walk should start with reading of four tiles from top left corner
+            # Hilbert curve...
+
+
+            # Read the tiles and write them to query window, children out of the tiles generated
+            # (those kept by --update) are read too
+            for y in range(2 * ty, 2 * ty + 2):
+                for x in range(2 * tx, 2 * tx + 2):
+                    minx, miny, maxx, maxy = (self.extents or self.tminmax)[tz + 1]
+                    if x >= minx and x <= maxx and y >= miny and y <= maxy:
+
+                        np_tile = self.read_tile(cur, tz + 1, x, y)
+                        if np_tile is None:
+                            continue
 
-                # TODO: Implement more clever walking on the tiles with cache functionality
-                # probably walk should start with reading of four tiles from top left corner
-                # Hilbert curve...
-
-
-                # Read the tiles and write them to query window
-                for y in range(2 * ty, 2 * ty + 2):
-                    for x in range(2 * tx, 2 * tx + 2):
-                        minx, miny, maxx, maxy = self.tminmax[tz + 1]
-                        if x >= minx and x <= maxx and y >= miny and y <= maxy:
-
-                            if self.options.output_cache == 'xyz':
-                                y_final = (2 ** (tz + 1) - 1) - y
-                            else:
-                                y_final = y
-
-                            tiles = cur.execute('''select  tile_data from tiles
-                                where zoom_level = (?) AND tile_column = (?) AND tile_row = (?) ;''', [tz + 1, x, y])
-                            blob_tile = tiles.fetchone()
-                            pil_tile = Image.open(io.BytesIO(blob_tile[0]))
-                            np_tile = numpy.array(pil_tile)
-
-                            if (ty == 0 and y == 1) or (ty != 0 and (y % (2 * ty)) != 0):
-                                tileposy = 0
-                            else:
-                                tileposy = self.tilesize
-                            if tx:
-                                tileposx = x % (2 * tx) * self.tilesize
-                            elif tx == 0 and x == 1:
-                                tileposx = self.tilesize
-                            else:
-                                tileposx = 0
-                                # Write Array each band of size (256L,256L)
-                            for i in range(tilebands):
-                                dsquery.GetRasterBand(i + 1).WriteArray(np_tile[:, :, i], tileposx, tileposy)
+                        # TMS rows are counted from the bottom, the upper tile goes first
+                        tileposx = (x - 2 * tx) * self.tilesize
+                        tileposy = (2 * ty + 1 - y) * self.tilesize
+                        query[tileposy:tileposy + self.tilesize, tileposx:tileposx + self.tilesize] = \
+                            np_tile[:, :, :tilebands]
 
+            if self.overview_kernel:
+                # Vectorized numpy kernel working on the 2x2 source pixels
+                tile_array = self.overview_kernel(overview_blocks(query), tilebands in (2, 4))
+            else:
+                dsquery = self.mem_drv.Create('', 2 * self.tilesize, 2 * self.tilesize, tilebands)
+                for i in range(tilebands):
+                    dsquery.GetRasterBand(i + 1).WriteArray(query[:, :, i])
+                dstile = self.mem_drv.Create('', self.tilesize, self.tilesize, tilebands)
                 self.scale_query_to_tile(dsquery, dstile, tilefilename)
-                # Write a copy of tile to png/jpg
-                #
-                if self.options.resampling != 'antialias':
-                    # Write a copy of tile to png/jpg
-                    dstile_array = dstile.ReadAsArray()
-                    binary = io.BytesIO()
-                    img = Image.fromarray(numpy.rollaxis(dstile_array, 0, 3))
-                    img.save(binary, format=self.tiledriver)
-                    cur.execute("""insert into tiles (zoom_level,
-                                                                tile_column, tile_row, tile_data) values
-                                                                (?, ?, ?, ?);""",
-                                (tz, tx, ty, sqlite3.Binary(binary.getvalue())))
-
-                    del binary
-                    del img
+                tile_array = numpy.rollaxis(dstile.ReadAsArray(), 0, 3)
+                del dsquery
                 del dstile
+            del query
 
-                if self.options.verbose:
-                    print("\tbuild from zoom", tz + 1, " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
-                          (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
+            # Write a copy of tile to png/jpg
+            self.write_tile(cur, tz, tx, ty, tile_array)
 
-                if not self.options.verbose:
-                    queue.put(tcount)
+            if self.options.verbose:
+                print("\tbuild from zoom", tz + 1, " tiles:", (2 * tx, 2 * ty), (2 * tx + 1, 2 * ty),
+                      (2 * tx, 2 * ty + 1), (2 * tx + 1, 2 * ty + 1))
+
+            if not self.options.verbose:
+                queue.put(tcount)
+                con.commit()
+                pass
+
+        self.finish_tiles(cur)
+        con.commit()
+        if self.scratch:
+            self.scratch.close()
+
+    # -------------------------------------------------------------------------
+    def write_tile(self, cur, tz, tx, ty, tile_array):
+        """Encodes tile pixels given as numpy array of shape (tilesize, tilesize, bands) and inserts
+        the tile into the MBTiles (and its pixels into the scratch store if used).
+        The tile is encoded and inserted also for each extra output.
+        With --encoder-threads the tile is encoded in background and inserted by a later call,
+        finish_tiles() has to be called at the end."""
+
+        if self.scratch:
+            self.scratch.write(tz, tx, ty, tile_array)
+        if self.encoder is None:
+            self.encoder = TileEncoder(self.tiledriver, self.options, self.palettefile)
+            self.extra_sinks = [(TileEncoder(tile_formats[options.output_format][0], options, self.palettefile),
+                                 path, None if self.writer else self.mbtiles_connect(path))
+                                for path, options in self.extra_outputs]
+        sinks = [(self.encoder, self.output, None)] + self.extra_sinks
+
+        if self.options.encoder_threads < 1:
+            for encoder, output, con in sinks:
+                self.store_tile(output, cur, con, tz, tx, ty, encoder.encode(tile_array))
+            return
+
+        if self.encode_pool is None:
+            self.encode_pool = multiprocessing.pool.ThreadPool(self.options.encoder_threads)
+        for encoder, output, con in sinks:
+            result = self.encode_pool.apply_async(encoder.encode, (tile_array,))
+            self.encoding.append((output, cur, con, tz, tx, ty, result))
+
+        # Insert the encoded tiles in order, wait only if too many tiles are pending
+        while self.encoding and (self.encoding[0][-1].ready() or
+                                 len(self.encoding) > 2 * self.options.encoder_threads * len(sinks)):
+            self.insert_encoded()
+
+    def insert_encoded(self):
+        """Inserts the oldest tile being encoded, waits for it if necessary"""
+
+        output, cur, con, tz, tx, ty, result = self.encoding.popleft()
+        self.store_tile(output, cur, con, tz, tx, ty, result.get())
+
+    def store_tile(self, output, cur, con, tz, tx, ty, tile_data):
+        """Inserts encoded tile into the output: by the cursor of the main output or the connection
+        of an extra output, or by the writer thread shared by the threads of the process (--threads)"""
+
+        if self.writer:
+            self.writer.put(output, tz, tx, ty, tile_data)
+        elif con:
+            self.insert_tile(con.cursor(), tz, tx, ty, tile_data)
+            con.commit()
+        else:
+            self.insert_tile(cur, tz, tx, ty, tile_data)
+
+    def finish_tiles(self, cur):
+        """Inserts all tiles still being encoded, closes extra outputs"""
+
+        while self.encoding:
+            self.insert_encoded()
+        if self.encode_pool is not None:
+            self.encode_pool.close()
+            self.encode_pool.join()
+            self.encode_pool = None
+        if self.encoder is not None:
+            for encoder, output, con in self.extra_sinks:
+                if con:
                     con.commit()
-                    pass
+                    con.close()
+            self.encoder = None
+
+    def insert_tile(self, cur, tz, tx, ty, tile_data):
+        if tile_data is None:
+            # Empty tile skipped by the encoder, the previous one is removed by --update
+            if self.options.update:
+                cur.execute("""DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+                            (tz, tx, ty))
+            return
+        cur.execute("""insert """ + ("""or replace """ if self.options.update else "") + """into tiles (zoom_level,
+                                tile_column, tile_row, tile_data) values
+                                (?, ?, ?, ?);""",
+                    (tz, tx, ty, sqlite3.Binary(tile_data)))
+
+    # -------------------------------------------------------------------------
+    def read_tile(self, cur, tz, tx, ty):
+        """Returns pixels of an already generated tile as numpy array of shape (tilesize, tilesize, bands),
+        from the raw scratch store if available, otherwise decoded from the MBTiles. None if there is no tile."""
+
+        if self.scratch:
+            np_tile = self.scratch.read(tz, tx, ty)
+            if np_tile is not None:
+                return np_tile
+
+        tiles = cur.execute('''select  tile_data from tiles
+            where zoom_level = (?) AND tile_column = (?) AND tile_row = (?) ;''', [tz, tx, ty])
+        blob_tile = tiles.fetchone()
+        if blob_tile is None:
+            return None
+        pil_tile = Image.open(io.BytesIO(blob_tile[0]))
+        mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[self.dataBandsCount + 1]
+        if pil_tile.mode != mode:
+            # JPEG tiles without alpha, paletted tiles from other tools, ...
+            pil_tile = pil_tile.convert(mode)
+        return numpy.array(pil_tile)
 
     # -------------------------------------------------------------------------
     def geo_query(self, ds, ulx, uly, lrx, lry, querysize=0):
@@ -1580,6 +3569,107 @@ class GDAL2Mbtiles(object):
 
         return (rx, ry, rxsize, rysize), (wx, wy, wxsize, wysize)
 
+    # -------------------------------------------------------------------------
+    def fastwarp_tile(self, tx, ty, tz):
+        """Renders tile of the 'mercator' profile directly from geographic (EPSG:4326) input.
+        Reprojection from EPSG:4326 to EPSG:3857 is separable: the source column of a tile pixel
+        depends only on its x (linear in longitude) and the source row only on its y (latitude
+        of the northing), so two index vectors replace the per pixel transformation of the warper.
+        Returns numpy array of shape (tilesize, tilesize, bands)."""
+
+        ts = self.tilesize
+        gt = self.in_gt
+        xsize, ysize = self.in_ds.RasterXSize, self.in_ds.RasterYSize
+        tilebands = self.dataBandsCount + 1
+        tile = numpy.zeros((ts, ts, tilebands), numpy.uint8)
+
+        # Source pixel coordinates of the centres of tile pixels
+        minx, miny, maxx, maxy = self.mercator.TileBounds(tx, ty, tz)
+        res = self.mercator.Resolution(tz)
+        lon = (minx + (numpy.arange(ts) + 0.5) * res) / self.mercator.originShift * 180.0
+        cols = (lon - gt[0]) / gt[1]
+        if (tz, ty) not in self.fastwarp_rows_cache:
+            if len(self.fastwarp_rows_cache) > 1024:
+                self.fastwarp_rows_cache.clear()
+            lat = (maxy - (numpy.arange(ts) + 0.5) * res) / self.mercator.originShift * 180.0
+            lat = 180 / math.pi * (2 * numpy.arctan(numpy.exp(lat * math.pi / 180.0)) - math.pi / 2.0)
+            self.fastwarp_rows_cache[(tz, ty)] = (lat - gt[3]) / gt[5]
+        rows = self.fastwarp_rows_cache[(tz, ty)]
+
+        validx = (cols >= 0) & (cols < xsize)
+        validy = (rows >= 0) & (rows < ysize)
+        if not validx.any() or not validy.any():
+            return tile
+
+        # Source window covering the tile (with a pixel margin for interpolation)
+        c0 = max(0, int(math.floor(cols[validx].min())) - 1)
+        c1 = min(xsize, int(math.ceil(cols[validx].max())) + 1)
+        r0 = max(0, int(math.floor(rows[validy].min())) - 1)
+        r1 = min(ysize, int(math.ceil(rows[validy].max())) + 1)
+
+        # Source pixels per tile pixel: bigger windows are reduced while reading by GDAL,
+        # so that the tile is sampled from a buffer of about its own resolution
+        stepx = abs(cols[-1] - cols[0]) / (ts - 1)
+        stepy = numpy.abs(numpy.diff(rows)).min()
+        bw = max(1, min(c1 - c0, int(math.ceil((c1 - c0) / max(stepx, 1.0)))))
+        bh = max(1, min(r1 - r0, int(math.ceil((r1 - r0) / max(stepy, 1.0)))))
+
+        resample_alg = {
+            'near': gdal.GRIORA_NearestNeighbour,
+            'bilinear': gdal.GRIORA_Bilinear,
+            'cubic': gdal.GRIORA_Cubic,
+            'cubicspline': gdal.GRIORA_CubicSpline,
+            'lanczos': gdal.GRIORA_Lanczos,
+        }.get(self.options.resampling, gdal.GRIORA_Average)
+        if self.scaler and self.scaler.ranges is None:
+            # Indices of the paletted input can not be averaged
+            resample_alg = gdal.GRIORA_NearestNeighbour
+
+        window = numpy.empty((self.srcBandsCount + 1, bh, bw), numpy.float32)
+        for i in range(self.srcBandsCount):
+            window[i] = self.in_ds.GetRasterBand(i + 1).ReadAsArray(c0, r0, c1 - c0, r1 - r0, bw, bh,
+                                                                    resample_alg=resample_alg)
+        if self.options.srcnodata:
+            # Pixels with NODATA in all bands are transparent (as UNIFIED_SRC_NODATA of the warper)
+            nodata = numpy.ones((bh, bw), bool)
+            for i in range(self.srcBandsCount):
+                nodata &= window[i] == self.in_nodata[i]
+            window[-1] = numpy.where(nodata, 0, 255)
+        else:
+            window[-1] = self.alphaband.ReadAsArray(c0, r0, c1 - c0, r1 - r0, bw, bh, resample_alg=resample_alg)
+
+        if self.scaler:
+            # 8-bit values (colours of the ramp or of the palette) are interpolated instead of the source values
+            data = self.scaler.scale(window[:-1])
+            if self.scaler.lut is not None:
+                window[-1] = numpy.minimum(window[-1], data[3])
+                data = data[:3]
+            window = numpy.concatenate((data, window[-1:])).astype(numpy.float32)
+
+        # Positions of tile pixels in the buffer
+        bx = (cols - c0) * (bw / float(c1 - c0))
+        by = (rows - r0) * (bh / float(r1 - r0))
+        if self.options.resampling == 'near':
+            x0 = x1 = numpy.clip(bx.astype(int), 0, bw - 1)
+            y0 = y1 = numpy.clip(by.astype(int), 0, bh - 1)
+            wx = numpy.zeros(ts, numpy.float32)
+            wy = numpy.zeros(ts, numpy.float32)
+        else:
+            # Separable linear interpolation between buffer pixel centres
+            bx, by = bx - 0.5, by - 0.5
+            x0, y0 = numpy.floor(bx).astype(int), numpy.floor(by).astype(int)
+            wx = numpy.clip(bx - x0, 0, 1).astype(numpy.float32)
+            wy = numpy.clip(by - y0, 0, 1).astype(numpy.float32)
+            x0, x1 = numpy.clip(x0, 0, bw - 1), numpy.clip(x0 + 1, 0, bw - 1)
+            y0, y1 = numpy.clip(y0, 0, bh - 1), numpy.clip(y0 + 1, 0, bh - 1)
+
+        window = window[:, y0, :] * (1 - wy)[None, :, None] + window[:, y1, :] * wy[None, :, None]
+        window = window[:, :, x0] * (1 - wx)[None, None, :] + window[:, :, x1] * wx[None, None, :]
+        window[-1] *= validy[:, None] & validx[None, :]
+
+        tile[:] = numpy.rollaxis(numpy.clip(window + 0.5, 0, 255), 0, 3)
+        return tile
+
     # -------------------------------------------------------------------------
     def scale_query_to_tile(self, dsquery, dstile, tilefilename=''):
         """Scales down query dataset to the tile dataset"""
@@ -1602,16 +3692,20 @@ class GDAL2Mbtiles(object):
 
         elif self.options.resampling == 'antialias':
 
-            # Scaling by PIL (Python Imaging Library) - improved Lanczos
-            array = numpy.zeros((querysize, querysize, tilebands), numpy.uint8)
-            for i in range(tilebands):
-                array[:, :, i] = gdalarray.BandReadAsArray(dsquery.GetRasterBand(i + 1), 0, 0, querysize, querysize)
-            im = Image.fromarray(array, 'RGBA')  # Always four bands
-            im1 = im.resize((tilesize, tilesize), Image.ANTIALIAS)
-            if os.path.exists(tilefilename):
-                im0 = Image.open(tilefilename)
-                im1 = Image.composite(im1, im0, im1)
-            im1.save(tilefilename, self.tiledriver)
+            # Scaling by PIL (Python Imaging Library) in memory - fast box reduce() by an integer factor
+            # down to twice the tilesize (Pillow 7 and later), followed by the improved Lanczos for the rest
+            mode = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[tilebands]
+            # Pixel interleaved buffer, as PIL expects it
+            data = dsquery.ReadRaster(0, 0, querysize, querysize, buf_pixel_space=tilebands,
+                                      buf_line_space=querysize * tilebands, buf_band_space=1)
+            im = Image.frombuffer(mode, (querysize, querysize), data, 'raw', mode, 0, 1)
+            factor = querysize // (2 * tilesize)
+            if factor > 1 and hasattr(im, 'reduce'):
+                im = im.reduce(factor)
+            if im.size != (tilesize, tilesize):
+                im = im.resize((tilesize, tilesize), Image.LANCZOS)
+            dstile.WriteRaster(0, 0, tilesize, tilesize, im.tobytes(), buf_pixel_space=tilebands,
+                               buf_line_space=tilesize * tilebands, buf_band_space=1)
 
         else:
 
@@ -1666,10 +3760,10 @@ class GDAL2Mbtiles(object):
                     args['publishurl'], z, (2 ** (self.nativezoom - z) * self.out_gt[1]), z)
             elif self.options.profile == 'mercator':
                 s += """        <TileSet href="%s%d" units-per-pixel="%.14f" order="%d"/>\n""" % (
-                    args['publishurl'], z, 156543.0339 / 2 ** z, z)
+                    args['publishurl'], z, self.mercator.Resolution(z), z)
             elif self.options.profile == 'geodetic':
                 s += """        <TileSet href="%s%d" units-per-pixel="%.14f" order="%d"/>\n""" % (
-                    args['publishurl'], z, 0.703125 / 2 ** z, z)
+                    args['publishurl'], z, self.geodetic.Resolution(z), z)
         s += """      </TileSets>
     </TileMap>
     """
@@ -2007,7 +4101,7 @@ class GDAL2Mbtiles(object):
                               mercator.fromPixelToLatLng( new GPoint( (tile.x+1)*256, (tile.y)*256 ) , zoom )
                           );
                           if (mapBounds.intersects(tileBounds)) {
-                              return zoom+"/"+tile.x+"/"+y+".png";
+                              return zoom+"/"+tile.x+"/"+y+".%(tileformat)s";
                           } else {
                               return "http://www.maptiler.org/img/none.png";
                           }
@@ -2229,6 +4323,7 @@ class GDAL2Mbtiles(object):
         args['maxzoom'] = self.tmaxz
         args['beginzoom'] = self.tmaxz
         args['tilesize'] = self.tilesize  # not used
+        args['scale'] = self.tilesize / 256.0
         args['tileformat'] = self.tileext
         args['publishurl'] = self.options.url  # not used
         args['copyright'] = self.options.copyright.replace('"', '\\"')
@@ -2262,7 +4357,7 @@ class GDAL2Mbtiles(object):
                     "minzoom": "%(minzoom)s",
                     "maxzoom": "%(maxzoom)s",
                     "bounds": "%(west)s,%(south)s,%(east)s,%(north)s",
-                    "scale": "1.000000",
+                    "scale": "%(scale)f",
                     "profile": "mercator"
               };
               tileserver(data);
@@ -2274,6 +4369,16 @@ class GDAL2Mbtiles(object):
 
         return s
 
+    # -------------------------------------------------------------------------
+    def generate_extra_metadata(self, cur, options):
+        """Fills metadata of an extra output, as of the main one but with the tile format of the extra output"""
+
+        if self.options.profile == 'mercator' and self.options.webviewer in ('all', 'metadata'):
+            metadata_dict = self.generate_metadatajson()
+            metadata_dict['format'] = tile_formats[options.output_format][1]
+            for n, v in metadata_dict.items():
+                cur.execute("INSERT INTO metadata (name,value) values (?,?)", (n, v))
+
     # -------------------------------------------------------------------------
     def generate_metadatajson(self):
         """
@@ -2306,7 +4411,7 @@ class GDAL2Mbtiles(object):
             "minzoom": args['minzoom'],
             "maxzoom": args['maxzoom'],
             "bounds": str(args['south']) + " " + str(args['west']) + " " + str(args['north']) + " " + str(args['east']),
-            "scale": "1",
+            "scale": "%g" % (self.tilesize / 256.0),
             "profile": "mercator"
         }
         return s
@@ -2420,7 +4525,7 @@ class GDAL2Mbtiles(object):
                 // create TMS Overlay layer
                 var tmsoverlay = new OpenLayers.Layer.TMS( "TMS Overlay", "",
                     {   // url: '', serviceVersion: '.', layername: '.',
-                        type: 'png', getURL: overlay_getTileURL, alpha: true,
+                        type: '%(tileformat)s', getURL: overlay_getTileURL, alpha: true,
                         isBaseLayer: false
                     });
                 if (OpenLayers.Util.alphaHack() == false) { tmsoverlay.setOpacity(0.7); }
@@ -2456,7 +4561,7 @@ class GDAL2Mbtiles(object):
                 var tmsoverlay = new OpenLayers.Layer.TMS( "TMS Overlay", "",
                     {
                         serviceVersion: '.', layername: '.', alpha: true,
-                        type: 'png', getURL: overlay_getTileURL,
+                        type: '%(tileformat)s', getURL: overlay_getTileURL,
                         isBaseLayer: false
                     });
                 map.addLayer(tmsoverlay);
@@ -2467,7 +4572,7 @@ class GDAL2Mbtiles(object):
                 switcherControl.maximizeControl();
 
                 map.zoomToExtent( mapBounds );
-            """
+            """ % args
 
         elif self.options.profile == 'raster':
             s += """
@@ -2481,7 +4586,7 @@ class GDAL2Mbtiles(object):
 
                 var layer = new OpenLayers.Layer.TMS( "TMS Layer","",
                     {  url: '', serviceVersion: '.', layername: '.', alpha: true,
-                        type: 'png', getURL: overlay_getTileURL
+                        type: '%(tileformat)s', getURL: overlay_getTileURL
                     });
                 map.addLayer(layer);
                 map.zoomToExtent( mapBounds );
@@ -2613,9 +4718,9 @@ class GDAL2Mbtiles(object):
     # -------------------------------------------------------
 
 
-    def mbtiles_connect(self):
+    def mbtiles_connect(self, output=None):
         try:
-            con = sqlite3.connect(self.output, timeout=30)
+            con = sqlite3.connect(output or self.output, timeout=30)
             self.optimize_connection(con.cursor())
             return con
         except Exception as e:
@@ -2637,10 +4742,18 @@ class GDAL2Mbtiles(object):
         integer, tile_row integer, key_name text, key_json text);""")
 
     def create_index(slef, cur):
-        cur.execute("""create unique index name on metadata (name);""")
-        cur.execute("""create unique index tile_index on tiles
+        cur.execute("""create unique index if not exists name on metadata (name);""")
+        cur.execute("""create unique index if not exists tile_index on tiles
             (zoom_level, tile_column, tile_row);""")
 
+    def update_zoom_metadata(self, cur):
+        """Sets minzoom and maxzoom in metadata to the zoom levels present in the tiles table"""
+
+        minzoom, maxzoom = cur.execute("""SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles""").fetchone()
+        for n, v in (('minzoom', minzoom), ('maxzoom', maxzoom)):
+            cur.execute("""DELETE FROM metadata WHERE name = ?""", (n,))
+            cur.execute("""INSERT INTO metadata (name,value) values (?,?)""", (n, v))
+
     def optimize_connection(self, cur):
         cur.execute("""PRAGMA synchronous=OFF;""")
         # cur.execute("""PRAGMA journal_mode=DELETE""")
@@ -2676,29 +4789,542 @@ class ProgressBar(QtCore.QObject):
 
 def worker_metadata(gdal2mbtiles):
     gdal2mbtiles.open_input()
+    if gdal2mbtiles.scaler and gdal2mbtiles.scaler.ranges is not None:
+        gdal2mbtiles.save_scaling()
+    if gdal2mbtiles.palettefile:
+        gdal2mbtiles.generate_palette()
     con = gdal2mbtiles.mbtiles_connect()
-    if not gdal2mbtiles.options.resume:
+    if not gdal2mbtiles.options.resume and not gdal2mbtiles.options.update:
         cur = con.cursor()
         gdal2mbtiles.mbtiles_setup(cur)
         gdal2mbtiles.generate_metadata(cur)
         con.commit()
+        for path, options in gdal2mbtiles.extra_outputs:
+            extra_con = gdal2mbtiles.mbtiles_connect(path)
+            cur = extra_con.cursor()
+            gdal2mbtiles.mbtiles_setup(cur)
+            gdal2mbtiles.generate_extra_metadata(cur, options)
+            extra_con.commit()
+            extra_con.close()
     con.close()
     sys.stdout.flush()
 
 
-def worker_base_tiles(argv, cpu, queue):
+def worker_threads(argv, cpu, generate, active=None):
+    """Runs generate(gdal2mbtiles, worker, con) in the process cpu. With --threads it runs in every thread
+    with its own GDAL2Mbtiles and so its own datasets (the GDAL block cache is shared by the process),
+    the tiles are inserted by one TileWriter. active is the number of active processes of --memory-budget."""
+
     gdal2mbtiles = GDAL2Mbtiles(argv[1:])
+    gdal2mbtiles.active = active
+    if gdal2mbtiles.cachemax:
+        gdal.SetCacheMax(gdal2mbtiles.cachemax * 1024 * 1024)
+    if gdal2mbtiles.options.affinity != 'none':
+        set_affinity(gdal2mbtiles.options.affinity, cpu)
+    threads = gdal2mbtiles.options.threads
+    if threads < 2:
+        con = gdal2mbtiles.mbtiles_connect()
+        generate(gdal2mbtiles, cpu, con)
+        con.close()
+        return
+
+    writer = TileWriter(gdal2mbtiles)
+
+    def run(worker):
+        instance = GDAL2Mbtiles(argv[1:])
+        instance.writer = writer
+        instance.active = active
+        con = instance.mbtiles_connect()
+        generate(instance, worker, con)
+        con.close()
+
+    workers = [threading.Thread(target=run, args=(cpu * threads + i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    writer.close()
+
+
+def worker_base_tiles(argv, cpu, queue, cursor=None, active=None):
+    def generate(gdal2mbtiles, worker, con):
+        gdal2mbtiles.open_input()
+        gdal2mbtiles.generate_base_tiles(worker, queue, con, cursor)
+
+    worker_threads(argv, cpu, generate, active)
+
+
+def worker_overview_tiles(argv, cpu, tz, queue, cursor=None, active=None):
+    def generate(gdal2mbtiles, worker, con):
+        if gdal2mbtiles.options.overviews_only:
+            gdal2mbtiles.open_mbtiles()
+        else:
+            gdal2mbtiles.open_input()
+        gdal2mbtiles.generate_overview_tiles(worker, tz, queue, con, cursor)
+
+    worker_threads(argv, cpu, generate, active)
+
+
+def gdal_engine(gdal2mbtiles, progress):
+    """Tiling by the MBTiles driver of GDAL (--engine=gdal): the input is warped to the resolution
+    of the base zoom level and copied to the .mbtiles, the lower levels are GDAL overviews.
+    Metadata and viewers are generated as by the native engine."""
+
+    if os.path.exists(gdal2mbtiles.scalefile):
+        os.unlink(gdal2mbtiles.scalefile)
     gdal2mbtiles.open_input()
+    options = gdal2mbtiles.options
+    tminz = gdal2mbtiles.tminz
+    tmaxz = gdal2mbtiles.tmaxz
+
+    def callback(overview):
+        def report(complete, message, data):
+            progress.progress_emiter(tmaxz, tminz, int(complete * 1000), 1000, overview=overview)
+            gdal2mbtiles.progressbar(complete)
+            sys.stdout.flush()
+            return 1
+        return report
+
+    resampling = {'near': 'near', 'bilinear': 'bilinear', 'cubic': 'cubic', 'cubicspline': 'cubicspline',
+                  'lanczos': 'lanczos', 'antialias': 'lanczos'}.get(options.resampling, 'average')
+    # 8-bit RGB(A) or gray source for the driver: paletted input expanded, other than Byte scaled
+    src = gdal2mbtiles.in_ds
+    scaler = gdal2mbtiles.scaler
+    if scaler and scaler.ranges is None:
+        src = gdal.Translate('', src, format='VRT', rgbExpand='rgba')
+    elif scaler:
+        src = gdal.Translate('', src, format='VRT', outputType=gdal.GDT_Byte,
+                             scaleParams=[[lo, hi, 0, 255] for lo, hi in scaler.ranges.tolist()],
+                             exponents=[1.0 / scaler.gamma] * len(scaler.ranges))
+    hasalpha = src.GetRasterBand(src.RasterCount).GetColorInterpretation() == gdal.GCI_AlphaBand
+
+    res = gdal2mbtiles.mercator.Resolution(tmaxz)
+    srcnodata = options.srcnodata.replace(',', ' ') if options.srcnodata else None
+    warped = gdal.Warp('', src, format='VRT', dstSRS='EPSG:3857', xRes=res, yRes=res, targetAlignedPixels=True,
+                       resampleAlg=resampling, srcNodata=srcnodata, dstAlpha=not hasalpha)
+
+    creation = ['TILE_FORMAT=%s' % options.output_format, 'NAME=%s' % options.title, 'TYPE=overlay']
+    if gdal2mbtiles.tilesize != 256:
+        creation.append('BLOCKSIZE=%d' % gdal2mbtiles.tilesize)
+    if options.quality is not None:
+        creation.append('QUALITY=%d' % options.quality)
+    if options.png_compress_level is not None:
+        creation.append('ZLEVEL=%d' % options.png_compress_level)
+
+    print("Generating Base Tiles:")
+    ds = gdal.Translate(gdal2mbtiles.output, warped, format='MBTiles', creationOptions=creation,
+                        callback=callback(False))
+    print("\n")
+    print("Generating Overview Tiles:")
+    if tmaxz > tminz:
+        overview_resampling = {'near': 'NEAREST', 'mode': 'MODE'}.get(options.overview_resampling,
+                                                                      resampling.upper())
+        ds.BuildOverviews(overview_resampling, [2 ** i for i in range(1, tmaxz - tminz + 1)],
+                          callback=callback(True))
+    ds = None
+    warped = None
+    src = None
+
+    # Metadata of the native engine replaces the one of the driver, entries it does not write
+    # (all of them without -w all|metadata) are kept from the driver
     con = gdal2mbtiles.mbtiles_connect()
-    gdal2mbtiles.generate_base_tiles(cpu, queue, con)
+    cur = con.cursor()
+    driver_metadata = cur.execute("""SELECT name, value FROM metadata""").fetchall()
+    cur.execute("""DELETE FROM metadata""")
+    gdal2mbtiles.generate_metadata(cur)
+    names = set(name for name, in cur.execute("""SELECT name FROM metadata"""))
+    cur.executemany("""INSERT INTO metadata (name, value) VALUES (?, ?)""",
+                    [(name, value) for name, value in driver_metadata if name not in names])
+    con.commit()
+    con.execute('''PRAGMA journal_mode=DELETE''')
     con.close()
 
 
-def worker_overview_tiles(argv, cpu, tz, queue):
-    gdal2mbtiles = GDAL2Mbtiles(argv[1:])
+recompressor = None
+
+
+def strip_option(args, name):
+    """Command line arguments without the option name and its value"""
+
+    stripped = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a == name:
+            skip = True
+        elif not a.startswith(name + '='):
+            stripped.append(a)
+    return stripped
+
+
+def absolute_option_paths(args):
+    """Command line arguments with the files of the options --cutline, --color-ramp and --scratch made absolute"""
+
+    names = ('--cutline', '--color-ramp', '--scratch')
+    result = []
+    name = None
+    for a in args:
+        if name:
+            result.append(os.path.abspath(a))
+            name = None
+        elif a in names:
+            result.append(a)
+            name = a
+        elif '=' in a and a.split('=', 1)[0] in names:
+            option, value = a.split('=', 1)
+            result.append(option + '=' + os.path.abspath(value))
+        else:
+            result.append(a)
+    return result
+
+
+def make_jobs(argv, gdal2mbtiles):
+    """Writes the manifest of the jobs of --make-jobs to OUTPUT.jobs.json. The manifest keeps the command line
+    with absolute paths and explicit zoom levels, so that the jobs can run anywhere the paths are valid."""
+
     gdal2mbtiles.open_input()
+    jobz, ranges = gdal2mbtiles.split_jobs(gdal2mbtiles.options.make_jobs)
+    output = os.path.abspath(gdal2mbtiles.output)
+    paths = dict((path, os.path.abspath(path)) for path in gdal2mbtiles.sources or [gdal2mbtiles.input])
+    paths[gdal2mbtiles.output] = output
+    paths.update((a, '@' + os.path.abspath(a[1:])) for a in argv[1:] if a.startswith('@') and os.path.exists(a[1:]))
+    args = []
+    options = []
+    for a in absolute_option_paths(strip_option(argv[1:], '--make-jobs')):
+        args.append(paths.get(a, a))
+        if a not in paths:
+            options.append(a)
+    zoom = ['-z', '%d-%d' % (gdal2mbtiles.tminz, gdal2mbtiles.tmaxz)]
+    base = os.path.splitext(output)[0]
+    manifest = {
+        'argv': zoom + args,
+        'options': zoom + options,
+        'output': output,
+        'tminz': gdal2mbtiles.tminz,
+        'tmaxz': gdal2mbtiles.tmaxz,
+        'jobz': jobz,
+        'jobs': [{'id': n, 'tiles': tiles, 'output': '%s.job%d.mbtiles' % (base, n)}
+                 for n, tiles in enumerate(ranges)]
+    }
+    manifestfile = output + '.jobs.json'
+    with open(manifestfile, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print("%d jobs of zoom levels %d-%d written to %s, run them by:" % (len(ranges), jobz, gdal2mbtiles.tmaxz,
+                                                                        manifestfile))
+    print("  %s --job=ID %s" % (argv[0], manifestfile))
+    print("and merge them by:")
+    print("  %s --merge %s" % (argv[0], manifestfile))
+
+
+def merge_jobs(argv, gdal2mbtiles, progress):
+    """Merges the partial outputs of the jobs of the manifest into its output and generates the zoom levels
+    below the job level from the merged tiles by --overviews-only"""
+
+    manifest = gdal2mbtiles.manifest
+    jobs = manifest['jobs']
+    missing = [str(job['id']) for job in jobs if not os.path.exists(job['output'])]
+    if missing:
+        gdal2mbtiles.error("Jobs %s are not finished" % ",".join(missing))
+    if os.path.exists(gdal2mbtiles.output):
+        os.unlink(gdal2mbtiles.output)
+
+    print("Merging %d jobs:" % len(jobs))
+    con = gdal2mbtiles.mbtiles_connect()
+    cur = con.cursor()
+    gdal2mbtiles.mbtiles_setup(cur)
+    gdal2mbtiles.create_index(cur)
+    con.commit()
+    for n, job in enumerate(jobs):
+        cur.execute("""ATTACH DATABASE ? AS job""", (job['output'],))
+        if n == 0:
+            cur.execute("""INSERT OR IGNORE INTO metadata (name, value) SELECT name, value FROM job.metadata""")
+        cur.execute("""INSERT OR IGNORE INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+            SELECT zoom_level, tile_column, tile_row, tile_data FROM job.tiles""")
+        con.commit()
+        cur.execute("""DETACH DATABASE job""")
+        gdal2mbtiles.progressbar((n + 1) / float(len(jobs)))
+    print("\n")
+
+    tminz, jobz = manifest['tminz'], manifest['jobz']
+    if jobz > tminz:
+        con.close()
+        extra = [a for a in argv[1:] if a not in ('--merge', gdal2mbtiles.manifestfile)]
+        main(progress, [argv[0]] + manifest['options'] + extra +
+             ['--overviews-only', '-z', '%d-%d' % (tminz, jobz), gdal2mbtiles.output])
+    else:
+        gdal2mbtiles.update_zoom_metadata(cur)
+        con.commit()
+        con.execute("""PRAGMA journal_mode=DELETE""")
+        con.close()
+
+
+class BatchProgress(object):
+    """Stands for the progress queue in the workers of --batch, the progress is counted by work units"""
+
+    def put(self, total):
+        pass
+
+
+def worker_batch_init():
+    global batch_open
+    batch_open = collections.OrderedDict()
+
+
+def worker_batch(unit):
+    """Runs a work unit of --batch: ('metadata', n, argv) or ('tiles', n, argv, tz, tiles).
+    Instances with the input of the last BATCH_OPEN jobs are kept open by the worker.
+    Returns (unit, result, error), result is the tile ranges of the job for 'metadata'
+    and the number of tiles for 'tiles', error the traceback if the unit failed."""
+
+    try:
+        kind, n, argv = unit[:3]
+        if kind == 'metadata':
+            gdal2mbtiles = GDAL2Mbtiles(argv[1:])
+            for path in (gdal2mbtiles.scalefile, gdal2mbtiles.mosaicfile):
+                if os.path.exists(path):
+                    os.unlink(path)
+            worker_metadata(gdal2mbtiles)
+            return unit, (gdal2mbtiles.tminz, gdal2mbtiles.tmaxz, list(gdal2mbtiles.tminmax)), None
+
+        tz, tiles = unit[3:]
+        entry = batch_open.pop(n, None)
+        if entry is None:
+            gdal2mbtiles = GDAL2Mbtiles(argv[1:])
+            gdal2mbtiles.open_input()
+            entry = (gdal2mbtiles, gdal2mbtiles.mbtiles_connect())
+        batch_open[n] = entry
+        while len(batch_open) > BATCH_OPEN:
+            batch_open.popitem(last=False)[1][1].close()
+        gdal2mbtiles, con = entry
+        gdal2mbtiles.tile_list = tiles
+        if tz == gdal2mbtiles.tmaxz:
+            gdal2mbtiles.generate_base_tiles(0, BatchProgress(), con)
+        else:
+            gdal2mbtiles.generate_overview_tiles(0, tz, BatchProgress(), con)
+        return unit, len(tiles), None
+    except KeyboardInterrupt:
+        raise
+    except BaseException:
+        # SystemExit of GDAL2Mbtiles.error() included, a failed unit must not stop the worker
+        return unit, None, traceback.format_exc()
+
+
+def batch(argv, gdal2mbtiles, progress):
+    """Tiles the jobs of --batch by one pool of processes. The work units of the jobs in progress,
+    the metadata and the tiles of a zoom level in blocks of BATCH_UNIT tiles, are interleaved
+    in the pool; the next zoom level of a job is scheduled when its previous level is finished."""
+
+    common = strip_option(argv[1:], '--batch')
+    jobs = []
+    with open(gdal2mbtiles.options.batch) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                jobs.append({'argv': [argv[0]] + common + shlex.split(line), 'status': 'pending',
+                             'tiles': 0, 'total': 0, 'error': None})
+
+    def finished(job, status, error=None):
+        job['status'] = status
+        job['error'] = error
+        job['seconds'] = time.time() - job.get('start', time.time())
+        job.pop('instance', None)
+        print("[%d/%d] %s: %s, %d tiles in %.1f s%s" % (
+            sum(1 for j in jobs if j['status'] in ('done', 'failed')), len(jobs),
+            job.get('output', ' '.join(job['argv'][1:])), status, job['tiles'], job['seconds'],
+            '' if error is None else '\n' + error.strip().splitlines()[-1]))
+        report(job)
+
+    def report(job):
+        """Emits the progress of all jobs, finished ones complete and the running ones by their tiles,
+        and prints the progress of the job in steps of 10 %"""
+
+        complete = sum(1.0 if j['status'] in ('done', 'failed') else j['tiles'] / float(j['total'] or 1)
+                       for j in jobs) / len(jobs)
+        progress.progress_emiter(0, 0, int(complete * 1000), 1000)
+        if job['status'] == 'running' and job['total']:
+            percent = 100 * job['tiles'] // job['total'] // 10 * 10
+            if job.get('reported', 0) < percent < 100:
+                job['reported'] = percent
+                print("  %s: %d%%, %d of %d tiles" % (job['output'], percent, job['tiles'], job['total']))
+        sys.stdout.flush()
+
+    def schedule(n, tz):
+        job = jobs[n]
+        job['level'] = tz
+        instance = job['instance']
+        tminx, tminy, tmaxx, tmaxy = instance.tminmax[tz]
+        count = (tmaxx - tminx + 1) * (tmaxy - tminy + 1)
+        job['pending'] = 0
+        for start in range(0, count, BATCH_UNIT):
+            tiles = [(tx, ty) for ti, tx, ty in instance.block_tiles(tz, start, min(start + BATCH_UNIT, count))]
+            ready.append(('tiles', n, job['argv'], tz, tiles))
+            job['pending'] += 1
+
+    def complete(job):
+        instance = job['instance']
+        con = instance.mbtiles_connect()
+        if not instance.options.resume:
+            instance.create_index(con.cursor())
+        con.execute('''PRAGMA journal_mode=DELETE''')
+        con.close()
+        for path, options in instance.extra_outputs:
+            con = instance.mbtiles_connect(path)
+            if not instance.options.resume:
+                instance.create_index(con.cursor())
+            con.execute('''PRAGMA journal_mode=DELETE''')
+            con.close()
+        for path in (instance.palettefile, instance.scalefile, instance.mosaicfile):
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+    processes = gdal2mbtiles.options.processes
+    pool = multiprocessing.Pool(processes, worker_batch_init)
+    done = Queue()
+    ready = collections.deque()
+    next_job = 0
+    active = 0
+    in_flight = 0
+    while True:
+        while active < BATCH_ACTIVE * processes and next_job < len(jobs):
+            n, job = next_job, jobs[next_job]
+            next_job += 1
+            job['start'] = time.time()
+            try:
+                instance = GDAL2Mbtiles(job['argv'][1:])
+            except SystemExit:
+                finished(job, 'failed', "Invalid options: %s" % ' '.join(job['argv'][1:]))
+                continue
+            job['instance'] = instance
+            job['input'], job['output'] = instance.input, instance.output
+            if instance.options.batch or instance.options.overviews_only or instance.options.recompress or \
+                    instance.options.scratch or instance.options.engine != 'native' or instance.manifest or \
+                    instance.options.make_jobs or instance.zoom_sources:
+                finished(job, 'failed', "Options of the job are not supported in batch")
+                continue
+            ready.append(('metadata', n, job['argv']))
+            active += 1
+        while ready and in_flight < 2 * processes:
+            pool.apply_async(worker_batch, (ready.popleft(),), callback=done.put)
+            in_flight += 1
+        if not in_flight:
+            break
+
+        unit, result, error = done.get()
+        in_flight -= 1
+        n = unit[1]
+        job = jobs[n]
+        if job['status'] == 'failed':
+            continue
+        if error is not None:
+            ready = collections.deque(u for u in ready if u[1] != n)
+            active -= 1
+            finished(job, 'failed', error)
+            continue
+        job['status'] = 'running'
+        instance = job['instance']
+        if unit[0] == 'metadata':
+            instance.tminz, instance.tmaxz, instance.tminmax = result
+            job['total'] = sum((tmaxx - tminx + 1) * (tmaxy - tminy + 1) for tminx, tminy, tmaxx, tmaxy
+                               in instance.tminmax[instance.tminz:instance.tmaxz + 1])
+            schedule(n, instance.tmaxz)
+            continue
+        job['tiles'] += result
+        job['pending'] -= 1
+        report(job)
+        if job['pending']:
+            continue
+        if job['level'] > instance.tminz:
+            schedule(n, job['level'] - 1)
+            continue
+        active -= 1
+        try:
+            complete(job)
+            finished(job, 'done')
+        except Exception:
+            finished(job, 'failed', traceback.format_exc())
+    pool.close()
+    pool.join()
+
+    statusfile = gdal2mbtiles.options.batch + '.status.json'
+    with open(statusfile, 'w') as f:
+        json.dump([dict((k, job.get(k)) for k in ('input', 'output', 'status', 'tiles', 'total', 'seconds', 'error'))
+                   for job in jobs], f, indent=1)
+    failed = sum(1 for job in jobs if job['status'] != 'done')
+    print("%d jobs done, %d failed, status written to %s" % (len(jobs) - failed, failed, statusfile))
+
+
+def zoom_stages(argv, gdal2mbtiles, progress):
+    """Renders the zoom levels of --zoom-source: each input in its turn by the native pipeline into
+    the same output, with its own input preparation, scaling and base tiles in its highest zoom level"""
+
+    inputs = set(gdal2mbtiles.inputargs + [gdal2mbtiles.output])
+    options = [a for a in strip_option(argv[1:], '--zoom-source') if a not in inputs]
+    for n, (args, minz, maxz) in enumerate(gdal2mbtiles.zoom_stages()):
+        print("Zoom levels %d-%d from %s:" % (minz, maxz, " ".join(args)))
+        # The tiles of the previous stages are kept by --resume
+        main(progress, [argv[0]] + options + (['--resume'] if n else []) + ['-z', '%d-%d' % (minz, maxz)] +
+             args + [gdal2mbtiles.output])
+
+    con = gdal2mbtiles.mbtiles_connect()
+    gdal2mbtiles.update_zoom_metadata(con.cursor())
+    con.commit()
+    con.close()
+
+
+def worker_recompress_init(argv):
+    global recompressor
+    recompressor = GDAL2Mbtiles(argv[1:])
+    recompressor.open_recompress()
+
+
+def worker_recompress(unit):
+    return recompressor.recompress_unit(unit)
+
+
+def recompress(argv, gdal2mbtiles, progress):
+    """Recompress (and retile) of an existing .mbtiles: work units are decoded and encoded
+    by a pool of processes, the encoded tiles are written in bulk by this process"""
+
+    gdal2mbtiles.open_recompress()
+    units = gdal2mbtiles.recompress_units()
     con = gdal2mbtiles.mbtiles_connect()
-    gdal2mbtiles.generate_overview_tiles(cpu, tz, queue, con)
+    cur = con.cursor()
+    gdal2mbtiles.mbtiles_setup(cur)
+    gdal2mbtiles.copy_metadata(cur)
+    con.commit()
+
+    print("Recompressing Tiles:")
+    pool = multiprocessing.Pool(gdal2mbtiles.options.processes, worker_recompress_init, (argv,))
+    start = time.time()
+    tiles_in = tiles_out = bytes_in = bytes_out = 0
+    for done, (count, size, tiles) in enumerate(pool.imap_unordered(worker_recompress, units), 1):
+        tiles = [(z, x, y, sqlite3.Binary(data)) for z, x, y, data in tiles if data is not None]
+        cur.executemany("""insert into tiles (zoom_level,
+                                tile_column, tile_row, tile_data) values
+                                (?, ?, ?, ?);""", tiles)
+        con.commit()
+        tiles_in, bytes_in = tiles_in + count, bytes_in + size
+        tiles_out, bytes_out = tiles_out + len(tiles), bytes_out + sum(len(tile[3]) for tile in tiles)
+        progress.progress_emiter(0, 0, done, len(units))
+        gdal2mbtiles.progressbar(done / float(len(units)))
+        if gdal2mbtiles.options.verbose:
+            elapsed = max(time.time() - start, 1e-6)
+            print("%d tiles read (%.1f MB), %d written (%.1f MB), %.0f tiles/s" % (
+                tiles_in, bytes_in / 1048576.0, tiles_out, bytes_out / 1048576.0, tiles_in / elapsed))
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+    elapsed = max(time.time() - start, 1e-6)
+    print("\nRecompressed %d tiles (%.1f MB) to %d tiles (%.1f MB): %.0f tiles/s, %.1f MB/s read" % (
+        tiles_in, bytes_in / 1048576.0, tiles_out, bytes_out / 1048576.0,
+        tiles_in / elapsed, bytes_in / 1048576.0 / elapsed))
+
+    print('Indexing tiles')
+    gdal2mbtiles.update_zoom_metadata(cur)
+    gdal2mbtiles.create_index(cur)
+    con.commit()
+    con.execute('''PRAGMA journal_mode=DELETE''')
     con.close()
 
 
@@ -2726,37 +5352,91 @@ def main(progress,argv = None):
         gdal.SetConfigOption("GDAL_PAM_ENABLED", "YES")
     else:
         gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
-    p = multiprocessing.Process(target=worker_metadata, args=[gdal2mbtiles])
-    p.start()
-    p.join()
-    print("Generating Base Tiles:")
+    if gdal2mbtiles.options.batch:
+        batch(argv, gdal2mbtiles, progress)
+        return
+    if gdal2mbtiles.options.recompress:
+        recompress(argv, gdal2mbtiles, progress)
+        return
+    if gdal2mbtiles.options.engine == 'gdal':
+        gdal_engine(gdal2mbtiles, progress)
+        return
+    if gdal2mbtiles.zoom_sources:
+        zoom_stages(argv, gdal2mbtiles, progress)
+        return
+    if gdal2mbtiles.options.make_jobs is not None:
+        make_jobs(argv, gdal2mbtiles)
+        return
+    if gdal2mbtiles.options.merge:
+        merge_jobs(argv, gdal2mbtiles, progress)
+        return
+    if gdal2mbtiles.options.update and not os.path.exists(gdal2mbtiles.output):
+        gdal2mbtiles.error("The updated file '%s' does not exist." % gdal2mbtiles.output)
+    if gdal2mbtiles.job is not None and not gdal2mbtiles.options.resume and os.path.exists(gdal2mbtiles.output):
+        # Leftover of an interrupted run of the job
+        os.unlink(gdal2mbtiles.output)
+    if gdal2mbtiles.options.overviews_only:
+        # Zoom range and extents are detected from the existing tiles
+        gdal2mbtiles.open_mbtiles()
+    else:
+        for path in (gdal2mbtiles.scalefile, gdal2mbtiles.mosaicfile):
+            if os.path.exists(path):
+                # Ranges and footprints of a previous run are not reused
+                os.unlink(path)
+        p = multiprocessing.Process(target=worker_metadata, args=[gdal2mbtiles])
+        p.start()
+        p.join()
     tminz = gdal2mbtiles.tminz
     tmaxz = gdal2mbtiles.tmaxz
+    scratch = gdal2mbtiles.scratch
+    if scratch:
+        # Leftovers of an interrupted run must not be taken for generated tiles
+        for tz in range(tminz, tmaxz + 1):
+            scratch.discard(tz)
+    # Shared position in the tiles of a zoom level for the dynamic scheduler
+    cursor = multiprocessing.Value('l', 0) if gdal2mbtiles.options.scheduler == 'dynamic' else None
+    controller = None
+    active = None
+    if gdal2mbtiles.options.memory_budget is not None:
+        print("Processes: %d, GDAL cache: %d MB each" % (proc_count, gdal2mbtiles.cachemax))
+        if cursor is not None:
+            controller = ConcurrencyController(gdal2mbtiles.options.memory_budget, proc_count)
+            active = controller.active
     procs = []
-    for cpu in range(proc_count):
-        proc = multiprocessing.Process(target=worker_base_tiles, args=(argv, cpu, queue,))
-        proc.daemon = True
-        proc.start()
-        procs.append(proc)
-    processed_tiles = 0
-    while len(multiprocessing.active_children()):
-        try:
-            total = queue.get(timeout=1)
-            processed_tiles += 1
-            progress.progress_emiter(tmaxz,tminz,processed_tiles,total)
-            gdal2mbtiles.progressbar(processed_tiles / float(total))
-            sys.stdout.flush()
-        except:
-            pass
-    [p.join(timeout=1) for p in procs]
-    print("\n")
+    if not gdal2mbtiles.options.overviews_only:
+        print("Generating Base Tiles:")
+        for cpu in range(proc_count):
+            proc = multiprocessing.Process(target=worker_base_tiles, args=(argv, cpu, queue, cursor, active))
+            proc.daemon = True
+            proc.start()
+            procs.append(proc)
+        processed_tiles = 0
+        while len(multiprocessing.active_children()):
+            try:
+                total = queue.get(timeout=1)
+                processed_tiles += 1
+                progress.progress_emiter(tmaxz,tminz,processed_tiles,total)
+                gdal2mbtiles.progressbar(processed_tiles / float(total))
+                sys.stdout.flush()
+            except:
+                pass
+            if controller:
+                controller.update(procs, processed_tiles)
+        [p.join(timeout=1) for p in procs]
+        print("\n")
     print("Generating Overview Tiles:")
     #  Values generated after base tiles creation
 
     processed_tiles = 0
     for tz in range(tmaxz - 1, tminz - 1, -1):
+        if cursor is not None:
+            cursor.value = 0
+        if controller:
+            controller.reset()
+            controller.tiles = processed_tiles
         for cpu in range(proc_count):
-            proc = multiprocessing.Process(target=worker_overview_tiles, args=(argv, cpu % proc_count, tz, queue))
+            proc = multiprocessing.Process(target=worker_overview_tiles,
+                                           args=(argv, cpu % proc_count, tz, queue, cursor, active))
             proc.daemon = True
             proc.start()
             procs.append(proc)
@@ -2769,13 +5449,36 @@ def main(progress,argv = None):
                 sys.stdout.flush()
             except:
                 pass
+            if controller:
+                controller.update(procs, processed_tiles)
         [p.join(timeout=1) for p in procs]
+        if scratch:
+            scratch.discard(tz + 1)
+    if scratch:
+        scratch.discard(tminz)
+
+    for path in (gdal2mbtiles.palettefile, gdal2mbtiles.scalefile, gdal2mbtiles.mosaicfile):
+        if path and os.path.exists(path):
+            os.unlink(path)
 
     con = gdal2mbtiles.mbtiles_connect()
-    if not gdal2mbtiles.options.resume:
+    if gdal2mbtiles.options.overviews_only:
+        gdal2mbtiles.update_zoom_metadata(con.cursor())
+        gdal2mbtiles.create_index(con.cursor())
+        con.commit()
+    elif not gdal2mbtiles.options.resume and not gdal2mbtiles.options.update:
         print('Indexing tiles')
         gdal2mbtiles.create_index(con.cursor())
     con.execute('''PRAGMA journal_mode=DELETE''')
+    for path, options in gdal2mbtiles.extra_outputs:
+        con = gdal2mbtiles.mbtiles_connect(path)
+        if not gdal2mbtiles.options.resume:
+            gdal2mbtiles.create_index(con.cursor())
+        con.execute('''PRAGMA journal_mode=DELETE''')
+    if gdal2mbtiles.job is not None:
+        # The partial output is complete
+        con.close()
+        os.rename(gdal2mbtiles.output, gdal2mbtiles.job['output'])
 
 
 if __name__ == '__main__':
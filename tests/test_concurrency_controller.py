@@ -0,0 +1,96 @@
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import gdal2mbtiles
+from gdal2mbtiles import ConcurrencyController, GDAL2Mbtiles, ADAPT_INTERVAL
+
+
+class FakeProcess(object):
+    def __init__(self, pid):
+        self.pid = pid
+
+    def is_alive(self):
+        return True
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+    """ConcurrencyController.update with RSS given per process by the test"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.procs = [FakeProcess(pid) for pid in range(8)]
+        self.rss = {}
+        patchers = [mock.patch.object(gdal2mbtiles.time, 'time', lambda: self.now),
+                    mock.patch.object(gdal2mbtiles, 'process_rss', lambda pid: self.rss[pid])]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.controller = ConcurrencyController(1000, 8)
+        self.tiles = 0
+
+    def update(self, rss, rate):
+        "Advances by one interval with total RSS and tiles per second given, returns the active processes"
+
+        for pid in range(8):
+            self.rss[pid] = rss / 8.0
+        self.now += ADAPT_INTERVAL
+        self.tiles += rate * ADAPT_INTERVAL
+        self.controller.update(self.procs, self.tiles)
+        return self.controller.active.value
+
+    def test_starts_with_half(self):
+        self.assertEqual(self.controller.active.value, 4)
+
+    def test_not_adjusted_within_interval(self):
+        self.now += ADAPT_INTERVAL / 2.0
+        self.rss = dict((pid, 1000) for pid in range(8))
+        self.controller.update(self.procs, 100)
+        self.assertEqual(self.controller.active.value, 4)
+
+    def test_scales_up_while_throughput_grows(self):
+        self.assertEqual(self.update(400, 10), 5)
+        self.assertEqual(self.update(500, 20), 6)
+        self.assertEqual(self.update(600, 30), 7)
+        self.assertEqual(self.update(700, 40), 8)
+        self.assertEqual(self.update(800, 50), 8)
+
+    def test_scales_down_when_throughput_does_not_grow(self):
+        self.assertEqual(self.update(400, 10), 5)
+        self.assertEqual(self.update(500, 10), 4)
+        # The ceiling is kept for the zoom level
+        self.assertEqual(self.update(400, 10), 4)
+        self.controller.reset()
+        self.assertEqual(self.update(400, 10), 5)
+
+    def test_resumes_after_memory_falls(self):
+        self.assertEqual(self.update(1200, 10), 3)
+        self.assertEqual(self.update(1100, 10), 2)
+        self.assertEqual(self.update(800, 10), 2)
+        self.assertEqual(self.update(400, 10), 3)
+        self.assertEqual(self.update(500, 20), 4)
+        self.assertEqual(self.update(600, 30), 5)
+
+    def test_keeps_one_process(self):
+        for _ in range(10):
+            active = self.update(2000, 10)
+        self.assertEqual(active, 1)
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    """Processes and GDAL cache of --memory-budget"""
+
+    def test_processes_and_cache(self):
+        gdal2mbtiles = GDAL2Mbtiles(['--memory-budget', '1000', '--processes', '8', 'in.tif', 'out.mbtiles'])
+        self.assertEqual(gdal2mbtiles.options.processes, 7)
+        self.assertEqual(gdal2mbtiles.cachemax, 35)
+
+    def test_with_zoom_levels(self):
+        gdal2mbtiles = GDAL2Mbtiles(['--memory-budget', '1000', '-z', '3-5', 'in.tif', 'out.mbtiles'])
+        self.assertEqual((gdal2mbtiles.tminz, gdal2mbtiles.tmaxz), (3, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
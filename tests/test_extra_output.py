@@ -0,0 +1,28 @@
+import unittest
+
+from gdal2mbtiles import GDAL2Mbtiles
+
+
+class ExtraOutputTest(unittest.TestCase):
+    """Extra outputs whose overview tiles can not be built from the decoded tiles of the main output"""
+
+    def parse(self, args):
+        return GDAL2Mbtiles(args.split() + ['in.tif', 'out.mbtiles'])
+
+    def test_lossless_from_lossy(self):
+        for args in ('-f JPEG --extra-output PNG,x.mbtiles', '-f WEBP --extra-output PNG,x.mbtiles',
+                     '-f AUTO --extra-output PNG,x.mbtiles', '-f PNG8 --extra-output PNG,x.mbtiles'):
+            self.assertRaises(SystemExit, self.parse, args)
+            self.parse('--scratch . ' + args)
+
+    def test_transparency_from_jpeg(self):
+        self.assertRaises(SystemExit, self.parse, '-f JPEG --extra-output WEBP,x.mbtiles')
+
+    def test_allowed(self):
+        for args in ('-f JPEG --extra-output JPEG,50,x.mbtiles', '-f PNG --extra-output JPEG,x.mbtiles',
+                     '-f WEBP --webp-lossless --extra-output PNG,x.mbtiles', '-f PNG8 --extra-output WEBP,x.mbtiles'):
+            self.parse(args)
+
+
+if __name__ == '__main__':
+    unittest.main()
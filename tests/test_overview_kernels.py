@@ -0,0 +1,54 @@
+import unittest
+
+import numpy
+
+from gdal2mbtiles import overview_blocks, overview_kernels
+
+
+class OverviewKernelsTest(unittest.TestCase):
+    """Vectorized overview kernels of --overview-resampling on 2x2 blocks"""
+
+    def query(self, pixels):
+        "Query window of one 2x2 block given as [[upper left, upper right], [lower left, lower right]]"
+
+        return numpy.array(pixels, numpy.uint8)
+
+    def overview(self, kernel, pixels, has_alpha):
+        tile = overview_kernels[kernel](overview_blocks(self.query(pixels)), has_alpha)
+        self.assertEqual(tile.shape, (1, 1, len(pixels[0][0])))
+        return tile[0, 0].tolist()
+
+    def test_blocks(self):
+        query = numpy.arange(4 * 4, dtype=numpy.uint8).reshape(4, 4, 1)
+        blocks = overview_blocks(query)
+        self.assertEqual(blocks.shape, (2, 2, 4, 1))
+        self.assertEqual(blocks[0, 1, :, 0].tolist(), [2, 3, 6, 7])
+        self.assertEqual(blocks[1, 0, :, 0].tolist(), [8, 9, 12, 13])
+
+    def test_near(self):
+        self.assertEqual(self.overview('near', [[[10], [20]], [[30], [40]]], False), [10])
+
+    def test_mode(self):
+        self.assertEqual(self.overview('mode', [[[1], [2]], [[2], [3]]], False), [2])
+        # Ties in favour of the upper left
+        self.assertEqual(self.overview('mode', [[[1], [2]], [[3], [4]]], False), [1])
+        # Transparent pixels are not counted
+        self.assertEqual(self.overview('mode', [[[5, 0], [5, 0]], [[7, 255], [8, 255]]], True), [7, 255])
+
+    def test_min_max(self):
+        pixels = [[[10, 255], [20, 255]], [[0, 0], [40, 255]]]
+        self.assertEqual(self.overview('min', pixels, True), [10, 255])
+        self.assertEqual(self.overview('max', pixels, True), [40, 255])
+        self.assertEqual(self.overview('min', [[[10], [20]], [[0], [40]]], False), [0])
+
+    def test_weighted(self):
+        self.assertEqual(self.overview('weighted', [[[10], [20]], [[30], [40]]], False), [25])
+        # Transparent pixels do not darken the edges
+        self.assertEqual(self.overview('weighted', [[[100, 255], [0, 0]], [[0, 0], [0, 0]]], True), [100, 64])
+        self.assertEqual(self.overview('weighted', [[[100, 255], [200, 255]], [[0, 0], [0, 0]]], True),
+                         [150, 128])
+        self.assertEqual(self.overview('weighted', [[[0, 0], [0, 0]], [[0, 0], [0, 0]]], True), [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image
+
+from gdal2mbtiles import GDAL2Mbtiles
+
+
+class FakeQueue(object):
+    def put(self, total):
+        pass
+
+
+class OverviewsOnlyTest(unittest.TestCase):
+    """--overviews-only from the base tiles of an existing .mbtiles"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.output = os.path.join(self.dir, 'out.mbtiles')
+
+    def create(self, tiles):
+        "Creates the output with the tiles given as {(tz, tx, ty): (format, array)}"
+
+        g = GDAL2Mbtiles(['--overviews-only', self.output])
+        con = g.mbtiles_connect()
+        cur = con.cursor()
+        g.mbtiles_setup(cur)
+        g.create_index(cur)
+        for (tz, tx, ty), (tile_format, tile) in sorted(tiles.items()):
+            f = io.BytesIO()
+            Image.fromarray(tile).save(f, tile_format)
+            g.insert_tile(cur, tz, tx, ty, f.getvalue())
+        con.commit()
+        con.close()
+
+    def overviews(self, args):
+        g = GDAL2Mbtiles(['--overviews-only', '--overview-resampling', 'near', '--processes', '1'] + args +
+                         [self.output])
+        g.open_mbtiles()
+        con = g.mbtiles_connect()
+        for tz in range(g.tmaxz - 1, g.tminz - 1, -1):
+            g.generate_overview_tiles(0, tz, FakeQueue(), con)
+        return g, con
+
+    def tile(self, color, size=64):
+        tile = numpy.empty((size, size, len(color)), numpy.uint8)
+        tile[:, :] = color
+        return tile
+
+    def test_format_detected(self):
+        self.create({(2, 0, 0): ('JPEG', self.tile((200, 0, 0)))})
+        g, con = self.overviews([])
+        self.assertEqual(g.tiledriver, 'JPEG')
+        self.assertEqual((g.tminz, g.tmaxz), (0, 2))
+
+    def test_auto_kept(self):
+        # The opaque JPEG tile is the first tile of the base level
+        self.create({(2, 0, 0): ('JPEG', self.tile((200, 0, 0))),
+                     (2, 1, 0): ('PNG', self.tile((0, 200, 0, 128)))})
+        g, con = self.overviews(['-f', 'AUTO'])
+        self.assertEqual(g.tiledriver, 'AUTO')
+        data, = con.execute("SELECT tile_data FROM tiles WHERE zoom_level = 1 AND tile_column = 0 "
+                            "AND tile_row = 0").fetchone()
+        parent = Image.open(io.BytesIO(data))
+        self.assertEqual(parent.format, 'PNG')
+        self.assertEqual(parent.mode, 'RGBA')
+        # Missing children are transparent, the semi-transparent child keeps its alpha
+        self.assertEqual(parent.getpixel((16, 16))[3], 0)
+        self.assertEqual(parent.getpixel((48, 48))[3], 128)
+
+    def test_missing_base_level(self):
+        self.create({(2, 0, 0): ('PNG', self.tile((200, 0, 0, 255)))})
+        self.assertRaises(SystemExit, self.overviews, ['-z', '0-3'])
+
+    def test_lowest_level(self):
+        self.create({(2, 0, 0): ('PNG', self.tile((200, 0, 0, 255)))})
+        g, con = self.overviews(['-z', '1'])
+        self.assertEqual((g.tminz, g.tmaxz), (1, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
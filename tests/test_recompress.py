@@ -0,0 +1,54 @@
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image
+
+from gdal2mbtiles import GDAL2Mbtiles, RECOMPRESS_BATCH
+
+
+class RecompressTest(unittest.TestCase):
+    """--recompress of the deduplicated layout: map and images tables with a tiles view"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.input = os.path.join(self.dir, 'in.mbtiles')
+        con = sqlite3.connect(self.input)
+        con.execute("CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id text)")
+        con.execute("CREATE TABLE images (tile_id text, tile_data blob)")
+        con.execute("""CREATE VIEW tiles AS SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data
+                       FROM map JOIN images ON map.tile_id = images.tile_id""")
+        for n, color in enumerate(((200, 0, 0, 255), (0, 200, 0, 128))):
+            tile = numpy.empty((64, 64, 4), numpy.uint8)
+            tile[:, :] = color
+            f = io.BytesIO()
+            Image.fromarray(tile).save(f, 'PNG')
+            con.execute("INSERT INTO images VALUES (?, ?)", (str(n), sqlite3.Binary(f.getvalue())))
+        # A wide row of level 9 and rows of few tiles of levels 3 and 9
+        self.tiles = set((9, x, 100) for x in range(RECOMPRESS_BATCH + 10))
+        self.tiles.update((9, x, y) for x in range(5) for y in range(200, 260))
+        self.tiles.update((3, x, y) for x in range(8) for y in range(8))
+        con.executemany("INSERT INTO map VALUES (?, ?, ?, ?)",
+                        [(z, x, y, str((x + y) % 2)) for z, x, y in sorted(self.tiles)])
+        con.commit()
+        con.close()
+
+    def test_units_cover_tiles_once(self):
+        g = GDAL2Mbtiles(['--recompress', '-f', 'WEBP', self.input, os.path.join(self.dir, 'out.mbtiles')])
+        g.open_recompress()
+        tiles = []
+        for unit in g.recompress_units():
+            count, size, unit_tiles = g.recompress_unit(unit)
+            self.assertTrue(count <= RECOMPRESS_BATCH)
+            tiles.extend((z, x, y) for z, x, y, data in unit_tiles)
+        self.assertEqual(len(tiles), len(self.tiles))
+        self.assertEqual(set(tiles), self.tiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
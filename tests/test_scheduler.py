@@ -0,0 +1,55 @@
+import multiprocessing
+import unittest
+
+from gdal2mbtiles import GDAL2Mbtiles, SCHEDULER_BLOCK
+
+
+class SchedulerTest(unittest.TestCase):
+    """Order of the tiles of a zoom level and their distribution to the processes"""
+
+    def setUp(self):
+        self.gdal2mbtiles = GDAL2Mbtiles(['--processes', '3', 'in.tif', 'out.mbtiles'])
+        # Ranges not multiples of the block
+        self.gdal2mbtiles.tminmax = list(range(0, 32))
+        self.gdal2mbtiles.tminmax[5] = (3, 7, 3 + 2 * SCHEDULER_BLOCK + 2, 7 + SCHEDULER_BLOCK + 4)
+        tminx, tminy, tmaxx, tmaxy = self.gdal2mbtiles.tminmax[5]
+        self.tiles = set((x, y) for x in range(tminx, tmaxx + 1) for y in range(tminy, tmaxy + 1))
+
+    def test_blocks(self):
+        tiles = list(self.gdal2mbtiles.block_tiles(5, 0, len(self.tiles)))
+        self.assertEqual([ti for ti, tx, ty in tiles], list(range(1, len(self.tiles) + 1)))
+        self.assertEqual(set((tx, ty) for ti, tx, ty in tiles), self.tiles)
+        # The first block is the upper left one, its rows from the top
+        first = [(tx, ty) for ti, tx, ty in tiles[:SCHEDULER_BLOCK * SCHEDULER_BLOCK]]
+        self.assertEqual(first[:2], [(3, 7 + SCHEDULER_BLOCK + 4), (4, 7 + SCHEDULER_BLOCK + 4)])
+        self.assertEqual(max(tx for tx, ty in first), 3 + SCHEDULER_BLOCK - 1)
+        self.assertEqual(min(ty for tx, ty in first), 7 + 4 + 1)
+
+    def test_blocks_split(self):
+        tiles = [tile for start in range(0, len(self.tiles), 7)
+                 for tile in self.gdal2mbtiles.block_tiles(5, start, min(start + 7, len(self.tiles)))]
+        self.assertEqual(tiles, list(self.gdal2mbtiles.block_tiles(5, 0, len(self.tiles))))
+
+    def test_static(self):
+        tiles = [(tx, ty) for cpu in range(3) for ti, tx, ty in self.gdal2mbtiles.iter_tiles(5, cpu)]
+        self.assertEqual(len(tiles), len(self.tiles))
+        self.assertEqual(set(tiles), self.tiles)
+
+    def test_dynamic(self):
+        # Processes taking chunks from the shared cursor in turn
+        cursor = multiprocessing.Value('l', 0)
+        workers = [self.gdal2mbtiles.iter_tiles(5, cpu, cursor) for cpu in range(3)]
+        tiles = []
+        while workers:
+            for worker in list(workers):
+                try:
+                    ti, tx, ty = next(worker)
+                    tiles.append((tx, ty))
+                except StopIteration:
+                    workers.remove(worker)
+        self.assertEqual(len(tiles), len(self.tiles))
+        self.assertEqual(set(tiles), self.tiles)
+
+
+if __name__ == '__main__':
+    unittest.main()
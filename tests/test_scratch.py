@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from gdal2mbtiles import ScratchPyramid
+
+
+class ScratchPyramidTest(unittest.TestCase):
+    """Raw tile pixels of --scratch"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.tminmax = (10, 20, 13, 22)
+
+    def tile(self, value):
+        tile = numpy.empty((16, 16, 4), numpy.uint8)
+        tile[:, :] = value
+        return tile
+
+    def test_write_read(self):
+        scratch = ScratchPyramid(self.dir, 'out', 16)
+        scratch.open(5, self.tminmax, 4)
+        scratch.write(5, 10, 20, self.tile(1))
+        scratch.write(5, 13, 22, self.tile(2))
+        self.assertTrue((scratch.read(5, 10, 20) == 1).all())
+        self.assertTrue((scratch.read(5, 13, 22) == 2).all())
+        self.assertIsNone(scratch.read(5, 11, 20))
+
+    def test_out_of_range(self):
+        scratch = ScratchPyramid(self.dir, 'out', 16)
+        scratch.open(5, self.tminmax, 4)
+        scratch.write(5, 14, 20, self.tile(1))
+        self.assertIsNone(scratch.read(5, 14, 20))
+        self.assertIsNone(scratch.read(5, 9, 23))
+
+    def test_fewer_bands(self):
+        scratch = ScratchPyramid(self.dir, 'out', 16)
+        scratch.open(5, self.tminmax, 4)
+        scratch.write(5, 12, 21, self.tile(7)[:, :, :3])
+        self.assertTrue((scratch.read(5, 12, 21)[:, :, :3] == 7).all())
+
+    def test_shared_by_workers(self):
+        # Every worker opens the level, the tiles written by one are read by another
+        first, second = ScratchPyramid(self.dir, 'out', 16), ScratchPyramid(self.dir, 'out', 16)
+        first.open(5, self.tminmax, 4)
+        second.open(5, self.tminmax, 4)
+        first.write(5, 11, 21, self.tile(3))
+        first.close()
+        self.assertTrue((second.read(5, 11, 21) == 3).all())
+        second.close()
+
+    def test_discard(self):
+        scratch = ScratchPyramid(self.dir, 'out', 16)
+        scratch.open(5, self.tminmax, 4)
+        scratch.close()
+        self.assertTrue(os.path.exists(scratch.filename(5)))
+        scratch.discard(5)
+        self.assertFalse(os.path.exists(scratch.filename(5)))
+        self.assertFalse(os.path.exists(scratch.filename(5, 'flags')))
+
+
+if __name__ == '__main__':
+    unittest.main()
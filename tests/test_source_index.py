@@ -0,0 +1,36 @@
+import random
+import unittest
+
+from gdal2mbtiles import SourceIndex
+
+
+class SourceIndexTest(unittest.TestCase):
+    """Spatial index of the sources of a mosaic"""
+
+    def setUp(self):
+        rnd = random.Random(0)
+        self.boxes = []
+        for i in range(500):
+            x, y = rnd.uniform(0, 1000), rnd.uniform(0, 1000)
+            w, h = rnd.uniform(1, 30), rnd.uniform(1, 30)
+            self.boxes.append((x, y, x + w, y + h, 1.0))
+        self.index = SourceIndex(self.boxes)
+
+    def scan(self, minx, miny, maxx, maxy):
+        return [i for i, b in enumerate(self.boxes) if b[0] < maxx and b[2] > minx and b[1] < maxy and b[3] > miny]
+
+    def test_query_as_scan(self):
+        rnd = random.Random(1)
+        for size in (1, 20, 200, 2000):
+            for n in range(50):
+                x, y = rnd.uniform(-100, 1000), rnd.uniform(-100, 1000)
+                self.assertEqual(self.index.query(x, y, x + size, y + size), self.scan(x, y, x + size, y + size))
+
+    def test_touching_not_intersecting(self):
+        index = SourceIndex([(0, 0, 10, 10, 1.0), (10, 0, 20, 10, 1.0)])
+        self.assertEqual(index.query(10, 0, 15, 5), [1])
+        self.assertEqual(index.query(5, 5, 15, 6), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import io
+import unittest
+
+import numpy
+from PIL import Image
+
+from gdal2mbtiles import GDAL2Mbtiles, TileEncoder, tile_formats
+
+
+def encoder(args):
+    options = GDAL2Mbtiles(args + ['in.tif', 'out.mbtiles']).options
+    return TileEncoder(tile_formats[options.output_format][0], options)
+
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+
+class PNG8Test(unittest.TestCase):
+    """PNG8 tiles quantized to 8-bit palette with alpha"""
+
+    def test_exact_palette(self):
+        tile = numpy.zeros((64, 64, 4), numpy.uint8)
+        tile[:32] = (200, 10, 10, 255)
+        tile[32:, :32] = (10, 200, 10, 128)
+        img = decode(encoder(['-f', 'PNG8']).encode(tile))
+        self.assertEqual((img.format, img.mode), ('PNG', 'P'))
+        self.assertTrue((numpy.array(img.convert('RGBA')) == tile).all())
+
+    def test_quantized(self):
+        # Smooth gradient of more than 256 colours
+        tile = numpy.zeros((64, 64, 3), numpy.uint8)
+        tile[:, :, 0] = numpy.arange(64)[:, None] * 4
+        tile[:, :, 1] = numpy.arange(64)[None, :] * 4
+        img = decode(encoder(['-f', 'PNG8']).encode(tile))
+        self.assertEqual(img.mode, 'P')
+        error = numpy.abs(numpy.array(img.convert('RGB')).astype(int) - tile).mean()
+        self.assertTrue(error <= 3.0)
+
+    def test_truecolour_over_max_error(self):
+        tile = numpy.random.RandomState(0).randint(0, 256, (64, 64, 3)).astype(numpy.uint8)
+        img = decode(encoder(['-f', 'PNG8', '--png8-max-error', '1']).encode(tile))
+        self.assertEqual(img.mode, 'RGB')
+        self.assertTrue((numpy.array(img) == tile).all())
+
+
+class AutoTest(unittest.TestCase):
+    """AUTO tiles: JPEG for opaque tiles, PNG for tiles with transparency, empty tiles skipped"""
+
+    def setUp(self):
+        self.encoder = encoder(['-f', 'AUTO'])
+        self.tile = numpy.zeros((64, 64, 4), numpy.uint8)
+        self.tile[:, :] = (100, 150, 200, 255)
+
+    def test_opaque(self):
+        img = decode(self.encoder.encode(self.tile))
+        self.assertEqual((img.format, img.mode), ('JPEG', 'RGB'))
+        img = decode(self.encoder.encode(self.tile[:, :, :3]))
+        self.assertEqual(img.format, 'JPEG')
+
+    def test_transparent(self):
+        self.tile[:10, :, 3] = 0
+        img = decode(self.encoder.encode(self.tile))
+        self.assertEqual((img.format, img.mode), ('PNG', 'RGBA'))
+        self.assertTrue((numpy.array(img) == self.tile).all())
+
+    def test_empty(self):
+        self.tile[:, :, 3] = 0
+        self.assertIsNone(self.encoder.encode(self.tile))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image
+
+from gdal2mbtiles import GDAL2Mbtiles, GlobalMercator
+
+
+class FakeQueue(object):
+    def put(self, total):
+        pass
+
+
+class UpdateTest(unittest.TestCase):
+    """Overview tiles rebuilt by --update keep the children out of the changed region"""
+
+    colors = {(0, 0): (255, 0, 0, 255), (1, 0): (0, 255, 0, 255),
+              (0, 1): (0, 0, 255, 255), (1, 1): (255, 255, 0, 255)}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.output = os.path.join(self.dir, 'out.mbtiles')
+        # Base tile 0,0 of zoom level 2 in the lower left corner
+        self.gdal2mbtiles = g = GDAL2Mbtiles(['--update=-170,-80,-100,-70', '--overview-resampling', 'near',
+                                              '--tilesize', '64', '--processes', '1', '-z', '1-2',
+                                              'in.tif', self.output])
+        g.mercator = GlobalMercator(g.tilesize)
+        g.tminmax = [(0, 0, 0, 0), (0, 0, 1, 1), (0, 0, 3, 3)]
+        g.extents = list(g.tminmax)
+        g.dataBandsCount = 3
+        g.tiledriver, g.tileext = 'PNG', 'png'
+
+        self.con = g.mbtiles_connect()
+        cur = self.con.cursor()
+        g.mbtiles_setup(cur)
+        g.create_index(cur)
+        for (tx, ty), color in self.colors.items():
+            g.insert_tile(cur, 2, tx, ty, self.encode(color))
+        self.con.commit()
+        self.addCleanup(self.con.close)
+
+    def encode(self, color):
+        tile = numpy.empty((64, 64, 4), numpy.uint8)
+        tile[:, :] = color
+        f = io.BytesIO()
+        Image.fromarray(tile).save(f, 'PNG')
+        return f.getvalue()
+
+    def test_parent_keeps_other_quadrants(self):
+        g = self.gdal2mbtiles
+        g.apply_update()
+        self.assertEqual(g.tminmax[2], (0, 0, 0, 0))
+        self.assertEqual(g.tminmax[1], (0, 0, 0, 0))
+
+        changed = (255, 255, 255, 255)
+        g.insert_tile(self.con.cursor(), 2, 0, 0, self.encode(changed))
+        g.generate_overview_tiles(0, 1, FakeQueue(), self.con)
+
+        parent = g.read_tile(self.con.cursor(), 1, 0, 0)
+        # TMS rows are counted from the bottom, the upper children are in the upper half
+        self.assertEqual(tuple(parent[48, 16]), changed)
+        self.assertEqual(tuple(parent[48, 48]), self.colors[(1, 0)])
+        self.assertEqual(tuple(parent[16, 16]), self.colors[(0, 1)])
+        self.assertEqual(tuple(parent[16, 48]), self.colors[(1, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+
+import numpy
+
+from gdal2mbtiles import ValueScaler
+
+
+class ValueScalerTest(unittest.TestCase):
+    """Scaling of 16-bit and float sources to 8-bit tile values"""
+
+    def test_linear(self):
+        scaler = ValueScaler([(0, 1000), (100, 200)])
+        data = numpy.array([[0, 500, 1000, 2000], [100, 150, 200, 50]], numpy.float64)
+        self.assertEqual(scaler.scale(data).tolist(), [[0, 128, 255, 255], [0, 128, 255, 0]])
+
+    def test_nan(self):
+        scaler = ValueScaler([(0, 10)])
+        self.assertEqual(scaler.scale(numpy.array([[numpy.nan, 10]])).tolist(), [[0, 255]])
+
+    def test_gamma(self):
+        scaler = ValueScaler([(0, 100)], gamma=2.0)
+        self.assertEqual(scaler.scale(numpy.array([[25.0]])).tolist(), [[128]])
+
+    def test_ramp(self):
+        # Entries of the ramp by value and in percents of the range
+        ramp = [(0, False, (0, 0, 0, 255)), (100, True, (255, 255, 255, 255))]
+        scaler = ValueScaler([(0, 1000)], ramp=ramp)
+        rgba = scaler.scale(numpy.array([[0, 1000]], numpy.float64))
+        self.assertEqual(rgba.shape, (4, 2))
+        self.assertEqual(rgba[:, 0].tolist(), [0, 0, 0, 255])
+        self.assertEqual(rgba[:, 1].tolist(), [255, 255, 255, 255])
+
+    def test_palette(self):
+        lut = numpy.zeros((256, 4), numpy.uint8)
+        lut[1] = (10, 20, 30, 255)
+        scaler = ValueScaler(None, lut=lut)
+        rgba = scaler.scale(numpy.array([[[0, 1]]], numpy.uint8))
+        self.assertEqual(rgba.shape, (4, 1, 2))
+        self.assertEqual(rgba[:, 0, 1].tolist(), [10, 20, 30, 255])
+        self.assertEqual(rgba[3, 0, 0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()